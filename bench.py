@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+# Benchmarks the build phases against generated host trees. This doesn't
+# need root or a Gentoo host, so it can run on any Linux machine.
+#
+# Usage: ./bench.py [--scales=100,1000,5000] [--seed=0] [--output=bench.json] [--keep]
+
+import sys
+
+from pkg.bench.Bench import Bench
+
+class Main(object):
+    @classmethod
+    def start(cls):
+        scales = [100, 1000, 5000]
+        seed = 0
+        output = None
+        keep = False
+
+        for argument in sys.argv[1:]:
+            name, separator, value = argument.partition("=")
+
+            if name == "--scales":
+                scales = [int(scale) for scale in value.split(",")]
+            elif name == "--seed":
+                seed = int(value)
+            elif name == "--output":
+                output = value
+            elif name == "--keep":
+                keep = True
+            else:
+                print("Unknown option: " + argument)
+                quit(1)
+
+        Bench.Report(Bench.Run(scales, seed, keep), output)
+
+if __name__ == '__main__':
+    Main.start()
@@ -3,39 +3,371 @@
 # Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
 # Licensed under the Simplified BSD License which can be found in the LICENSE file.
 
-from subprocess import call
+import multiprocessing
+import os
+import signal
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import pkg.libs.Variables as var
 
 from pkg.libs.Core import Core
 from pkg.libs.Tools import Tools
+from pkg.libs.Metrics import Metrics
+from pkg.libs.BootLog import BootLog
+from pkg.libs.BuildContext import BuildContext
+from pkg.libs.Inspector import Inspector
+from pkg.libs.Provenance import Provenance
+from pkg.libs.Watcher import Watcher
 from pkg.hooks.Addon import Addon
+from pkg.hooks.Zfs import Zfs
 
 class Main(object):
+    # Commands that don't build an initramfs (and don't need root)
+    _commands = ["analyze", "inspect", "why"]
+
+    # Phases that don't depend on the kernel. When the initramfs of several
+    # kernels is built, they run once before the builds start.
+    _shared_phases = [
+        Core.VerifySupportedArchitecture,
+        Core.VerifyPreliminaryBinaries,
+        Core.VerifyBinaries,
+        Core.ResolveUserspace,
+    ]
+
+    # Phases of the build of a single initramfs
+    _build_phases = [
+        Tools.Clean,
+        Core.CreateBaselayout,
+        Core.VerifyZpoolCache,
+        Core.DetectHostModules,
+        Core.CheckBuildCache,
+        Core.CopyRequiredFiles,
+        Core.CopyModules,
+        Core.GenerateModprobeInfo,
+        Core.CopyFirmware,
+        Core.CreateLinks,
+        Core.CopyDependencies,
+        Core.StripFiles,
+        Core.LastSteps,
+        Core.WriteProvenance,
+        Core.CreateInitramfs,
+    ]
+
     # Let the games begin ...
     @classmethod
     def start(cls):
+        if len(sys.argv) > 1 and sys.argv[1] in cls._commands:
+            getattr(cls, sys.argv[1].capitalize())(sys.argv[2:])
+            return
+
+        Metrics.Install()
         Tools.ProcessArguments(Addon)
-        call(["clear"])
+        Tools.ClearScreen()
         Tools.PrintHeader()
         Core.PrintMenu()
 
-        if var.kernel or Addon.GetFiles():
+        if not var.kernels and (var.kernel or Addon.GetFiles() or var.hostOnly or var.watch):
             Core.GetDesiredKernel()
+            BuildContext(var.kernel).Apply()
+            Core.VerifyModulesDirectory()
+
+        # Every phase is measured, a summary is printed when the program exits
+        for phase in cls._shared_phases:
+            Metrics.Run(phase)
+
+        if var.watch:
+            cls.Watch()
+        elif var.kernels:
+            cls.BuildKernels()
+        else:
+            cls.Build()
+
+    # Builds the initramfs of the current build context
+    @classmethod
+    def Build(cls):
+        for phase in cls._build_phases:
+            Metrics.Run(phase)
 
-        Core.VerifySupportedArchitecture()
-        Tools.Clean()
-        Core.VerifyPreliminaryBinaries()
-        Core.CreateBaselayout()
-        Core.VerifyBinaries()
-        Core.CopyRequiredFiles()
-        Core.CopyModules()
-        Core.CopyFirmware()
-        Core.CreateLinks()
-        Core.CopyDependencies()
-        Core.LastSteps()
-        Core.CreateInitramfs()
         Tools.CleanAndExit(var.initrd)
 
+    # Builds the initramfs of every kernel given with --kernels. Each build
+    # runs in its own (forked) process with its own build context, and
+    # inherits everything that the shared phases already resolved.
+    @classmethod
+    def BuildKernels(cls):
+        contexts = [BuildContext(kernel) for kernel in var.kernels]
+
+        for context in contexts:
+            Core.VerifyModulesDirectory(context.modules)
+
+        failed = cls.RunBuilds(contexts)
+
+        if failed:
+            Tools.Fail("Unable to build the initramfs of: " + ", ".join(failed))
+
+        Tools.Info("Please copy " + ", ".join("\"" + context.initrd + "\"" for context in contexts) +
+                   " to your /boot directory")
+        Tools.Flush()
+        quit()
+
+    # Runs the builds of the contexts in worker processes and returns the
+    # kernels whose build failed
+    @classmethod
+    def RunBuilds(cls, vContexts):
+        jobs = min(var.jobs or os.cpu_count() or 1, len(vContexts))
+        failed = []
+
+        Tools.Info("Building the initramfs of " + str(len(vContexts)) + " kernels (" + str(jobs) + " at a time) ...")
+
+        # Anything still buffered would be written again by every worker
+        Tools.Flush()
+
+        try:
+            with ProcessPoolExecutor(jobs, multiprocessing.get_context("fork")) as pool:
+                for context, result in zip(vContexts, pool.map(cls.BuildKernel, vContexts)):
+                    Metrics.Merge(context.kernel, result["metrics"])
+
+                    if result["status"]:
+                        failed.append(context.kernel)
+        except BrokenProcessPool:
+            Tools.Warn("A build process was terminated unexpectedly!")
+            return [context.kernel for context in vContexts]
+
+        return failed
+
+    # Builds the initramfs of a kernel in a worker process and returns
+    # its exit status and metrics to the parent
+    @classmethod
+    def BuildKernel(cls, vContext):
+        # The watch mode's handler only applies to the parent
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        vContext.Apply()
+        var.logTag = vContext.kernel
+        Metrics.Reset()
+
+        # The build ends by exiting (after cleaning up) whether it
+        # succeeded, reused a cached image or failed
+        try:
+            cls.Build()
+            status = 0
+        except SystemExit as exit:
+            status = exit.code or 0
+
+        Tools.Flush()
+
+        return {"status": status, "metrics": Metrics.GetResults()}
+
+    # Keeps running and rebuilds the initramfs of a kernel when its modules
+    # directory changes (i.e the kernel was reinstalled), and of every kernel
+    # when the zpool.cache, modprobe.d, init or a userspace file changes. A
+    # newly installed kernel (once depmod ran) is built and watched as well.
+    @classmethod
+    def Watch(cls):
+        kernels = list(var.kernels or [var.kernel])
+        watcher = Watcher(var.watchInterval)
+
+        # Stop cleanly (between builds, the metrics of the last one are printed)
+        signal.signal(signal.SIGTERM, lambda vSignal, vFrame: quit())
+
+        cls.WatchUserspace(watcher)
+        watcher.Add(var.phome + "/files/init", "all")
+        watcher.Add("/etc/modprobe.d", "all")
+        watcher.Add("/lib/modules", "kernels")
+
+        if Zfs.IsEnabled():
+            watcher.Add("/etc/zfs/zpool.cache", "all")
+
+        for kernel in kernels:
+            watcher.Add("/lib/modules/" + kernel, kernel)
+
+        pending = set(kernels)
+
+        try:
+            while True:
+                if pending:
+                    cls.Rebuild(sorted(pending))
+
+                Tools.Info("Watching for changes ...")
+                Tools.Flush()
+
+                targets = watcher.Wait(var.watchDelay)
+                pending = set(target for target in targets if target in kernels)
+
+                if "userspace" in targets:
+                    if not cls.ResolveUserspace(watcher):
+                        pending = set()
+                        continue
+
+                    pending.update(kernels)
+
+                if "all" in targets:
+                    pending.update(kernels)
+
+                if "kernels" in targets:
+                    for kernel in cls.FindNewKernels(kernels):
+                        Tools.Flag("Found a new kernel: " + kernel)
+                        kernels.append(kernel)
+                        watcher.Add("/lib/modules/" + kernel, kernel)
+                        pending.add(kernel)
+        except KeyboardInterrupt:
+            Tools.NewLine()
+        finally:
+            watcher.Close()
+
+    # Watches the hook files and their libraries
+    @classmethod
+    def WatchUserspace(cls, vWatcher):
+        files, binaries, libraries = Core.GetUserspace()
+
+        for path in files + libraries:
+            vWatcher.Add(path, "userspace")
+
+    # Resolves the userspace closure again after a userspace file changed.
+    # Returns false if a required file is missing (the builds are skipped
+    # until the next change).
+    @classmethod
+    def ResolveUserspace(cls, vWatcher):
+        Core._userspace = None
+        Provenance.Reset()
+
+        try:
+            for phase in cls._shared_phases:
+                Metrics.Run(phase)
+
+            cls.WatchUserspace(vWatcher)
+        except SystemExit:
+            Tools.Warn("The initramfs will be built after the next change ...")
+            return False
+
+        return True
+
+    # Returns the kernels in /lib/modules that aren't built yet. A kernel
+    # counts once depmod generated its modules.dep.
+    @classmethod
+    def FindNewKernels(cls, vKernels):
+        try:
+            names = sorted(os.listdir("/lib/modules"))
+        except OSError:
+            return []
+
+        return [name for name in names if name not in vKernels and
+                os.path.isfile("/lib/modules/" + name + "/modules.dep")]
+
+    # Rebuilds the initramfs of the kernels whose modules directory exists
+    @classmethod
+    def Rebuild(cls, vKernels):
+        contexts = []
+
+        for kernel in vKernels:
+            context = BuildContext(kernel)
+
+            if os.path.isdir(context.modules):
+                contexts.append(context)
+            else:
+                Tools.Warn("The modules directory of " + kernel + " doesn't exist. Skipping ...")
+
+        if not contexts:
+            return
+
+        # Only the results of the last rebuild are kept
+        Metrics.Reset()
+
+        failed = cls.RunBuilds(contexts)
+
+        for context in contexts:
+            if context.kernel in failed:
+                Tools.Warn("Unable to build the initramfs of " + context.kernel + ". It will be built after the next change ...")
+            else:
+                Tools.Flag("Updated " + var.home + "/" + context.initrd)
+
+    # Analyzes the boot logs written by init:
+    # ./mkinitrd.py analyze [--recent=1] [--threshold=1.25] [--minimum=0.05] [--output=file] <log>...
+    @classmethod
+    def Analyze(cls, vArguments):
+        options = {"recent": 1, "threshold": 1.25, "minimum": 0.05, "output": None}
+        files = []
+
+        for argument in vArguments:
+            name, separator, value = argument[2:].partition("=")
+
+            if not argument.startswith("--"):
+                files.append(argument)
+            elif name in ("recent", "threshold", "minimum"):
+                try:
+                    options[name] = int(value) if name == "recent" else float(value)
+                except ValueError:
+                    Tools.Fail("The --" + name + " option requires a number!")
+            elif name == "output":
+                options["output"] = value
+            else:
+                Tools.Fail("Unknown option: " + argument)
+
+        if not files:
+            files = ["/var/log/bliss-boot.log"]
+
+        BootLog.Analyze(files, options["recent"], options["threshold"], options["minimum"], options["output"])
+
+    # Shows what takes up the space in an initramfs, or what changed between two:
+    # ./mkinitrd.py inspect [--top=15] [--depth=2] [--output=file] <image> [<other image>]
+    @classmethod
+    def Inspect(cls, vArguments):
+        options = {"top": 15, "depth": 2, "output": None}
+        images = []
+
+        for argument in vArguments:
+            name, separator, value = argument[2:].partition("=")
+
+            if not argument.startswith("--"):
+                images.append(argument)
+            elif name in ("top", "depth"):
+                options[name] = Tools.GetNumericOption(name, value)
+            elif name == "output":
+                options["output"] = value
+            else:
+                Tools.Fail("Unknown option: " + argument)
+
+        if len(images) == 1:
+            Inspector.Inspect(images[0], options["top"], options["depth"], options["output"])
+        elif len(images) == 2:
+            Inspector.Diff(images[0], images[1], options["top"], options["depth"], options["output"])
+        else:
+            Tools.Fail("The inspect command needs one image (or two images to compare)!")
+
+    # Explains why files are in an initramfs, or shows what every hook entry
+    # adds to it (without paths), from the provenance graph of a build:
+    # ./mkinitrd.py why [--graph=file] [--top=15] [--output=file.json|file.dot] [<path>...]
+    @classmethod
+    def Why(cls, vArguments):
+        options = {"graph": None, "top": 15, "output": None}
+        paths = []
+
+        for argument in vArguments:
+            name, separator, value = argument[2:].partition("=")
+
+            if not argument.startswith("--"):
+                paths.append(argument)
+            elif name == "top":
+                options["top"] = Tools.GetNumericOption(name, value)
+            elif name in ("graph", "output"):
+                options[name] = value
+            else:
+                Tools.Fail("Unknown option: " + argument)
+
+        graph = Provenance.Load(options["graph"])
+
+        if paths:
+            Provenance.PrintReasons(graph, paths)
+        else:
+            Provenance.PrintSizes(graph, options["top"])
+
+        if options["output"]:
+            Provenance.Export(graph, options["output"])
+
+        Tools.Flush()
+
 if __name__ == '__main__':
     Main.start()
@@ -0,0 +1,142 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import json
+import math
+import os
+import shutil
+import tempfile
+
+import pkg.libs.Variables as var
+
+from pkg.bench.Fixtures import Fixtures
+from pkg.libs.Core import Core
+from pkg.libs.Metrics import Metrics
+from pkg.libs.Tools import Tools
+from pkg.hooks.Addon import Addon
+from pkg.hooks.Firmware import Firmware
+
+# Runs the build phases against generated host trees of increasing size
+# and reports their throughput and how they scale.
+class Bench(object):
+    # Phases that are measured, in the order the build runs them
+    _phases = [
+        "CopyModules",
+        "CopyFirmware",
+        "CopyDependencies",
+        "CreateInitramfs",
+    ]
+
+    # Generates the fixture tree for a scale. 'vScale' is the amount of
+    # modules, the other trees are sized relative to it.
+    @classmethod
+    def Generate(cls, vRoot, vScale, vSeed):
+        fixtures = Fixtures(os.path.join(vRoot, "host"), vSeed)
+
+        firmware = max(1, vScale // 4)
+        modules = fixtures.GenerateModules(vScale, firmware)
+        binaries = fixtures.GenerateBinaries(max(1, vScale // 20), max(2, vScale // 10))
+        fixtures.GenerateFirmware(firmware)
+
+        return fixtures, modules, binaries
+
+    # Points the build at the fixture tree and resets the state of the previous run
+    @classmethod
+    def Setup(cls, vRoot, vFixtures, vModules, vBinaries):
+        var.home = vRoot
+        var.temp = os.path.join(vRoot, "staging")
+        var.kernel = vFixtures.GetKernel()
+        var.modules = vFixtures.GetModulesDirectory()
+        var.lmodules = var.temp + "/" + var.modules
+        var.initrd = "initrd-" + var.kernel
+        var.firmwareDirectory = vFixtures.GetFirmwareDirectory()
+        var.cacheDirectory = os.path.join(vRoot, "cache")
+        var.elfCache = var.cacheDirectory + "/elf.json"
+        var.hashCache = var.cacheDirectory + "/hashes.json"
+        var.provenanceDirectory = var.cacheDirectory + "/provenance"
+        var.useCache = False
+
+        os.makedirs(var.temp)
+
+        Core._binset = set(vBinaries)
+        Core._modset = set()
+        Core._modclosure = []
+        Core._libset = set()
+        Core._plan = []
+
+        # Request every fourth module, the rest come in as dependencies
+        Addon._files = vModules[::4]
+        Addon.Enable()
+
+        Firmware._copy_all = 1
+        Firmware.Enable()
+
+    # Runs the benchmark for every scale and returns the results
+    @classmethod
+    def Run(cls, vScales, vSeed=0, vKeep=False):
+        Metrics.Install(False)
+
+        results = []
+
+        for scale in vScales:
+            root = tempfile.mkdtemp(prefix="bliss-bench-")
+
+            try:
+                fixtures, modules, binaries = cls.Generate(root, scale, vSeed)
+                cls.Setup(root, fixtures, modules, binaries)
+
+                for phase in cls._phases:
+                    Metrics.Run(getattr(Core, phase))
+                    result = dict(Metrics.GetLastPhase())
+                    result["scale"] = scale
+
+                    if phase == "CreateInitramfs":
+                        result["bytes"] = Metrics.GetNote("image")["bytes_in"]
+
+                    results.append(result)
+            finally:
+                if vKeep:
+                    print("Fixture tree kept at: " + root)
+                else:
+                    shutil.rmtree(root, ignore_errors=True)
+
+        return results
+
+    # Prints the throughput of every phase at every scale and the scaling
+    # exponent between consecutive scales (1.0 means linear scaling)
+    @classmethod
+    def Report(cls, vResults, vOutput=None):
+        header = "{0:<18} {1:>7} {2:>9} {3:>8} {4:>12} {5:>10} {6:>8}"
+        row = "{0:<18} {1:>7} {2:>9.3f} {3:>8} {4:>12.1f} {5:>10.1f} {6:>8}"
+
+        # Show the messages of the phases before the table
+        Tools.Flush()
+
+        print("")
+        print(header.format("Phase", "Scale", "Wall (s)", "Files", "Files/s", "MiB/s", "Scaling"))
+
+        for phase in cls._phases:
+            previous = None
+
+            for result in [r for r in vResults if r["phase"] == phase]:
+                wall = max(result["wall"], 0.000001)
+                scaling = "-"
+
+                if previous:
+                    ratio = math.log(result["scale"] / previous["scale"])
+
+                    if ratio:
+                        scaling = "{0:.2f}".format(math.log(wall / max(previous["wall"], 0.000001)) / ratio)
+
+                result["files_per_second"] = result["files"] / wall
+                result["mib_per_second"] = result["bytes"] / wall / (1024 * 1024)
+
+                print(row.format(phase, result["scale"], result["wall"], result["files"],
+                                 result["files_per_second"], result["mib_per_second"], scaling))
+                previous = result
+
+        print("")
+
+        if vOutput:
+            with open(vOutput, "w") as output:
+                json.dump(vResults, output, indent=4, sort_keys=True)
@@ -0,0 +1,242 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import os
+import random
+import struct
+
+# Generates synthetic host trees (kernel modules, ELF binaries and libraries,
+# firmware) that the build phases can run against on any Linux machine,
+# without root and without the real files of a Gentoo host.
+class Fixtures(object):
+    # Kernel version used for the fake modules directory
+    _kernel = "0.0.0-bench"
+
+    # ELF constants used by the generated files
+    _et_rel = 1
+    _et_dyn = 3
+    _em_x86_64 = 62
+
+    def __init__(self, vRoot, vSeed=0):
+        self._root = vRoot
+        self._random = random.Random(vSeed)
+
+    # Returns the kernel version of the generated modules
+    def GetKernel(self):
+        return self._kernel
+
+    # Returns the path of a file inside the fixture tree
+    def GetPath(self, *vParts):
+        return os.path.join(self._root, *vParts)
+
+    # Returns the modules directory of the fixture tree
+    def GetModulesDirectory(self):
+        return self.GetPath("lib", "modules", self._kernel) + "/"
+
+    # Returns the firmware directory of the fixture tree
+    def GetFirmwareDirectory(self):
+        return self.GetPath("lib", "firmware") + "/"
+
+    # Writes a file (creating its directory)
+    def WriteFile(self, vPath, vData, vMode=0o644):
+        os.makedirs(os.path.dirname(vPath), exist_ok=True)
+
+        with open(vPath, "wb") as file:
+            file.write(vData)
+
+        os.chmod(vPath, vMode)
+
+    # Returns data that compresses roughly like machine code does
+    def GetPayload(self, vSize):
+        chunks = []
+        size = 0
+
+        while size < vSize:
+            if self._random.random() < 0.5:
+                chunk = self._random.getrandbits(256 * 8).to_bytes(256, "little")
+            else:
+                chunk = bytes([self._random.getrandbits(8)]) * 256
+
+            chunks.append(chunk)
+            size += len(chunk)
+
+        return b"".join(chunks)[:vSize]
+
+    # Builds a relocatable ELF file (like a kernel module) with the given sections
+    def MakeRelocatable(self, vSections):
+        names = b"\0"
+        offsets = []
+
+        for name, data in vSections + [(".shstrtab", b"")]:
+            offsets.append(len(names))
+            names += name.encode() + b"\0"
+
+        sections = vSections + [(".shstrtab", names)]
+
+        body = b""
+        headers = [struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+        position = 64
+
+        for (name, data), nameOffset in zip(sections, offsets):
+            sectionType = 3 if name == ".shstrtab" else 1
+            headers.append(struct.pack("<IIQQQQIIQQ", nameOffset, sectionType, 0, 0, position, len(data), 0, 0, 1, 0))
+            body += data
+            position += len(data)
+
+        shoff = position
+        header = self.MakeHeader(self._et_rel, 0, 0, shoff, len(headers), len(headers) - 1)
+
+        return header + body + b"".join(headers)
+
+    # Builds an ELF header
+    def MakeHeader(self, vType, vPhoff, vPhnum, vShoff, vShnum, vShstrndx):
+        ident = b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+        return ident + struct.pack("<HHIQQQIHHHHHH", vType, self._em_x86_64, 1, 0, vPhoff, vShoff, 0,
+                                   64, 56, vPhnum, 64, vShnum, vShstrndx)
+
+    # Builds a dynamically linked ELF file with a PT_INTERP (executables only),
+    # a PT_DYNAMIC with DT_NEEDED/DT_SONAME/DT_RUNPATH entries and a payload
+    def MakeDynamic(self, vNeeded, vSoname=None, vInterp=None, vRunpath=None, vPayload=b""):
+        strings = b"\0"
+        dynamic = []
+
+        def AddString(vValue):
+            nonlocal strings
+            offset = len(strings)
+            strings += vValue.encode() + b"\0"
+            return offset
+
+        for needed in vNeeded:
+            dynamic.append((1, AddString(needed)))
+
+        if vSoname:
+            dynamic.append((14, AddString(vSoname)))
+
+        if vRunpath:
+            dynamic.append((29, AddString(vRunpath)))
+
+        phnum = 3 if vInterp else 2
+        position = 64 + 56 * phnum
+
+        interp = (vInterp.encode() + b"\0") if vInterp else b""
+        interpOffset = position
+        position += len(interp)
+
+        strtabOffset = position
+        position += len(strings)
+
+        # Align the dynamic section
+        padding = (8 - position % 8) % 8
+        position += padding
+        dynamicOffset = position
+
+        dynamic.append((5, strtabOffset))
+        dynamic.append((0, 0))
+
+        dynamicData = b"".join(struct.pack("<qQ", tag, value) for tag, value in dynamic)
+        position += len(dynamicData)
+        total = position + len(vPayload)
+
+        # The whole file is mapped at address 0, so virtual addresses equal file offsets
+        headers = []
+
+        if vInterp:
+            headers.append(struct.pack("<IIQQQQQQ", 3, 4, interpOffset, interpOffset, interpOffset, len(interp), len(interp), 1))
+
+        headers.append(struct.pack("<IIQQQQQQ", 1, 5, 0, 0, 0, total, total, 0x1000))
+        headers.append(struct.pack("<IIQQQQQQ", 2, 6, dynamicOffset, dynamicOffset, dynamicOffset,
+                                   len(dynamicData), len(dynamicData), 8))
+
+        header = self.MakeHeader(self._et_dyn, 64, phnum, 0, 0, 0)
+
+        return header + b"".join(headers) + interp + strings + bytes(padding) + dynamicData + vPayload
+
+    # Generates a modules directory with 'vCount' modules. Every module
+    # depends on a few of the modules generated before it, which gives a
+    # dependency graph that is deep in some places and wide in others.
+    # A quarter of the modules request a firmware file.
+    def GenerateModules(self, vCount, vFirmwareCount=0):
+        directory = self.GetModulesDirectory()
+        deps = {}
+        paths = {}
+
+        for i in range(vCount):
+            name = "bench_mod{0:05d}".format(i)
+            paths[name] = "kernel/drivers/bench/{0}/{1}.ko".format(i % 16, name)
+
+            direct = set()
+
+            # Modules only depend on modules of their own subsystem (groups of
+            # 50), like real drivers do, which keeps the closures bounded
+            first = i - i % 50
+
+            if i > first:
+                for j in range(self._random.randint(0, 3)):
+                    direct.add("bench_mod{0:05d}".format(self._random.randint(first, i - 1)))
+
+            # modules.dep lists the full closure of every module
+            closure = set(direct)
+
+            for dep in direct:
+                closure |= deps[dep]
+
+            deps[name] = closure
+
+            modinfo = ["license=GPL", "name=" + name, "depends=" + ",".join(sorted(direct)), "alias=bench:" + name]
+
+            if vFirmwareCount and self._random.random() < 0.25:
+                modinfo.append("firmware=bench/fw{0:05d}.bin".format(self._random.randint(0, vFirmwareCount - 1)))
+
+            sections = [
+                (".text", self.GetPayload(self._random.randint(8, 96) * 1024)),
+                (".modinfo", "\0".join(modinfo).encode() + b"\0"),
+            ]
+
+            self.WriteFile(os.path.join(directory, paths[name]), self.MakeRelocatable(sections))
+
+        names = sorted(paths)
+
+        lines = []
+
+        for name in names:
+            closure = sorted(deps[name], reverse=True)
+            lines.append(paths[name] + ":" + "".join(" " + paths[dep] for dep in closure))
+
+        self.WriteFile(directory + "modules.dep", ("\n".join(lines) + "\n").encode())
+        self.WriteFile(directory + "modules.order", ("\n".join(paths[n] for n in names) + "\n").encode())
+        self.WriteFile(directory + "modules.alias", "".join("alias bench:{0} {0}\n".format(n) for n in names).encode())
+        self.WriteFile(directory + "modules.softdep", b"")
+        self.WriteFile(directory + "modules.builtin", b"")
+
+        return names
+
+    # Generates libraries that need each other in chains and binaries that
+    # need a few of them. Returns the paths of the binaries.
+    def GenerateBinaries(self, vBinaries, vLibraries):
+        interp = self.GetPath("lib64", "ld-bench.so.1")
+        self.WriteFile(interp, self.MakeDynamic([], "ld-bench.so.1", vPayload=self.GetPayload(64 * 1024)), 0o755)
+
+        libraries = ["libbench{0:04d}.so.1".format(i) for i in range(vLibraries)]
+
+        for i, library in enumerate(libraries):
+            needed = libraries[i + 1:i + 1 + self._random.randint(0, 2)]
+            data = self.MakeDynamic(needed, library, vRunpath="$ORIGIN", vPayload=self.GetPayload(self._random.randint(16, 256) * 1024))
+            self.WriteFile(self.GetPath("lib64", library), data, 0o755)
+
+        binaries = []
+
+        for i in range(vBinaries):
+            path = self.GetPath("bin", "bench{0:04d}".format(i))
+            needed = self._random.sample(libraries, min(len(libraries), self._random.randint(1, 4)))
+            data = self.MakeDynamic(needed, vInterp=interp, vRunpath="$ORIGIN/../lib64", vPayload=self.GetPayload(self._random.randint(32, 512) * 1024))
+            self.WriteFile(path, data, 0o755)
+            binaries.append(path)
+
+        return binaries
+
+    # Generates 'vCount' firmware files
+    def GenerateFirmware(self, vCount):
+        directory = self.GetFirmwareDirectory()
+
+        for i in range(vCount):
+            self.WriteFile(directory + "bench/fw{0:05d}.bin".format(i), self.GetPayload(self._random.randint(4, 256) * 1024))
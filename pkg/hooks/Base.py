@@ -10,24 +10,34 @@ class Base(Hook):
     def GetKmodLinks(cls):
         return cls._kmod_links
 
-    _files = [
-        # sys-apps/busybox
-        "/bin/busybox",
-
-        # sys-apps/kmod
-        Tools.GetProgramPath("kmod"),
-
-        # app-shells/bash
-        "/bin/bash",
-        "/etc/bash/bashrc",
-        "/etc/DIR_COLORS",
-        "/etc/profile",
-
-        # sys-apps/grep
-        "/bin/egrep",
-        "/bin/fgrep",
-        "/bin/grep",
-    ]
+    # Required Files (Looked up the first time they are needed so that
+    # importing this hook doesn't fail on systems without kmod)
+    _files = None
+
+    # Returns the list
+    @classmethod
+    def GetFiles(cls):
+        if cls._files is None:
+            cls._files = [
+                # sys-apps/busybox
+                "/bin/busybox",
+
+                # sys-apps/kmod
+                Tools.GetProgramPath("kmod"),
+
+                # app-shells/bash
+                "/bin/bash",
+                "/etc/bash/bashrc",
+                "/etc/DIR_COLORS",
+                "/etc/profile",
+
+                # sys-apps/grep
+                "/bin/egrep",
+                "/bin/fgrep",
+                "/bin/grep",
+            ]
+
+        return cls._files
 
     _kmod_links = [
         "depmod",
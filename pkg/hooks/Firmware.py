@@ -12,6 +12,11 @@ class Firmware(Hook):
     # to reduce the initramfs size.
     _copy_all = 0
 
+    # If enabled, only the firmware that the included modules request (the
+    # firmware= entries in their modinfo) is copied into the initramfs, in
+    # addition to the firmware files listed below.
+    _auto = 0
+
     # A list of firmware files to include in the initramfs
     _files = [
         # Add your firmware files below
@@ -23,3 +28,18 @@ class Firmware(Hook):
     @classmethod
     def IsCopyAllEnabled(cls):
         return cls._copy_all
+
+    # Enables copying all the firmware
+    @classmethod
+    def EnableCopyAll(cls):
+        cls._copy_all = 1
+
+    # Gets the auto selection value
+    @classmethod
+    def IsAutoEnabled(cls):
+        return cls._auto
+
+    # Enables selecting the firmware from the included modules
+    @classmethod
+    def EnableAuto(cls):
+        cls._auto = 1
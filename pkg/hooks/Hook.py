@@ -39,7 +39,7 @@ class Hook(object):
     @classmethod
     def PrintFiles(cls):
         for file in cls.GetFiles():
-            print("File: " + file)
+            Tools.Print("File: " + file)
 
     # Returns the list
     @classmethod
@@ -8,9 +8,18 @@ class Udev(Hook):
     # Enable udev support?
     _use = 1
 
-    # Required Files
-    _files = [
-        # udev
-        Tools.GetUdevPath(),
-        Tools.GetProgramPath("udevadm"),
-    ]
+    # Required Files (Looked up the first time they are needed so that
+    # importing this hook doesn't fail on systems without udev)
+    _files = None
+
+    # Returns the list
+    @classmethod
+    def GetFiles(cls):
+        if cls._files is None:
+            cls._files = [
+                # udev
+                Tools.GetUdevPath(),
+                Tools.GetProgramPath("udevadm"),
+            ]
+
+        return cls._files
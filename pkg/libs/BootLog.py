@@ -0,0 +1,171 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import json
+import math
+
+from pkg.libs.Tools import Tools
+
+# Reads the boot logs that init writes (/run/bliss-boot.log, appended to
+# /var/log/bliss-boot.log in the rootfs on every boot) and reports how long
+# every stage takes across boots and which stages got slower.
+class BootLog(object):
+    # Percentiles shown for every stage
+    _percentiles = [50, 90, 99]
+
+    # Parses boot logs and returns a list of boots, oldest first. Each boot
+    # is a dictionary with its id, version and stage -> seconds.
+    @classmethod
+    def Parse(cls, vFiles):
+        boots = []
+
+        for file in vFiles:
+            try:
+                with open(file, "r") as log:
+                    lines = log.read().splitlines()
+            except OSError:
+                Tools.Fail("Unable to read the boot log: " + file)
+
+            boot = None
+
+            for line in lines:
+                fields = line.split()
+
+                if not fields:
+                    continue
+
+                # Every boot starts with a '# bliss-boot <version> <boot id>' line
+                if fields[0] == "#":
+                    if len(fields) >= 2 and fields[1] == "bliss-boot":
+                        boot = {
+                            "version": fields[2] if len(fields) > 2 else "",
+                            "id": fields[3] if len(fields) > 3 else "",
+                            "stages": {},
+                        }
+                        boots.append(boot)
+                    continue
+
+                if len(fields) < 3:
+                    continue
+
+                # Logs without a header are a single boot
+                if boot is None:
+                    boot = {"version": "", "id": file, "stages": {}}
+                    boots.append(boot)
+
+                try:
+                    seconds = float(fields[2]) - float(fields[1])
+                except ValueError:
+                    continue
+
+                # A stage can run more than once (i.e udev_settle)
+                boot["stages"][fields[0]] = boot["stages"].get(fields[0], 0) + seconds
+
+        return boots
+
+    # Returns a percentile of a list of values (linear interpolation)
+    @classmethod
+    def GetPercentile(cls, vValues, vPercentile):
+        values = sorted(vValues)
+
+        if not values:
+            return 0.0
+
+        position = (len(values) - 1) * vPercentile / 100.0
+        low = math.floor(position)
+        high = math.ceil(position)
+
+        return values[low] + (values[high] - values[low]) * (position - low)
+
+    # Returns the names of the stages, in the order they first appear
+    @classmethod
+    def GetStages(cls, vBoots):
+        stages = []
+
+        for boot in vBoots:
+            for stage in boot["stages"]:
+                if stage not in stages:
+                    stages.append(stage)
+
+        return stages
+
+    # Returns the statistics of every stage
+    @classmethod
+    def GetStatistics(cls, vBoots):
+        statistics = []
+
+        for stage in cls.GetStages(vBoots):
+            values = [boot["stages"][stage] for boot in vBoots if stage in boot["stages"]]
+            entry = {"stage": stage, "boots": len(values), "mean": sum(values) / len(values)}
+
+            for percentile in cls._percentiles:
+                entry["p" + str(percentile)] = cls.GetPercentile(values, percentile)
+
+            statistics.append(entry)
+
+        return statistics
+
+    # Compares the most recent boots against the ones before them and returns
+    # the stages whose median got slower by more than the threshold (a ratio)
+    # and by more than the minimum amount of seconds
+    @classmethod
+    def GetRegressions(cls, vBoots, vRecent, vThreshold, vMinimum):
+        if len(vBoots) <= vRecent:
+            return []
+
+        baseline = vBoots[:-vRecent]
+        recent = vBoots[-vRecent:]
+        regressions = []
+
+        for stage in cls.GetStages(recent):
+            before = [boot["stages"][stage] for boot in baseline if stage in boot["stages"]]
+            after = [boot["stages"][stage] for boot in recent if stage in boot["stages"]]
+
+            if not before or not after:
+                continue
+
+            old = cls.GetPercentile(before, 50)
+            new = cls.GetPercentile(after, 50)
+
+            if new - old >= vMinimum and new > old * vThreshold:
+                regressions.append({"stage": stage, "before": old, "after": new, "change": new - old})
+
+        return regressions
+
+    # Parses the logs and prints the report
+    @classmethod
+    def Analyze(cls, vFiles, vRecent=1, vThreshold=1.25, vMinimum=0.05, vOutput=None):
+        boots = cls.Parse(vFiles)
+
+        if not boots:
+            Tools.Fail("No boots were found in the boot logs!")
+
+        statistics = cls.GetStatistics(boots)
+        regressions = cls.GetRegressions(boots, vRecent, vThreshold, vMinimum)
+
+        header = "{0:<16} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9}"
+        row = "{0:<16} {1:>6} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}"
+
+        Tools.Info("Analyzed " + str(len(boots)) + " boots")
+        Tools.Print("")
+        Tools.Print(header.format("Stage", "Boots", "Mean (s)", "p50 (s)", "p90 (s)", "p99 (s)"))
+
+        for entry in statistics:
+            Tools.Print(row.format(entry["stage"], entry["boots"], entry["mean"], entry["p50"], entry["p90"], entry["p99"]))
+
+        Tools.Print("")
+
+        if regressions:
+            for regression in regressions:
+                Tools.Warn("{0} got slower: {1:.3f}s -> {2:.3f}s (+{3:.3f}s)".format(
+                    regression["stage"], regression["before"], regression["after"], regression["change"]))
+        elif len(boots) > vRecent:
+            Tools.Flag("No stage got slower in the last " + str(vRecent) + " boot(s)")
+
+        if vOutput:
+            with open(vOutput, "w") as output:
+                json.dump({"boots": len(boots), "stages": statistics, "regressions": regressions}, output, indent=4, sort_keys=True)
+
+        Tools.Flush()
+
+        return regressions
@@ -0,0 +1,103 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import re
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Tools import Tools
+from pkg.libs.ZpoolCache import ZpoolCache
+from pkg.hooks.Zfs import Zfs
+from pkg.hooks.Luks import Luks
+from pkg.hooks.Addon import Addon
+from pkg.hooks.Udev import Udev
+
+# The settings of a build that end up in the generated files of the
+# initramfs (i.e the 'init' script). Every value is checked for its type
+# when it is set and converted to the text that goes into the files.
+class BuildConfig(object):
+    # Setting name: (placeholder in the templates, type)
+    _settings = {
+        "useZfs": ("USE_ZFS", bool),
+        "useLuks": ("USE_LUKS", bool),
+        "useAddon": ("USE_ADDON", bool),
+        "useUdev": ("USE_UDEV", bool),
+        "version": ("VERSION", str),
+        "modules": ("MODULES", list),
+        "modulePlan": ("MODULE_PLAN", str),
+        "zfsDevices": ("ZFS_DEVICES", list),
+        "encDrives": ("ENC_DRIVES", list),
+        "encJobs": ("ENC_JOBS", int),
+    }
+
+    # Characters that are allowed in the values that go into a quoted shell string
+    _safe = re.compile(r"^[A-Za-z0-9_.,:+=/@-]*$")
+
+    def __init__(self, **vSettings):
+        self._values = {}
+
+        for name, (placeholder, kind) in self._settings.items():
+            if name not in vSettings:
+                Tools.Fail("The build setting '" + name + "' is missing!")
+
+            self.Set(name, vSettings[name])
+
+        for name in vSettings:
+            if name not in self._settings:
+                Tools.Fail("Unknown build setting: " + name)
+
+    # Returns the configuration of the current build
+    @classmethod
+    def FromBuild(cls):
+        return cls(
+            useZfs=bool(Zfs.IsEnabled()),
+            useLuks=bool(Luks.IsEnabled()),
+            useAddon=bool(Addon.IsEnabled()),
+            useUdev=bool(Udev.IsEnabled()),
+            version=var.version,
+            modules=list(Addon.GetFiles()) if Addon.IsEnabled() else [],
+            modulePlan=var.modulePlan,
+            zfsDevices=[device for device in ZpoolCache.GetHints() if cls.IsSafe(device)] if Zfs.IsEnabled() else [],
+            encDrives=list(var.encDrives) if Luks.IsEnabled() else [],
+            encJobs=var.encJobs,
+        )
+
+    # Checks to see if a value can go into a quoted shell string
+    @classmethod
+    def IsSafe(cls, vValue):
+        return bool(cls._safe.match(vValue))
+
+    # Sets the value of a setting after checking its type
+    def Set(self, vName, vValue):
+        placeholder, kind = self._settings[vName]
+
+        if not isinstance(vValue, kind) or (kind == int and isinstance(vValue, bool)):
+            Tools.Fail("The build setting '" + vName + "' must be a " + kind.__name__ + "!")
+
+        for value in (vValue if kind == list else [vValue]):
+            if not isinstance(value, (str, bool, int)) or not self.IsSafe(str(value)):
+                Tools.Fail("The build setting '" + vName + "' has an invalid value: " + str(value))
+
+        self._values[vName] = vValue
+
+    # Returns the value of a setting
+    def Get(self, vName):
+        return self._values[vName]
+
+    # Returns the text of every placeholder
+    def GetPlaceholders(self):
+        placeholders = {}
+
+        for name, (placeholder, kind) in self._settings.items():
+            value = self._values[name]
+
+            if kind == bool:
+                placeholders[placeholder] = "1" if value else "0"
+            elif kind == list:
+                placeholders[placeholder] = " ".join(value)
+            elif kind == int:
+                placeholders[placeholder] = str(value)
+            else:
+                placeholders[placeholder] = value
+
+        return placeholders
@@ -0,0 +1,42 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import random
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Core import Core
+
+# The state of the build of one initramfs: the kernel, its modules directory,
+# the temporary directory the files are gathered in and the name of the image.
+# Every build has its own context, so the initramfs of several kernels can be
+# built at the same time (each one in its own process). Applying a context
+# also resets the state that the previous build in the same process left
+# behind.
+class BuildContext(object):
+    def __init__(self, vKernel):
+        rstring = str(random.randint(100000000, 999999999))
+
+        self.kernel = vKernel
+        self.modules = "/lib/modules/" + vKernel + "/"
+        self.temp = "/tmp/" + rstring
+        self.tlink = var.home + "/" + rstring
+        self.lmodules = self.temp + "/" + self.modules
+        self.initrd = "initrd-" + vKernel
+
+    # Makes this the build that the rest of the application works on
+    def Apply(self):
+        var.kernel = self.kernel
+        var.modules = self.modules
+        var.lmodules = self.lmodules
+        var.initrd = self.initrd
+        var.temp = self.temp
+        var.tlink = self.tlink
+
+        var.lbin = self.temp + var.bin
+        var.lsbin = self.temp + var.sbin
+        var.llib = self.temp + var.lib
+        var.llib64 = self.temp + var.lib64
+        var.letc = self.temp + var.etc
+
+        Core.ResetBuild()
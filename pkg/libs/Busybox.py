@@ -0,0 +1,75 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import re
+
+from subprocess import check_output
+from subprocess import CalledProcessError
+
+from pkg.libs.Tools import Tools
+from pkg.libs.Cache import Cache
+
+# Finds the applets that a busybox binary provides without installing them.
+# The list is read from the applet table inside the binary (or from
+# 'busybox --list' if the table can't be found) and cached per build of
+# busybox, so the binary doesn't need to run inside the initramfs.
+class Busybox(object):
+    # A NUL terminated applet name as it is stored in the applet table
+    _name = re.compile(rb"[a-z0-9\[][a-z0-9_.\-\[\]]*\0")
+
+    # The smallest table that is accepted (a real busybox has hundreds of applets)
+    _min_applets = 20
+
+    # Returns the applets of a busybox binary
+    @classmethod
+    def GetApplets(cls, vPath):
+        key = Cache.GetKey(["applets", Cache.HashFile(vPath)])
+        applets = Cache.GetValue(key)
+
+        if applets is None:
+            with open(vPath, "rb") as busybox:
+                applets = cls.ParseApplets(busybox.read())
+
+            if not applets:
+                applets = cls.ListApplets(vPath)
+
+            Cache.PutValue(key, applets)
+
+        return applets
+
+    # Returns the names in the applet table of the binary: the longest run
+    # of NUL terminated names that is sorted (the table is sorted so that
+    # busybox can look up the applets with a binary search).
+    @classmethod
+    def ParseApplets(cls, vData):
+        best = []
+        run = []
+        position = None
+
+        for match in cls._name.finditer(vData):
+            name = match.group()[:-1].decode()
+
+            if match.start() == position and (not run or name > run[-1]):
+                run.append(name)
+            else:
+                run = [name]
+
+            position = match.end()
+
+            if len(run) > len(best):
+                best = run
+
+        if len(best) < cls._min_applets:
+            return []
+
+        return list(best)
+
+    # Returns the applets that the binary lists when it runs
+    @classmethod
+    def ListApplets(cls, vPath):
+        try:
+            output = check_output([vPath, "--list"], universal_newlines=True)
+        except (OSError, CalledProcessError):
+            Tools.Fail("Unable to get the list of applets from " + vPath + "!")
+
+        return sorted(set(output.split()))
@@ -0,0 +1,267 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import hashlib
+import json
+import os
+import shutil
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Tools import Tools
+
+# A persistent, content addressed build cache. Objects (finished images,
+# compressed modules, etc) are stored under a key that is derived from the
+# content of everything that went into them, so they can be reused by any
+# later build that has the same inputs.
+class Cache(object):
+    # Content hashes of files, keyed by path: [file key, digest]
+    _hashes = None
+
+    # Set to true when new hashes were calculated and need to be written
+    _dirty = False
+
+    # The hashes that the shared phases calculated (every build starts from them)
+    _shared = None
+
+    # Amount of finished images that are kept in the cache
+    _max_images = 5
+
+    # Amount of compressed layers (of layered images) that are kept in the cache
+    _max_layers = 15
+
+    # Checks to see if the cache is enabled
+    @classmethod
+    def IsEnabled(cls):
+        return var.useCache
+
+    # Returns the path of an object in the cache
+    @classmethod
+    def GetObjectPath(cls, vKey, vKind="objects"):
+        return os.path.join(var.cacheDirectory, vKind, vKey[:2], vKey[2:])
+
+    # Returns a key for a list of values (strings or other keys)
+    @classmethod
+    def GetKey(cls, vValues):
+        digest = hashlib.sha256()
+
+        for value in vValues:
+            digest.update(str(value).encode())
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    # Loads the content hashes that were calculated by previous builds
+    @classmethod
+    def LoadHashes(cls):
+        try:
+            with open(var.hashCache, "r") as hashes:
+                cls._hashes = json.load(hashes)
+        except (OSError, ValueError):
+            cls._hashes = {}
+
+    # Remembers the hashes calculated so far as the ones every build starts from
+    @classmethod
+    def MarkShared(cls):
+        cls._shared = dict(cls._hashes) if cls._hashes is not None else None
+
+    # Forgets the hashes that a previous build in this process calculated
+    @classmethod
+    def ResetBuild(cls):
+        cls._hashes = dict(cls._shared) if cls._shared is not None else None
+
+    # Writes the content hashes back to disk
+    @classmethod
+    def SaveHashes(cls):
+        if not cls._dirty or not cls.IsEnabled():
+            return
+
+        try:
+            os.makedirs(var.cacheDirectory, exist_ok=True)
+
+            tempHashes = var.hashCache + "." + str(os.getpid())
+
+            with open(tempHashes, "w") as hashes:
+                json.dump(cls._hashes, hashes)
+
+            os.replace(tempHashes, var.hashCache)
+            cls._dirty = False
+        except OSError:
+            Tools.Warn("Unable to write the hash cache to " + var.hashCache)
+
+    # Returns the sha256 of a file's content. Files that didn't change
+    # since the last time they were hashed aren't read again.
+    @classmethod
+    def HashFile(cls, vFile):
+        if cls._hashes is None:
+            cls.LoadHashes()
+
+        key = Tools.GetFileKey(vFile)
+        cached = cls._hashes.get(vFile)
+
+        if cached and cached[0] == key:
+            return cached[1]
+
+        digest = cls.HashContent(vFile)
+
+        cls._hashes[vFile] = [key, digest]
+        cls._dirty = True
+
+        return digest
+
+    # Returns the sha256 of a file's content without remembering it (for
+    # files that only exist during a build)
+    @classmethod
+    def HashContent(cls, vFile):
+        digest = hashlib.sha256()
+
+        with open(vFile, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    # Returns a key for a path on disk. Directories are hashed recursively,
+    # symlinks by their target and what it resolves to (the build copies the
+    # content, i.e of a library's soname link) and missing paths by their name.
+    @classmethod
+    def HashPath(cls, vPath):
+        if os.path.islink(vPath):
+            return cls.GetKey(["link", vPath, os.readlink(vPath), cls.HashPath(os.path.realpath(vPath))])
+        elif os.path.isdir(vPath):
+            values = ["dir", vPath]
+
+            # Symlinked subdirectories are followed like the copy does
+            for root, dirs, files in os.walk(vPath, followlinks=True):
+                dirs.sort()
+
+                for file in sorted(files):
+                    values.append(cls.HashPath(os.path.join(root, file)))
+
+            return cls.GetKey(values)
+        elif os.path.isfile(vPath):
+            return cls.GetKey(["file", vPath, cls.HashFile(vPath), os.stat(vPath).st_mode])
+
+        return cls.GetKey(["missing", vPath])
+
+    # Returns the path of a cached object or None if it isn't cached
+    @classmethod
+    def Get(cls, vKey, vKind="objects"):
+        if not cls.IsEnabled():
+            return None
+
+        path = cls.GetObjectPath(vKey, vKind)
+
+        if os.path.isfile(path):
+            return path
+
+        return None
+
+    # Stores a copy of a file in the cache under the given key
+    @classmethod
+    def Put(cls, vKey, vFile, vKind="objects"):
+        if not cls.IsEnabled():
+            return
+
+        path = cls.GetObjectPath(vKey, vKind)
+        tempPath = path + "." + str(os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(vFile, tempPath)
+            os.replace(tempPath, path)
+        except OSError:
+            Tools.Warn("Unable to store " + vFile + " in the cache")
+
+    # Returns a value (anything that JSON can hold) that was stored in the
+    # cache, or None if it isn't cached
+    @classmethod
+    def GetValue(cls, vKey, vKind="values"):
+        path = cls.Get(vKey, vKind)
+
+        if not path:
+            return None
+
+        try:
+            with open(path, "r") as value:
+                return json.load(value)
+        except (OSError, ValueError):
+            return None
+
+    # Stores a value in the cache under the given key
+    @classmethod
+    def PutValue(cls, vKey, vValue, vKind="values"):
+        if not cls.IsEnabled():
+            return
+
+        path = cls.GetObjectPath(vKey, vKind)
+        tempPath = path + "." + str(os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(tempPath, "w") as value:
+                json.dump(vValue, value)
+
+            os.replace(tempPath, path)
+        except OSError:
+            Tools.Warn("Unable to store a value in the cache")
+
+    # Returns the path of a cached layer of a layered initramfs
+    @classmethod
+    def GetLayer(cls, vKey):
+        path = cls.Get(vKey, "layers")
+
+        # Mark the layer as recently used so it isn't pruned
+        if path:
+            os.utime(path)
+
+        return path
+
+    # Stores a compressed layer and removes the layers that weren't used lately
+    @classmethod
+    def PutLayer(cls, vKey, vLayer):
+        if not cls.IsEnabled():
+            return
+
+        cls.Put(vKey, vLayer, "layers")
+        cls.Prune("layers", cls._max_layers)
+
+    # Removes the oldest objects of a kind, keeping 'vKeep' of them. Other
+    # builds might be adding and removing objects at the same time, and the
+    # files that are still being written (<key>.<pid>) are left alone.
+    @classmethod
+    def Prune(cls, vKind, vKeep):
+        objects = []
+
+        for root, dirs, files in os.walk(os.path.join(var.cacheDirectory, vKind)):
+            for file in files:
+                if "." in file:
+                    continue
+
+                path = os.path.join(root, file)
+
+                try:
+                    objects.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+
+        for mtime, path in sorted(objects, reverse=True)[vKeep:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # Returns the cached image for a build fingerprint
+    @classmethod
+    def GetImage(cls, vFingerprint):
+        return cls.Get(vFingerprint, "images")
+
+    # Stores a finished image and removes the oldest images from the cache
+    @classmethod
+    def PutImage(cls, vFingerprint, vImage):
+        if not cls.IsEnabled():
+            return
+
+        cls.Put(vFingerprint, vImage, "images")
+        cls.Prune("images", cls._max_images)
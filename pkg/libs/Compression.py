@@ -0,0 +1,469 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import bz2
+import lzma
+import os
+import struct
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pkg.libs.Tools import Tools
+
+# The zstd and lz4 codecs are optional and only available when the
+# corresponding python libraries are installed.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# Base class for all the compressors. A compressor is a writable stream
+# that compresses everything written into it into the output stream.
+class Compressor(object):
+    def __init__(self, vStream, vLevel, vThreads):
+        self._stream = vStream
+        self._level = vLevel
+        self._threads = vThreads
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._start = time.time()
+        self._elapsed = 0
+
+    # Writes compressed data to the output stream
+    def Output(self, vData):
+        if vData:
+            self._stream.write(vData)
+            self._bytes_out += len(vData)
+
+    def write(self, vData):
+        self._bytes_in += len(vData)
+        self.Compress(vData)
+        return len(vData)
+
+    def close(self):
+        self.Finish()
+        self._elapsed = time.time() - self._start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, vType, vValue, vTraceback):
+        if vType is None:
+            self.close()
+
+    # Returns the amount of uncompressed bytes that were written
+    def GetBytesIn(self):
+        return self._bytes_in
+
+    # Returns the amount of compressed bytes that were produced
+    def GetBytesOut(self):
+        return self._bytes_out
+
+    # Returns the amount of seconds that compression took
+    def GetElapsed(self):
+        return self._elapsed
+
+    def Compress(self, vData):
+        self.Output(vData)
+
+    def Finish(self):
+        pass
+
+# Splits the input into blocks and compresses them on a pool of threads
+# (with the CompressBlock method of the compressor that uses it). The
+# compressed blocks are written out in their original order.
+class BlockCompressor(Compressor):
+    # Amount of uncompressed data per block
+    _block_size = 1024 * 1024
+
+    def __init__(self, vStream, vLevel, vThreads):
+        super(BlockCompressor, self).__init__(vStream, vLevel, vThreads)
+        self._buffer = bytearray()
+        self._pending = []
+        self._pool = ThreadPoolExecutor(max_workers=vThreads)
+
+    def Compress(self, vData):
+        self._buffer += vData
+
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self.Submit(block, False)
+
+    # Queues a block for compression. Only a few blocks per thread are kept
+    # in flight so that memory usage stays bounded.
+    def Submit(self, vBlock, vLast):
+        self._pending.append(self._pool.submit(self.CompressBlock, vBlock, vLast, self.GetBlockContext(vBlock)))
+
+        while len(self._pending) > self._threads * 2:
+            self.Output(self._pending.pop(0).result())
+
+    def Finish(self):
+        self.Submit(bytes(self._buffer), True)
+        self._buffer = bytearray()
+
+        for future in self._pending:
+            self.Output(future.result())
+
+        self._pending = []
+        self._pool.shutdown()
+
+    # The pool is shut down even if writing the image failed, and the blocks
+    # that didn't start yet are dropped
+    def __exit__(self, vType, vValue, vTraceback):
+        try:
+            super(BlockCompressor, self).__exit__(vType, vValue, vTraceback)
+        finally:
+            for future in self._pending:
+                future.cancel()
+
+            self._pending = []
+            self._pool.shutdown()
+
+    # Returns any state that compressing this block needs from the previous blocks
+    def GetBlockContext(self, vBlock):
+        return None
+
+# Single threaded gzip
+class GzipCompressor(Compressor):
+    def __init__(self, vStream, vLevel, vThreads):
+        super(GzipCompressor, self).__init__(vStream, vLevel, vThreads)
+        self._compressor = zlib.compressobj(vLevel, zlib.DEFLATED, 31)
+
+    def Compress(self, vData):
+        self.Output(self._compressor.compress(vData))
+
+    def Finish(self):
+        self.Output(self._compressor.flush())
+
+# Multi-threaded gzip (The same approach as pigz). Every block is compressed
+# into a raw deflate stream that is primed with the last 32K of the previous
+# block and ends on a byte boundary, so the blocks can simply be concatenated
+# into a single gzip member that any gzip decoder (including the kernel's) reads.
+class ParallelGzipCompressor(BlockCompressor):
+    # Size of the deflate window
+    _window = 32768
+
+    def __init__(self, vStream, vLevel, vThreads):
+        super(ParallelGzipCompressor, self).__init__(vStream, vLevel, vThreads)
+        self._crc = 0
+        self._dictionary = b""
+
+        # Header: magic, deflate, no flags, no mtime, no extra flags, unix
+        self.Output(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03")
+
+    def GetBlockContext(self, vBlock):
+        self._crc = zlib.crc32(vBlock, self._crc)
+
+        dictionary = self._dictionary
+        self._dictionary = (dictionary + vBlock)[-self._window:]
+
+        return dictionary
+
+    def CompressBlock(self, vBlock, vLast, vContext):
+        if vContext:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15, zdict=vContext)
+        else:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+
+        flush = zlib.Z_FINISH if vLast else zlib.Z_SYNC_FLUSH
+
+        return compressor.compress(vBlock) + compressor.flush(flush)
+
+    def Finish(self):
+        super(ParallelGzipCompressor, self).Finish()
+        self.Output(struct.pack("<II", self._crc & 0xFFFFFFFF, self._bytes_in & 0xFFFFFFFF))
+
+# xz (The kernel only supports the CRC32 integrity check)
+class XzCompressor(Compressor):
+    def __init__(self, vStream, vLevel, vThreads):
+        super(XzCompressor, self).__init__(vStream, vLevel, vThreads)
+        filters = [{"id": lzma.FILTER_LZMA2, "preset": vLevel}]
+        self._compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, filters=filters)
+
+    def Compress(self, vData):
+        self.Output(self._compressor.compress(vData))
+
+    def Finish(self):
+        self.Output(self._compressor.flush())
+
+# zstd (The library does the multi-threading itself and still produces a single frame)
+class ZstdCompressor(Compressor):
+    def __init__(self, vStream, vLevel, vThreads):
+        super(ZstdCompressor, self).__init__(vStream, vLevel, vThreads)
+        threads = vThreads if vThreads > 1 else 0
+        self._compressor = zstandard.ZstdCompressor(level=vLevel, threads=threads).compressobj()
+
+    def Compress(self, vData):
+        self.Output(self._compressor.compress(vData))
+
+    def Finish(self):
+        self.Output(self._compressor.flush())
+
+# lz4 using the legacy format, which is the only lz4 format the kernel can decompress
+class Lz4Compressor(BlockCompressor):
+    # The legacy format uses 8 MiB blocks
+    _block_size = 8 * 1024 * 1024
+
+    def __init__(self, vStream, vLevel, vThreads):
+        super(Lz4Compressor, self).__init__(vStream, vLevel, vThreads)
+        self.Output(struct.pack("<I", 0x184C2102))
+
+    def CompressBlock(self, vBlock, vLast, vContext):
+        if not vBlock:
+            return b""
+
+        data = lz4.block.compress(vBlock, mode="high_compression", compression=self._level, store_size=False)
+        return struct.pack("<I", len(data)) + data
+
+# Decompresses the legacy lz4 format with the same interface as the
+# decompressors of the standard library (decompress, eof and unused_data)
+class Lz4LegacyDecompressor(object):
+    _magic = 0x184C2102
+    _block_size = 8 * 1024 * 1024
+
+    # Largest compressed size of a block. Anything bigger ends the stream
+    # (that's how the kernel finds the end of a legacy lz4 stream too).
+    _max_block = _block_size + _block_size // 255 + 16
+
+    def __init__(self):
+        self.eof = False
+        self.unused_data = b""
+        self._buffer = b""
+
+    def decompress(self, vData):
+        self._buffer += vData
+        output = []
+
+        while not self.eof and len(self._buffer) >= 4:
+            size = struct.unpack_from("<I", self._buffer)[0]
+
+            # Another stream in the same format just continues this one
+            if size == self._magic:
+                self._buffer = self._buffer[4:]
+                continue
+
+            if size == 0 or size > self._max_block:
+                self.eof = True
+                self.unused_data = self._buffer
+                self._buffer = b""
+                break
+
+            if len(self._buffer) < 4 + size:
+                break
+
+            output.append(lz4.block.decompress(self._buffer[4:4 + size], uncompressed_size=self._block_size))
+            self._buffer = self._buffer[4 + size:]
+
+        return b"".join(output)
+
+# Selects and creates the compressor used for the final image
+class Compression(object):
+    # Supported codecs and their default levels
+    _levels = {
+        "gzip": 9,
+        "xz": 6,
+        "zstd": 19,
+        "lz4": 9,
+        "none": 0,
+    }
+
+    # Valid levels for each codec
+    _ranges = {
+        "gzip": (1, 9),
+        "xz": (0, 9),
+        "zstd": (1, 22),
+        "lz4": (1, 12),
+        "none": (0, 0),
+    }
+
+    # Magic numbers of the formats that an initramfs segment can be in
+    _magics = [
+        (b"070701", "none"),
+        (b"070702", "none"),
+        (b"\x1f\x8b", "gzip"),
+        (b"\xfd7zXZ\x00", "xz"),
+        (b"\x28\xb5\x2f\xfd", "zstd"),
+        (b"\x02\x21\x4c\x18", "lz4"),
+        (b"BZh", "bzip2"),
+        (b"\x5d\x00\x00", "lzma"),
+    ]
+
+    # Errors raised by the decompressors on corrupted data
+    _decompress_errors = tuple(error for error in (
+        zlib.error,
+        lzma.LZMAError,
+        OSError,
+        zstandard.ZstdError if zstandard else None,
+        lz4.block.LZ4BlockError if lz4 else None,
+    ) if error)
+
+    # Formats that kernel modules can be compressed with and the
+    # feature that kmod must have been built with to load them.
+    _module_formats = {
+        "gz": "ZLIB",
+        "xz": "XZ",
+        "zst": "ZSTD",
+        "none": None,
+    }
+
+    # Returns the supported codecs
+    @classmethod
+    def GetCodecs(cls):
+        return sorted(cls._levels)
+
+    # Checks to see if the library needed by a codec is installed
+    @classmethod
+    def IsAvailable(cls, vCodec):
+        if vCodec == "zstd":
+            return zstandard is not None
+        elif vCodec == "lz4":
+            return lz4 is not None
+
+        return vCodec in cls._levels
+
+    # Returns the level that will be used for the codec
+    @classmethod
+    def GetLevel(cls, vCodec, vLevel):
+        if vLevel is None:
+            return cls._levels[vCodec]
+
+        return vLevel
+
+    # Makes sure that the codec and level can be used
+    @classmethod
+    def Verify(cls, vCodec, vLevel):
+        if vCodec not in cls._levels:
+            Tools.Fail("Unknown compression: " + vCodec + ". Supported: " + ", ".join(cls.GetCodecs()))
+
+        if not cls.IsAvailable(vCodec):
+            Tools.Fail("The python library for " + vCodec + " compression isn't installed!")
+
+        level = cls.GetLevel(vCodec, vLevel)
+        low, high = cls._ranges[vCodec]
+
+        if level < low or level > high:
+            Tools.Fail("The " + vCodec + " level must be between " + str(low) + " and " + str(high) + "!")
+
+    # Returns the formats that kernel modules can be compressed with
+    @classmethod
+    def GetModuleFormats(cls):
+        return sorted(cls._module_formats)
+
+    # Returns the kmod feature needed to load modules in this format
+    @classmethod
+    def GetModuleFeature(cls, vFormat):
+        return cls._module_formats.get(vFormat)
+
+    # Compresses a kernel module the same way the kernel build system does
+    @classmethod
+    def CompressModule(cls, vData, vFormat):
+        if vFormat == "gz":
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            return compressor.compress(vData) + compressor.flush()
+        elif vFormat == "xz":
+            filters = [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": 1024 * 1024}]
+            return lzma.compress(vData, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, filters=filters)
+        elif vFormat == "zst":
+            return zstandard.ZstdCompressor(level=19).compress(vData)
+
+        return vData
+
+    # Decompresses a kernel module based on its suffix (.ko.gz, .ko.xz or
+    # .ko.zst). Returns None if the module can't be decompressed.
+    @classmethod
+    def DecompressModule(cls, vData, vPath):
+        try:
+            if vPath.endswith(".gz"):
+                return zlib.decompress(vData, 31)
+            elif vPath.endswith(".xz"):
+                return lzma.decompress(vData)
+            elif vPath.endswith(".zst"):
+                if not zstandard:
+                    return None
+
+                try:
+                    return zstandard.ZstdDecompressor().decompressobj().decompress(vData)
+                except zstandard.ZstdError:
+                    return None
+        except (zlib.error, lzma.LZMAError):
+            return None
+
+        return vData
+
+    # Returns the format of the data that starts with the given bytes
+    # (none for an uncompressed cpio archive), or None if it is unknown
+    @classmethod
+    def Detect(cls, vData):
+        for magic, codec in cls._magics:
+            if vData.startswith(magic):
+                return codec
+
+        return None
+
+    # Returns a decompressor (with the decompress method and the eof and
+    # unused_data attributes) for a format, or None if its library isn't installed
+    @classmethod
+    def OpenDecompressor(cls, vCodec):
+        if vCodec == "gzip":
+            return zlib.decompressobj(31)
+        elif vCodec == "xz":
+            return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        elif vCodec == "lzma":
+            return lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+        elif vCodec == "bzip2":
+            return bz2.BZ2Decompressor()
+        elif vCodec == "zstd" and zstandard:
+            return zstandard.ZstdDecompressor().decompressobj()
+        elif vCodec == "lz4" and lz4:
+            return Lz4LegacyDecompressor()
+
+        return None
+
+    # Returns the errors that the decompressors raise on corrupted data
+    @classmethod
+    def GetDecompressErrors(cls):
+        return cls._decompress_errors
+
+    # Returns a compressor that writes into the given stream
+    @classmethod
+    def Open(cls, vStream, vCodec, vLevel=None, vThreads=0):
+        level = cls.GetLevel(vCodec, vLevel)
+        threads = vThreads or os.cpu_count() or 1
+
+        if vCodec == "gzip":
+            if threads > 1:
+                return ParallelGzipCompressor(vStream, level, threads)
+
+            return GzipCompressor(vStream, level, threads)
+        elif vCodec == "xz":
+            return XzCompressor(vStream, level, threads)
+        elif vCodec == "zstd":
+            return ZstdCompressor(vStream, level, threads)
+        elif vCodec == "lz4":
+            return Lz4Compressor(vStream, level, threads)
+
+        return Compressor(vStream, level, threads)
+
+    # Prints the statistics of a finished compressor (of a segment of the
+    # initramfs if a name is given)
+    @classmethod
+    def Report(cls, vCodec, vCompressor, vName=None):
+        bytesIn = vCompressor.GetBytesIn()
+        bytesOut = vCompressor.GetBytesOut()
+        elapsed = max(vCompressor.GetElapsed(), 0.001)
+
+        ratio = (100.0 * bytesOut / bytesIn) if bytesIn else 0
+        throughput = bytesIn / elapsed / (1024 * 1024)
+
+        label = vName + " (" + vCodec + ")" if vName else vCodec
+
+        Tools.Flag("{0}: {1} bytes in, {2} bytes out ({3:.1f}%), {4:.2f}s, {5:.1f} MiB/s".format(
+            label, bytesIn, bytesOut, ratio, elapsed, throughput))
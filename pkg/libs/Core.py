@@ -1,10 +1,12 @@
 # Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
 # Licensed under the Simplified BSD License which can be found in the LICENSE file.
 
+import glob
 import os
 import shutil
-import re
+import stat
 
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import call
 from subprocess import check_output
 from subprocess import CalledProcessError
@@ -12,6 +14,19 @@ from subprocess import CalledProcessError
 import pkg.libs.Variables as var
 
 from pkg.libs.Tools import Tools
+from pkg.libs.Elf import Elf
+from pkg.libs.Cpio import Cpio
+from pkg.libs.Compression import Compression
+from pkg.libs.ModuleIndex import ModuleIndex
+from pkg.libs.Cache import Cache
+from pkg.libs.Metrics import Metrics
+from pkg.libs.BuildConfig import BuildConfig
+from pkg.libs.Template import Template
+from pkg.libs.Host import Host
+from pkg.libs.Busybox import Busybox
+from pkg.libs.Strip import Strip
+from pkg.libs.Provenance import Provenance
+from pkg.libs.ZpoolCache import ZpoolCache
 from pkg.hooks.Base import Base
 from pkg.hooks.Zfs import Zfs
 from pkg.hooks.Luks import Luks
@@ -21,12 +36,43 @@ from pkg.hooks.Udev import Udev
 
 # Contains the core of the application
 class Core(object):
-     # List of binaries (That will be 'ldd'ed later)
+     # List of binaries (Their library dependencies will be resolved later)
     _binset = set()
 
-    # List of modules that will be compressed
+    # List of modules that were requested
     _modset = set()
 
+    # The requested modules and all their dependencies (dependencies first)
+    _modclosure = []
+
+    # The libraries that were copied for the binaries
+    _libset = set()
+
+    # The modules that the host-only mode added to the addon modules
+    _hostset = set()
+
+    # Results of stripping the files (--strip), keyed by their category
+    _stripped = {}
+
+    # Fingerprint of all the inputs of this build
+    _fingerprint = None
+
+    # Set to true when the host-only mode enabled the addon hook
+    _host_enabled = False
+
+    # Files of the enabled hooks, the binaries among them and the libraries
+    # that those binaries need. This doesn't depend on the kernel, so it is
+    # resolved once and shared by the builds of every kernel.
+    _userspace = None
+
+    # Suffixes of compressed firmware files (tried in order)
+    _firmware_suffixes = ["", ".zst", ".xz"]
+
+    # Entries that don't exist in the temporary directory but will be
+    # written straight into the archive (device nodes, generated files, etc)
+    # Format: (path in the initramfs, mode, data, (major, minor))
+    _plan = []
+
     # Enable the 'base' hook since all initramfs will have this
     Base.Enable()
 
@@ -36,7 +82,7 @@ class Core(object):
         # If the user didn't pass an option through the command line,
         # then ask them which initramfs they would like to generate.
         if not var.choice:
-            print("Which initramfs would you like to generate:")
+            Tools.Print("Which initramfs would you like to generate:")
             Tools.PrintOptions()
             var.choice = Tools.Question("Current choice [1]: ")
             Tools.NewLine()
@@ -45,6 +91,15 @@ class Core(object):
         if Addon.GetFiles():
             Addon.Enable()
 
+        # Firmware selected from the command line
+        if var.firmwareSelection:
+            Firmware.Enable()
+
+            if var.firmwareSelection == "all":
+                Firmware.EnableCopyAll()
+            else:
+                Firmware.EnableAuto()
+
         # ZFS
         if var.choice == "1" or not var.choice:
             Zfs.Enable()
@@ -75,7 +130,12 @@ class Core(object):
     @classmethod
     def CreateBaselayout(cls):
         for dir in var.baselayout:
-            call(["mkdir", "-p", dir])
+            Tools.MakeDirectory(var.temp + dir)
+
+        # Device nodes can't be created without root, so they are only
+        # added to the archive rather than to the temporary directory
+        for path, mode, major, minor in var.basedevices:
+            cls._plan.append((path, mode, b"", (major, minor)))
 
         # Create a symlink to this temporary directory at the home dir.
         # This will help us debug if anything (since the dirs are randomly
@@ -86,7 +146,7 @@ class Core(object):
     @classmethod
     def GetDesiredKernel(cls):
         if not var.kernel:
-            current_kernel = check_output(["uname", "-r"], universal_newlines=True).strip()
+            current_kernel = os.uname().release
 
             message = "Do you want to use the current kernel: " + current_kernel + " [Y/n]: "
             var.choice = Tools.Question(message)
@@ -103,19 +163,38 @@ class Core(object):
             else:
                 Tools.Fail("Invalid Option. Exiting.")
 
-        # Set modules path to correct location and sets kernel name for initramfs
-        var.modules = "/lib/modules/" + var.kernel + "/"
-        var.lmodules = var.temp + "/" + var.modules
-        var.initrd = "initrd-" + var.kernel
-
-        # Check modules directory
-        cls.VerifyModulesDirectory()
+    # Forgets everything that a previous build in this process collected,
+    # so every build starts from what the shared phases resolved
+    @classmethod
+    def ResetBuild(cls):
+        for module in cls._hostset:
+            Addon.RemoveFile(module)
+
+        if cls._host_enabled:
+            Addon.Disable()
+
+        cls._modset = set()
+        cls._modclosure = []
+        cls._binset = set()
+        cls._libset = set()
+        cls._hostset = set()
+        cls._host_enabled = False
+        cls._stripped = {}
+        cls._fingerprint = None
+        cls._plan = []
+
+        Tools.ForgetDirectories()
+        Cache.ResetBuild()
+        Provenance.ResetBuild()
+        ZpoolCache.Reset()
 
     # Check to make sure the kernel modules directory exists
     @classmethod
-    def VerifyModulesDirectory(cls):
-        if not os.path.exists(var.modules):
-            Tools.Fail("The modules directory for " + var.modules + " doesn't exist!")
+    def VerifyModulesDirectory(cls, vModules=None):
+        modules = vModules or var.modules
+
+        if not os.path.exists(modules):
+            Tools.Fail("The modules directory for " + modules + " doesn't exist!")
 
     # Make sure that the arch is x86_64
     @classmethod
@@ -133,24 +212,100 @@ class Core(object):
             if not os.path.isfile(binary):
                 Tools.BinaryDoesntExist(binary)
 
-    # Compresses the kernel modules
+        # Make sure the selected compression can be used before doing any work
+        Compression.Verify(var.compression, var.compressionLevel)
+        cls.VerifyModuleCompression()
+
+        if var.strip:
+            Tools.GetProgramPath("strip")
+
+    # Checks that the kernel modules can be compressed in the selected format
+    # and that the kmod that goes into the initramfs can load them
+    @classmethod
+    def VerifyModuleCompression(cls):
+        if var.moduleCompression not in Compression.GetModuleFormats():
+            Tools.Fail("Unknown module compression: " + var.moduleCompression + ". Supported: " +
+                       ", ".join(Compression.GetModuleFormats()))
+
+        if var.moduleCompression == "zst" and not Compression.IsAvailable("zstd"):
+            Tools.Fail("The python library for zstd compression isn't installed!")
+
+        feature = Compression.GetModuleFeature(var.moduleCompression)
+
+        if not feature:
+            return
+
+        # kmod lists the features it was built with (i.e +XZ -ZLIB +ZSTD). Older
+        # versions don't list all of them, so only fail if it is explicitly disabled.
+        try:
+            features = check_output([Tools.GetProgramPath("kmod"), "--version"], universal_newlines=True).split()
+        except (OSError, CalledProcessError):
+            return
+
+        if "-" + feature in features:
+            Tools.Fail("kmod wasn't built with " + feature + " support. Use a different --module-compression.")
+
+    # Compresses the kernel modules in parallel. Modules that the host already
+    # ships compressed were copied as is and are left untouched.
     @classmethod
     def CompressKernelModules(cls):
+        if var.moduleCompression == "none":
+            return
+
         Tools.Info("Compressing kernel modules ...")
 
-        cmd = "find " + var.lmodules + " -name " + "*.ko"
-        results = check_output(cmd, shell=True, universal_newlines=True).strip()
+        modules = []
+
+        for root, dirs, files in os.walk(var.lmodules):
+            for file in files:
+                if file.endswith(".ko"):
+                    modules.append(os.path.join(root, file))
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for module, success in zip(modules, pool.map(cls.CompressKernelModule, modules)):
+                if not success:
+                    Tools.Fail("Unable to compress " + module + " !")
+
+    # Compresses a single kernel module and replaces the original
+    @classmethod
+    def CompressKernelModule(cls, vModule):
+        compressed = vModule + "." + var.moduleCompression
+
+        try:
+            key = None
+            cached = None
+
+            # The module was copied from the host, so its content can be
+            # identified by the (already hashed) original.
+            if Cache.IsEnabled():
+                source = vModule[len(var.temp):]
+                key = Cache.GetKey(["module", Cache.HashFile(source), var.moduleCompression, var.strip])
+                cached = Cache.Get(key)
+
+            if cached:
+                Tools.StageFile(cached, compressed, vMode=stat.S_IMODE(os.stat(vModule).st_mode))
+            else:
+                with open(vModule, "rb") as module:
+                    data = Compression.CompressModule(module.read(), var.moduleCompression)
+
+                with open(compressed, "wb") as module:
+                    module.write(data)
+
+                Cache.Put(key, compressed)
+                shutil.copymode(vModule, compressed)
 
-        for module in results.split("\n"):
-            cmd = "gzip -9 " + module
-            callResult = call(cmd, shell=True)
+            os.remove(vModule)
+        except OSError:
+            return False
 
-            if callResult != 0:
-                Tools.Fail("Unable to compress " + module + " !")
+        return True
 
     # Generates the modprobe information
     @classmethod
     def GenerateModprobeInfo(cls):
+        if not cls._modclosure:
+            return
+
         Tools.Info("Generating modprobe information ...")
 
         # Copy modules.order and modules.builtin just so depmod doesn't spit out warnings. -_-
@@ -162,91 +317,202 @@ class Core(object):
         if result != 0:
             Tools.Fail("Depmod was unable to refresh the dependency information for your initramfs!")
 
+        for file in os.listdir(var.lmodules):
+            if file.startswith("modules."):
+                Provenance.Add("build", var.modules + file, "generated")
+
     # Copies the firmware files if necessary
     @classmethod
     def CopyFirmware(cls):
         if Firmware.IsEnabled():
             Tools.Info("Copying firmware...")
 
-            if os.path.isdir("/lib/firmware/"):
+            if os.path.isdir(var.firmwareDirectory):
                 if Firmware.IsCopyAllEnabled():
-                    shutil.copytree("/lib/firmware/", var.temp + "/lib/firmware/")
+                    Tools.CopyTree(var.firmwareDirectory, var.temp + "/lib/firmware/")
+                    Provenance.Add("hook:Firmware", "/lib/firmware", "file")
                 else:
+                    # Copy the firmware that the included modules request
+                    if Firmware.IsAutoEnabled():
+                        cls.CopySelectedFirmware()
+
                     # Copy the firmware in the files list
                     if Firmware.GetFiles():
                         try:
                             for fw in Firmware.GetFiles():
                                 Tools.Copy(fw, directoryPrefix=var.firmwareDirectory)
+                                Provenance.Add("hook:Firmware", "/lib/firmware/" + fw, "file")
                         except FileNotFoundError:
                             Tools.Warn("An error occured while copying the following firmware: " + fw)
-                    else:
+                    elif not Firmware.IsAutoEnabled():
                         Tools.Warn("No firmware files were found in the firmware list!")
             else:
-                Tools.Fail("The /lib/firmware/ directory does not exist")
+                Tools.Fail("The " + var.firmwareDirectory + " directory does not exist")
 
-    # Create the required symlinks
+    # Returns the firmware files (relative to the firmware directory) that
+    # the modules request, and the requested names that weren't found.
+    @classmethod
+    def SelectFirmware(cls, vModules):
+        selected = []
+        missing = []
+
+        for module in vModules:
+            for name in ModuleIndex.GetFirmware(module):
+                matches = cls.FindFirmware(name)
+
+                if not matches and name not in missing:
+                    missing.append(name)
+
+                for match in matches:
+                    Provenance.Add(ModuleIndex.GetPath(module), "/lib/firmware/" + match, "firmware")
+
+                    if match not in selected:
+                        selected.append(match)
+
+        return selected, missing
+
+    # Finds the files in the firmware directory for a firmware name. The name
+    # can contain wildcards, and the file might be compressed (.xz, .zst).
+    @classmethod
+    def FindFirmware(cls, vName):
+        directory = os.path.normpath(var.firmwareDirectory)
+        matches = []
+
+        for suffix in cls._firmware_suffixes:
+            pattern = os.path.join(directory, vName + suffix)
+
+            if any(character in vName for character in "*?["):
+                paths = sorted(glob.glob(pattern))
+            else:
+                paths = [pattern] if os.path.lexists(pattern) else []
+
+            matches += [os.path.relpath(path, directory) for path in paths if not os.path.isdir(path)]
+
+            if matches:
+                break
+
+        return matches
+
+    # Copies a firmware file into the initramfs. Symlinks inside the firmware
+    # directory (linux-firmware uses many of them) are kept as symlinks and
+    # their targets are copied as well. Returns the amount of bytes copied.
+    @classmethod
+    def CopyFirmwareFile(cls, vName):
+        directory = os.path.normpath(var.firmwareDirectory)
+        source = os.path.join(directory, vName)
+        target = os.path.join(var.temp, "lib/firmware", vName)
+        seen = set()
+
+        while os.path.islink(source) and source not in seen:
+            seen.add(source)
+            resolved = os.path.normpath(os.path.join(os.path.dirname(source), os.readlink(source)))
+
+            # Links that leave the firmware directory are copied as files
+            if not resolved.startswith(directory + os.sep):
+                break
+
+            Tools.MakeDirectory(os.path.dirname(target))
+
+            if not os.path.lexists(target):
+                os.symlink(os.path.relpath(resolved, os.path.dirname(source)), target)
+
+            Provenance.Add("/lib/firmware/" + os.path.relpath(source, directory),
+                           "/lib/firmware/" + os.path.relpath(resolved, directory), "symlink")
+
+            source = resolved
+            target = os.path.join(var.temp, "lib/firmware", os.path.relpath(resolved, directory))
+
+        if os.path.lexists(target):
+            return 0
+
+        st = os.stat(source)
+        Tools.MakeDirectory(os.path.dirname(target))
+        Tools.StageFile(source, target, st)
+
+        return st.st_size
+
+    # Copies the firmware that the modules in the initramfs request and
+    # adds the selection to the report
+    @classmethod
+    def CopySelectedFirmware(cls):
+        selected, missing = cls.SelectFirmware(cls._modclosure)
+        size = 0
+
+        for name in selected:
+            try:
+                size += cls.CopyFirmwareFile(name)
+            except OSError:
+                Tools.Warn("An error occured while copying the following firmware: " + name)
+                missing.append(name)
+
+        Tools.Flag("Selected " + str(len(selected)) + " firmware files for the included modules (" +
+                   str(size // 1024) + " KiB)")
+
+        # Modules list the firmware of every device they support, most of it is never installed
+        if missing:
+            Tools.Warn(str(len(missing)) + " firmware files requested by the modules weren't found")
+
+        Metrics.Note("firmware", {
+            "mode": "auto",
+            "files": selected,
+            "bytes": size,
+            "missing": missing,
+        })
+
+    # Create the required symlinks. They are written straight into the
+    # archive, nothing runs inside the temporary directory.
     @classmethod
     def CreateLinks(cls):
         Tools.Info("Creating symlinks ...")
 
-        # Needs to be from this directory so that the links are relative
-        os.chdir(var.lbin)
+        kmod = Tools.GetProgramPath("kmod")
+        kmodDirectory = os.path.dirname(kmod).lstrip("/")
 
-        # Create busybox links
-        cmd = 'chroot ' + var.temp + ' /bin/busybox sh -c "cd /bin && /bin/busybox --install -s ."'
+        # 'sh' is bash and the kmod tools are links to kmod (in its own directory)
+        links = {"bin/sh": "bash"}
 
-        callResult = call(cmd, shell=True)
+        for link in Base.GetKmodLinks():
+            links[kmodDirectory + "/" + link] = "kmod"
 
-        if callResult != 0:
-            Tools.Fail("Unable to create busybox links via chroot!")
+        # Every busybox applet goes into /bin, unless the initramfs already
+        # has a program (or a link) with that name there
+        existing = set(os.listdir(var.lbin))
+        applets = Busybox.GetApplets(var.temp + "/bin/busybox")
 
-        # Create 'sh' symlink to 'bash'
-        os.remove(var.temp + "/bin/sh")
-        os.symlink("bash", "sh")
+        for applet in applets:
+            if applet not in existing and applet not in Base.GetKmodLinks():
+                links.setdefault("bin/" + applet, "busybox")
 
-        # Switch to the kmod directory, delete the corresponding busybox
-        # symlink and create the symlinks pointing to kmod
-        if os.path.isfile(var.lsbin + "/kmod"):
-            os.chdir(var.lsbin)
-        elif os.path.isfile(var.lbin + "/kmod"):
-            os.chdir(var.lbin)
+        for path, target in sorted(links.items()):
+            cls._plan.append((path, stat.S_IFLNK | 0o777, target.encode(), (0, 0)))
+            Provenance.Add(os.path.join("/" + os.path.dirname(path), target), "/" + path, "symlink")
 
-        for link in Base.GetKmodLinks():
-            os.remove(var.temp + "/bin/" + link)
-            os.symlink("kmod", link)
+        Tools.Flag("Added " + str(len(applets)) + " busybox applets")
 
-    # Creates symlinks from library files found in each /usr/lib## dir to the /lib[32/64] directories
+    # Adds the library symlinks (path -> target) to the archive. The links
+    # are relative so that they also resolve in an unpacked copy.
     @classmethod
-    def CreateLibraryLinks(cls):
-         # Set library symlinks
-        if os.path.isdir(var.temp + "/usr/lib") and os.path.isdir(var.temp + "/lib64"):
-            pcmd = 'find /usr/lib -iname "*.so.*" -exec ln -s "{}" /lib64 \;'
-            cmd = 'chroot ' + var.temp + ' /bin/busybox sh -c "' + pcmd + '"'
-            call(cmd, shell=True)
-
-        if os.path.isdir(var.temp + "/usr/lib32") and os.path.isdir(var.temp + "/lib32"):
-            pcmd = 'find /usr/lib32 -iname "*.so.*" -exec ln -s "{}" /lib32 \;'
-            cmd = 'chroot ' + var.temp + ' /bin/busybox sh -c "' + pcmd + '"'
-            call(cmd, shell=True)
+    def CreateLibraryLinks(cls, vLinks):
+        for path, target in sorted(vLinks.items()):
+            Tools.MakeDirectory(var.temp + os.path.dirname(path))
+            relative = os.path.relpath(target, os.path.dirname(path))
+            cls._plan.append((path.lstrip("/"), stat.S_IFLNK | 0o777, relative.encode(), (0, 0)))
 
-        if os.path.isdir(var.temp + "/usr/lib64") and os.path.isdir(var.temp + "/lib64"):
-            pcmd = 'find /usr/lib64 -iname "*.so.*" -exec ln -s "{}" /lib64 \;'
-            cmd = 'chroot ' + var.temp + ' /bin/busybox sh -c "' + pcmd + '"'
-            call(cmd, shell=True)
+        if vLinks:
+            Tools.Flag("Added " + str(len(vLinks)) + " library links")
 
     # Copies files that udev uses, like /etc/udev/*, /lib/udev/*, etc
     @classmethod
     def CopyUdevSupportFiles(cls):
         if Udev.IsEnabled():
-            # Activate udev support in 'init'
-            call(["sed", "-i", "-e", var.useUdevLine + "s/0/1/", var.temp + "/init"])
-
             # Copy all of the udev files
             if os.path.isdir("/etc/udev/"):
-                shutil.copytree("/etc/udev/", var.temp + "/etc/udev/")
+                Tools.CopyTree("/etc/udev/", var.temp + "/etc/udev/")
+                Provenance.Add("hook:Udev", "/etc/udev", "file")
 
             if os.path.isdir("/lib/udev/"):
-                shutil.copytree("/lib/udev/", var.temp + "/lib/udev/")
+                Tools.CopyTree("/lib/udev/", var.temp + "/lib/udev/")
+                Provenance.Add("hook:Udev", "/lib/udev", "file")
 
             # Rename udevd and place in /sbin
             udev_path = Tools.GetUdevPath()
@@ -255,6 +521,7 @@ class Core(object):
             if os.path.isfile(var.temp + udev_path) and udev_path != "/sbin/udevd":
                 os.rename(var.temp + udev_path, var.temp + "/sbin/udevd")
                 os.rmdir(var.temp + systemd_dir)
+                Provenance.Add(udev_path, "/sbin/udevd", "renamed")
 
     # This functions does any last minute steps like copying zfs.conf,
     # giving init execute permissions, setting up symlinks, etc
@@ -263,79 +530,363 @@ class Core(object):
         Tools.Info("Performing finishing steps ...")
 
         # Create mtab file
-        call(["touch", var.temp + "/etc/mtab"])
+        open(var.temp + "/etc/mtab", "a").close()
 
         if not os.path.isfile(var.temp + "/etc/mtab"):
             Tools.Fail("Error creating the mtab file. Exiting.")
 
-        cls.CreateLibraryLinks()
-
-        # Copy the init script
-        shutil.copy(var.phome + "/files/init", var.temp)
-
-        if not os.path.isfile(var.temp + "/init"):
-            Tools.Fail("Error creating the init file. Exiting.")
-
-        # Give execute permissions to the script
-        cr = call(["chmod", "u+x", var.temp + "/init"])
-
-        if cr != 0:
-            Tools.Fail("Failed to give executive privileges to " + var.temp + "/init")
-
-        # Fix 'poweroff, reboot' commands
-        call("sed -i \"71a alias reboot='reboot -f' \" " + var.temp + "/etc/bash/bashrc", shell=True)
-        call("sed -i \"71a alias poweroff='poweroff -f' \" " + var.temp + "/etc/bash/bashrc", shell=True)
-
-        # Sets initramfs script version number
-        call(["sed", "-i", "-e", var.initrdVersionLine + "s/0/" + var.version + "/", var.temp + "/init"])
-
-        # Fix EDITOR/PAGER
-        call(["sed", "-i", "-e", "12s:/bin/nano:/bin/vi:", var.temp + "/etc/profile"])
-        call(["sed", "-i", "-e", "13s:/usr/bin/less:/bin/less:", var.temp + "/etc/profile"])
+        # Generate the init script and fix the shell configuration files
+        cls.RenderFiles()
+        Provenance.Add("build", "/init", "generated")
 
         # Copy all of the modprobe configurations
         if os.path.isdir("/etc/modprobe.d/"):
-            shutil.copytree("/etc/modprobe.d/", var.temp + "/etc/modprobe.d/")
+            Tools.CopyTree("/etc/modprobe.d/", var.temp + "/etc/modprobe.d/")
+            Provenance.Add("build", "/etc/modprobe.d", "file")
 
         cls.CopyUdevSupportFiles()
 
         # Any last substitutions or additions/modifications should be done here
         if Zfs.IsEnabled():
-            # Enable ZFS in the init if ZFS is being used
-            call(["sed", "-i", "-e", var.useZfsLine + "s/0/1/", var.temp + "/init"])
-
             # Copy zpool.cache into initramfs
             if os.path.isfile("/etc/zfs/zpool.cache"):
                 Tools.Flag("Using your zpool.cache file ...")
                 Tools.Copy("/etc/zfs/zpool.cache")
+                Provenance.Add("hook:Zfs", "/etc/zfs/zpool.cache", "file")
             else:
                 Tools.Warn("No zpool.cache was found. It will not be used ...")
 
-        # Enable LUKS in the init if LUKS is being used
-        if Luks.IsEnabled():
-            call(["sed", "-i", "-e", var.useLuksLine + "s/0/1/", var.temp + "/init"])
+    # Writes the order in which init loads the modules: one level of modules
+    # per line, the modules of a level are loaded in parallel
+    @classmethod
+    def WriteModulePlan(cls):
+        if not cls._modclosure:
+            return
 
-        # Enable ADDON in the init and add our modules to the initramfs
-        # if addon is being used
-        if Addon.IsEnabled():
-            call(["sed", "-i", "-e", var.useAddonLine + "s/0/1/", var.temp + "/init"])
-            call(["sed", "-i", "-e", var.addonModulesLine + "s/\"\"/\"" + " ".join(Addon.GetFiles()) + "\"/", var.temp + "/init"])
+        levels = ModuleIndex.GetLevels(cls._modclosure)
+        text = "".join(" ".join(level) + "\n" for level in levels)
+
+        Tools.MakeDirectory(os.path.dirname(var.temp + var.modulePlan))
+        Template.WriteFile(var.temp + var.modulePlan, text, 0o644)
+        Provenance.Add("build", var.modulePlan, "generated")
+
+        Metrics.Note("module_plan", levels)
+
+    # Renders the init script from the build configuration and applies the
+    # fixups to the shell configuration files. Each file is written once.
+    @classmethod
+    def RenderFiles(cls):
+        config = BuildConfig.FromBuild()
+
+        Template.RenderFile(var.phome + "/files/init", var.temp + "/init", config.GetPlaceholders())
+        cls.WriteModulePlan()
+
+        for file, fixups in sorted(var.shellFixups.items()):
+            if os.path.isfile(var.temp + file):
+                Tools.EditFile(var.temp + file, lambda vLines: Template.Fixup(vLines, fixups))
+
+    # Saves why every file is in the initramfs (see './mkinitrd.py why')
+    @classmethod
+    def WriteProvenance(cls):
+        graph = Provenance.Save(var.temp)
+        Metrics.Note("provenance", {"nodes": len(graph["nodes"]), "edges": len(graph["edges"]), "other": graph["other"]})
 
     # Create the initramfs
     @classmethod
     def CreateInitramfs(cls):
         Tools.Info("Creating the initramfs ...")
 
-        # The find command must use the `find .` and not `find ${T}`
-        # because if not, then the initramfs layout will be prefixed with
-        # the ${T} path.
-        os.chdir(var.temp)
+        totals = {
+            "codec": var.compression,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "seconds": 0.0,
+            "segments": [],
+        }
+
+        # The image is written to a temporary file that replaces the
+        # output once it is complete, so a half written initramfs never
+        # shows up in the output directory
+        output = var.home + "/" + var.initrd
+        partial = cls.GetPartialPath(output)
+
+        with open(partial, "wb") as image:
+            if var.microcode:
+                cls.WriteMicrocode(image, totals)
+
+            if var.layered:
+                for name, entries, extra in cls.GetLayers():
+                    cls.WriteLayer(image, name, entries, extra, totals)
+            else:
+                # The temporary directory is walked once and every entry is
+                # streamed straight into the compressor.
+                cls.WriteSegment(image, None, Cpio.Walk(var.temp), cls._plan, totals)
 
-        call(["find . -print0 | cpio -o --null --format=newc | gzip -9 > " +  var.home + "/" + var.initrd], shell=True)
+        Metrics.Note("image", totals)
 
-        if not os.path.isfile(var.home + "/" + var.initrd):
+        if not os.path.isfile(partial):
             Tools.Fail("Error creating the initramfs. Exiting.")
 
+        os.replace(partial, output)
+
+        # Keep the image so that a rebuild with the same inputs can reuse it
+        if cls._fingerprint:
+            Cache.PutImage(cls._fingerprint, output)
+
+        Cache.SaveHashes()
+
+    # Returns the temporary path that an output file is written to before it
+    # replaces the output (hidden, in the same directory)
+    @classmethod
+    def GetPartialPath(cls, vOutput):
+        return os.path.join(os.path.dirname(vOutput), "." + os.path.basename(vOutput) + ".partial")
+
+    # Writes a compressed cpio segment with the given entries ((name, path,
+    # stat) tuples like Cpio.Walk returns) and extra entries (like _plan)
+    @classmethod
+    def WriteSegment(cls, vImage, vName, vEntries, vExtra, vTotals):
+        with Compression.Open(vImage, var.compression, var.compressionLevel, var.compressionThreads) as stream:
+            archive = Cpio(stream)
+
+            for name, path, st in vEntries:
+                archive.AddPath(name, path, st)
+
+            for entry in vExtra:
+                archive.AddEntry(*entry)
+
+            archive.Close()
+
+        Compression.Report(var.compression, stream, vName)
+
+        vTotals["bytes_in"] += stream.GetBytesIn()
+        vTotals["bytes_out"] += stream.GetBytesOut()
+        vTotals["seconds"] += stream.GetElapsed()
+        vTotals["segments"].append({
+            "name": vName or "image",
+            "bytes_in": stream.GetBytesIn(),
+            "bytes_out": stream.GetBytesOut(),
+            "cached": False,
+        })
+
+    # Writes the uncompressed early segment with the CPU microcode. The
+    # microcode files of each vendor are joined into the file the kernel
+    # looks for (kernel/x86/microcode/<vendor>.bin).
+    @classmethod
+    def WriteMicrocode(cls, vImage, vTotals):
+        archive = Cpio(vImage)
+        found = []
+
+        for name, (directory, pattern) in sorted(var.microcodeSources.items()):
+            files = sorted(glob.glob(os.path.join(var.firmwareDirectory, directory, pattern)))
+            files = [file for file in files if os.path.isfile(file)]
+
+            if not files:
+                continue
+
+            if not found:
+                for parent in ("kernel", "kernel/x86", "kernel/x86/microcode"):
+                    archive.AddDirectory(parent)
+
+            data = b""
+
+            for file in files:
+                with open(file, "rb") as microcode:
+                    data += microcode.read()
+
+            archive.AddData("kernel/x86/microcode/" + name, data)
+            found.append(name)
+
+        if not found:
+            Tools.Warn("No CPU microcode was found in " + var.firmwareDirectory + ". The early segment will not be added ...")
+            return
+
+        archive.Close()
+
+        Tools.Flag("Added the CPU microcode: " + ", ".join(found))
+
+        vTotals["bytes_out"] += archive.GetLength()
+        vTotals["segments"].append({
+            "name": "microcode",
+            "bytes_in": archive.GetLength(),
+            "bytes_out": archive.GetLength(),
+            "cached": False,
+        })
+
+    # Returns the layers of a layered initramfs: (name, entries, extra entries).
+    # The base layer has everything that isn't in a later layer.
+    @classmethod
+    def GetLayers(cls):
+        later = set()
+
+        for name, paths in var.layers[1:]:
+            later.update(paths)
+
+        layers = [(var.layers[0][0], list(Cpio.Walk(var.temp, "", later)), cls._plan)]
+
+        for name, paths in var.layers[1:]:
+            entries = []
+
+            for path in paths:
+                full = os.path.join(var.temp, path)
+
+                if not os.path.lexists(full):
+                    continue
+
+                # The parent directories are repeated in every layer that
+                # needs them so that each layer can be unpacked on its own
+                parts = path.split("/")
+
+                for i in range(1, len(parts)):
+                    parent = "/".join(parts[:i])
+                    entries.append((parent, os.path.join(var.temp, parent), os.lstat(os.path.join(var.temp, parent))))
+
+                st = os.lstat(full)
+                entries.append((path, full, st))
+
+                if os.path.isdir(full) and not os.path.islink(full):
+                    entries += list(Cpio.Walk(full, path + "/"))
+
+            if entries:
+                layers.append((name, entries, []))
+
+        return layers
+
+    # Returns the cache key of a layer. The key covers everything that
+    # goes into the archive except the modification times, since the
+    # files in the temporary directory are new on every build.
+    @classmethod
+    def GetLayerKey(cls, vEntries, vExtra):
+        values = ["layer", var.compression, Compression.GetLevel(var.compression, var.compressionLevel)]
+
+        for name, path, st in vEntries:
+            values += [name, st.st_mode, st.st_uid, st.st_gid]
+
+            if stat.S_ISREG(st.st_mode):
+                values.append(Cache.HashContent(path))
+            elif stat.S_ISLNK(st.st_mode):
+                values.append(os.readlink(path))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                values.append(st.st_rdev)
+
+        for entry in vExtra:
+            values.append(repr(entry))
+
+        return Cache.GetKey(values)
+
+    # Writes a layer of a layered initramfs. A layer with the same content
+    # as one of a previous build is copied from the cache as is.
+    @classmethod
+    def WriteLayer(cls, vImage, vName, vEntries, vExtra, vTotals):
+        key = cls.GetLayerKey(vEntries, vExtra) if Cache.IsEnabled() else None
+        cached = Cache.GetLayer(key) if key else None
+
+        if cached:
+            Tools.Flag("Reusing the cached " + vName + " layer ...")
+
+            with open(cached, "rb") as layer:
+                shutil.copyfileobj(layer, vImage)
+
+            size = os.path.getsize(cached)
+            vTotals["bytes_out"] += size
+            vTotals["segments"].append({"name": vName, "bytes_in": 0, "bytes_out": size, "cached": True})
+            return
+
+        if not key:
+            cls.WriteSegment(vImage, vName, vEntries, vExtra, vTotals)
+            return
+
+        # The layer is written next to the temporary directory so that it
+        # can be stored in the cache
+        layerFile = var.temp + "." + vName
+
+        try:
+            with open(layerFile, "wb") as layer:
+                cls.WriteSegment(layer, vName, vEntries, vExtra, vTotals)
+
+            with open(layerFile, "rb") as layer:
+                shutil.copyfileobj(layer, vImage)
+
+            Cache.PutLayer(key, layerFile)
+        finally:
+            if os.path.exists(layerFile):
+                os.remove(layerFile)
+
+    # Returns the paths of every file that the build will read from the host
+    @classmethod
+    def GetBuildInputs(cls):
+        # Only the sources of the program (not their bytecode, which
+        # depends on the interpreter)
+        inputs = [var.phome + "/files/init"] + sorted(glob.glob(var.phome + "/pkg/**/*.py", recursive=True))
+
+        if Udev.IsEnabled():
+            inputs += ["/etc/udev", "/lib/udev"]
+
+        if Zfs.IsEnabled():
+            inputs.append("/etc/zfs/zpool.cache")
+
+        files, binaries, libraries = cls.GetUserspace()
+        inputs += files + libraries
+        inputs.append("/etc/modprobe.d")
+
+        if var.microcode:
+            for directory, pattern in var.microcodeSources.values():
+                inputs.append(os.path.join(var.firmwareDirectory, directory))
+
+        modules = []
+
+        if Addon.IsEnabled() and var.modules:
+            ModuleIndex.Load(var.modules)
+
+            for file in Addon.GetFiles():
+                modules += ModuleIndex.GetDependencies(ModuleIndex.Resolve(file) or file)
+
+            inputs += [ModuleIndex.GetPath(module) for module in modules]
+            inputs += [var.modules + "/modules.order", var.modules + "/modules.builtin"]
+
+        if Firmware.IsEnabled():
+            if Firmware.IsCopyAllEnabled():
+                inputs.append(var.firmwareDirectory)
+            else:
+                inputs += [var.firmwareDirectory + fw for fw in Firmware.GetFiles()]
+
+                if Firmware.IsAutoEnabled():
+                    for fw in cls.SelectFirmware(modules)[0]:
+                        inputs += [var.firmwareDirectory + fw, os.path.realpath(var.firmwareDirectory + fw)]
+
+        return inputs
+
+    # Calculates the fingerprint of this build and reuses the image of a
+    # previous build if nothing that goes into the initramfs has changed
+    @classmethod
+    def CheckBuildCache(cls):
+        if not Cache.IsEnabled():
+            return
+
+        settings = [
+            var.version, var.kernel, var.compression, var.compressionLevel, var.moduleCompression,
+            Udev.IsEnabled(), Zfs.IsEnabled(), Luks.IsEnabled(), Addon.IsEnabled(),
+            Firmware.IsEnabled(), Firmware.IsCopyAllEnabled(), Firmware.IsAutoEnabled(),
+            var.layered, var.layers, var.microcode, var.strip, ZpoolCache.GetHints(),
+            var.encDrives, var.encJobs, var.hostOnly, var.firmwareSelection, var.firmwareDirectory,
+            var.provenance, list(Addon.GetFiles()),
+        ]
+
+        keys = [Cache.HashPath(path) for path in cls.GetBuildInputs()]
+        cls._fingerprint = Cache.GetKey(settings + keys)
+
+        # The provenance graph is only written by a full build
+        cached = Cache.GetImage(cls._fingerprint) if not var.provenance else None
+
+        if cached:
+            Tools.Flag("Nothing has changed since the last build. Using the cached initramfs ...")
+            output = var.home + "/" + var.initrd
+            partial = cls.GetPartialPath(output)
+
+            shutil.copyfile(cached, partial)
+            os.replace(partial, output)
+            Cache.SaveHashes()
+            Tools.CleanAndExit(var.initrd)
+
     # Checks to see if the binaries exist, if not then emerge
     @classmethod
     def VerifyBinaries(cls):
@@ -361,6 +912,11 @@ class Core(object):
             Tools.Flag("Using LUKS")
             cls.VerifyBinariesExist(Luks.GetFiles())
 
+            if var.encDrives:
+                Tools.Flag("Encrypted drives: " + ", ".join(var.encDrives))
+        elif var.encDrives:
+            Tools.Warn("Not using LUKS. The encrypted drives given with --enc-drives will be ignored ...")
+
     # Checks to see that all the binaries in the array exist and errors if they don't
     @classmethod
     def VerifyBinariesExist(cls, vFiles):
@@ -368,116 +924,235 @@ class Core(object):
             if not os.path.exists(file):
                 Tools.BinaryDoesntExist(file)
 
-    # Copies the required files into the initramfs
+    # Checks that the devices in the zpool.cache are still the vdevs of their
+    # pools (by the GUIDs in their labels). Vdevs that moved are looked up
+    # by their GUID. The devices are passed to init, so that an import
+    # without the cache only scans them.
     @classmethod
-    def CopyRequiredFiles(cls):
-        Tools.Info("Copying required files ...")
+    def VerifyZpoolCache(cls):
+        if not Zfs.IsEnabled() or var.zpoolCheck == "off" or not os.path.isfile("/etc/zfs/zpool.cache"):
+            return
 
-        cls.FilterAndInstall(Base.GetFiles())
+        Tools.Info("Checking the zpool.cache ...")
 
-        if Udev.IsEnabled():
-            cls.FilterAndInstall(Udev.GetFiles())
+        try:
+            problems = ZpoolCache.Check("/etc/zfs/zpool.cache")
+        except (OSError, ValueError) as error:
+            problems = [(None, "/etc/zfs/zpool.cache", "can't be read (" + str(error) + ")", None)]
 
-        if Zfs.IsEnabled():
-            cls.FilterAndInstall(Zfs.GetFiles())
+        for pool, path, problem, found in problems:
+            message = (pool + ": " if pool else "") + path + " " + problem
 
-        if Luks.IsEnabled():
-            cls.FilterAndInstall(Luks.GetFiles())
+            if found:
+                message += ", the vdev is at " + found + " now"
+
+            Tools.Warn(message)
+
+        if problems and var.zpoolCheck == "strict":
+            Tools.Fail("Your zpool.cache doesn't match your devices. Recreate it (zpool set cachefile=/etc/zfs/zpool.cache <pool>) "
+                       "or use --zpool-check=warn.")
+
+        for pool, devices in sorted(ZpoolCache.GetPools().items()):
+            Tools.Flag(pool + ": " + str(len(devices)) + " devices will be scanned if the pool is imported without the cache")
 
-    # Filters and installs each file in the array into the initramfs
+        Metrics.Note("zpool_cache", {"problems": [list(problem) for problem in problems], "devices": ZpoolCache.GetHints()})
+
+    # Adds the modules that this machine needs to boot to the addon modules
     @classmethod
-    def FilterAndInstall(cls, vFiles):
-        for file in vFiles:
-            # If the application is a binary, add it to our binary set. If the application is not
-            # a binary, then we will get a CalledProcessError because the output will be null.
-            try:
-                check_output('file -L ' + file.strip() + ' | grep "linked"', shell=True, universal_newlines=True).strip()
-                cls._binset.add(file)
-            except CalledProcessError:
-                pass
+    def DetectHostModules(cls):
+        if not var.hostOnly:
+            return
+
+        Tools.Info("Detecting the modules needed by this machine ...")
+
+        ModuleIndex.Load(var.modules)
+        modules = Host.Detect(Zfs.IsEnabled(), Luks.IsEnabled(), ZpoolCache.GetDevices())
+
+        for module in modules:
+            if module not in Addon.GetFiles():
+                Addon.AddFile(module)
+                cls._hostset.add(module)
+
+        if modules and not Addon.IsEnabled():
+            Addon.Enable()
+            cls._host_enabled = True
+
+        Tools.Flag("Host-only: " + str(len(modules)) + " modules detected (" + " ".join(modules) + ")")
+        Metrics.Note("host", {"sysfs": var.sysfsRoot, "modules": modules})
+
+    # Returns the files of the enabled hooks, the binaries among them and
+    # the libraries that the binaries need (resolved only once)
+    @classmethod
+    def GetUserspace(cls):
+        if cls._userspace is None:
+            files = []
+
+            for hook in (Base, Udev, Zfs, Luks):
+                if hook.IsEnabled():
+                    for file in hook.GetFiles():
+                        files.append(file)
+                        Provenance.Add("hook:" + hook.__name__, file, "file")
+
+            binaries = [file for file in files if Elf.IsElf(file.strip())]
+            dependencies, references = Elf.Resolve(binaries)
+
+            for binary in binaries:
+                if Elf.GetInfo(binary)["interp"]:
+                    Provenance.Add(binary, Elf.GetInfo(binary)["interp"], "interpreter")
+
+            for current, info, executableInfo, needed, library in references:
+                Provenance.Add(current, library, "needed")
 
-            # Copy the file into the initramfs
+            cls._userspace = (files, binaries, sorted(dependencies))
+
+        return cls._userspace
+
+    # Resolves the userspace files and their library closure and hashes them
+    # for the build cache. When several kernels are built, this runs before
+    # the builds start and every build inherits the results.
+    @classmethod
+    def ResolveUserspace(cls):
+        files, binaries, libraries = cls.GetUserspace()
+
+        if Cache.IsEnabled():
+            for path in files + libraries:
+                Cache.HashPath(path)
+
+        # Every build starts from these results
+        Cache.MarkShared()
+        Provenance.MarkShared()
+
+    # Copies the required files into the initramfs
+    @classmethod
+    def CopyRequiredFiles(cls):
+        Tools.Info("Copying required files ...")
+
+        files, binaries, libraries = cls.GetUserspace()
+
+        # The binaries' library dependencies are copied by CopyDependencies
+        cls._binset.update(binaries)
+
+        for file in files:
             Tools.Copy(file)
 
     # Copy modules and their dependencies
     @classmethod
     def CopyModules(cls):
-        moddeps = set()
+        moddeps = []
 
         # Build the list of module dependencies
         if Addon.IsEnabled():
             Tools.Info("Copying modules ...")
 
+            # Load the module indexes of the selected kernel once. The
+            # indexes are only read, nothing on the host is regenerated.
+            ModuleIndex.Load(var.modules)
+
             # Checks to see if all the modules in the list exist
             for file in Addon.GetFiles():
-                try:
-                    cmd = 'find ' + var.modules + ' -iname "' + file + '.ko" | grep ' + file + '.ko'
-                    result = check_output(cmd, universal_newlines=True, shell=True).strip()
-                    cls._modset.add(result)
-                except CalledProcessError:
-                    Tools.ModuleDoesntExist(file)
-
-        # If a kernel has been set, try to update the module dependencies
-        # database before searching it
-        if var.kernel:
-            try:
-                result = call(["depmod", var.kernel])
+                module = ModuleIndex.Resolve(file)
 
-                if result:
-                    Tools.Fail("Error updating module dependency database!")
-            except FileNotFoundError:
-                    # This should never occur because the application checks
-                    # that root is the user that is running the application.
-                    # Non-administraative users normally don't have access
-                    # to the 'depmod' command.
-                    Tools.Fail("The 'depmod' command wasn't found.")
+                if module:
+                    cls._modset.add(module)
+                    Provenance.Add("host-only" if file in cls._hostset else "hook:Addon", ModuleIndex.GetPath(module), "module")
+                elif ModuleIndex.IsBuiltin(file):
+                    Tools.Flag("The " + file + " module is built into the kernel ...")
+                else:
+                    Tools.ModuleDoesntExist(file)
 
         # Get the dependencies for all the modules in our set
-        for file in cls._modset:
-            # Get only the name of the module
-            match = re.search('(?<=/)[a-zA-Z0-9_-]+.ko', file)
-
-            if match:
-                sFile = match.group().split(".")[0]
-
-                cmd = "modprobe -S " + var.kernel + " --show-depends " + sFile + " | awk -F ' ' '{print $2}'"
-                results = check_output(cmd, shell=True, universal_newlines=True).strip()
+        for module in sorted(cls._modset):
+            for dependency in ModuleIndex.GetDependencies(module):
+                if dependency not in moddeps:
+                    moddeps.append(dependency)
 
-                for i in results.split("\n"):
-                    moddeps.add(i.strip())
+        cls._modclosure = moddeps
 
         # Copy the modules/dependencies
         if moddeps:
             for module in moddeps:
-                Tools.Copy(module)
+                Tools.Copy(ModuleIndex.GetPath(module))
 
-            # Compress the modules and update module dependency database inside the initramfs
+                for dependency in ModuleIndex.GetDirectDependencies(module):
+                    Provenance.Add(ModuleIndex.GetPath(module), ModuleIndex.GetPath(dependency), "dependency")
+
+            # The modules are stripped before they are compressed
+            if var.strip:
+                cls.StripModules()
+
+            # Compress the modules. The module dependency database inside the
+            # initramfs is updated afterwards by GenerateModprobeInfo.
             cls.CompressKernelModules()
-            cls.GenerateModprobeInfo()
 
     # Gets the library dependencies for all our binaries and copies them into our initramfs.
     @classmethod
     def CopyDependencies(cls):
         Tools.Info("Copying library dependencies ...")
 
-        bindeps = set()
+        # Resolve the interpreters and the full library closure of the
+        # binaries we've collected and where they go in the initramfs.
+        # (The userspace closure is usually resolved already, so this is cheap.)
+        libraries, links = Elf.GetLayout(cls._binset)
 
-        # Get the interpreter name that is on this system
-        result = check_output("ls " + var.lib64 + "/ld-linux-x86-64.so*", shell=True, universal_newlines=True).strip()
+        # Copy all the dependencies of the binary files into the initramfs
+        for library in libraries:
+            Tools.Copy(library)
 
-        # Add intepreter to deps since everything will depend on it
-        bindeps.add(result)
+        cls._libset.update(libraries)
+        cls.CreateLibraryLinks(links)
 
-        # Get the dependencies for the binaries we've collected and add them to
-        # our bindeps set. These will all be copied into the initramfs later.
-        for binary in cls._binset:
-            cmd = "ldd " + binary + " | awk -F '=>' '{print $2}' | awk -F ' ' '{print $1}' | sed '/^ *$/d'"
-            results = check_output(cmd, shell=True, universal_newlines=True).strip()
+        # A link that a binary references leads to the copied library, the
+        # other links exist because of the library they point to
+        for path, target in links.items():
+            if Provenance.HasParents(path):
+                Provenance.Add(path, target, "symlink")
+            else:
+                Provenance.Add(target, path, "symlink")
 
-            if results:
-                for library in results.split("\n"):
-                    bindeps.add(library)
+    # Strips the kernel modules that were copied (only the uncompressed ones,
+    # modules that the host ships compressed are left as they are)
+    @classmethod
+    def StripModules(cls):
+        modules = []
 
-        # Copy all the dependencies of the binary files into the initramfs
-        for library in bindeps:
-            Tools.Copy(library)
+        for root, dirs, files in os.walk(var.lmodules):
+            for file in files:
+                if file.endswith(".ko"):
+                    modules.append(os.path.join(root, file))
+
+        cls._stripped["modules"] = Strip.StripFiles(modules, "modules")
+
+    # Strips the binaries and the libraries in the initramfs and reports how
+    # much every category (including the modules) saved
+    @classmethod
+    def StripFiles(cls):
+        if not var.strip:
+            return
+
+        Tools.Info("Stripping binaries and libraries ...")
+
+        binaries = sorted(var.temp + binary for binary in cls._binset if os.path.isfile(var.temp + binary))
+        libraries = sorted(var.temp + library for library in cls._libset - cls._binset)
+
+        cls._stripped["binaries"] = Strip.StripFiles(binaries, "binaries")
+        cls._stripped["libraries"] = Strip.StripFiles(libraries, "libraries")
+
+        for category in ("binaries", "libraries", "modules"):
+            totals = cls._stripped.get(category)
+
+            if not totals or not totals["files"]:
+                continue
+
+            message = "Stripped {0} of {1} {2}, saved {3} KiB ({4} KiB -> {5} KiB)".format(
+                totals["stripped"], totals["files"], category, (totals["before"] - totals["after"]) // 1024,
+                totals["before"] // 1024, totals["after"] // 1024)
+
+            if totals["signed"]:
+                message += ", " + str(totals["signed"]) + " signed modules kept as they are"
+
+            Tools.Flag(message)
+
+            if totals["failed"]:
+                Tools.Warn("Unable to strip " + str(totals["failed"]) + " " + category + ", they were kept as they are")
+
+        Metrics.Note("strip", cls._stripped)
@@ -0,0 +1,328 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import hashlib
+import os
+import stat
+
+# Writes a cpio archive in the "newc" format (the format the kernel expects
+# for an initramfs) directly into a stream. File data is copied in chunks so
+# memory usage stays bounded no matter how large the files are.
+class Cpio(object):
+    # Magic number for the "newc" format
+    _magic = b"070701"
+
+    # Name of the entry that terminates the archive
+    _trailer = "TRAILER!!!"
+
+    # Amount of file data that is read and written at a time
+    _chunk_size = 1024 * 1024
+
+    def __init__(self, vStream):
+        self._stream = vStream
+        self._length = 0
+        self._inode = 0
+        self._written = set()
+
+    # Returns true if an entry with this name was already written
+    def Contains(self, vName):
+        return vName in self._written
+
+    # Writes raw bytes into the stream
+    def Write(self, vData):
+        self._stream.write(vData)
+        self._length += len(vData)
+
+    # Writes the given bytes and pads the stream to a 4 byte boundary
+    def WritePadded(self, vData, vLength):
+        self.Write(vData)
+        self.WritePadding(vLength)
+
+    # Pads the stream to a 4 byte boundary after writing 'vLength' bytes
+    def WritePadding(self, vLength):
+        padding = (4 - vLength % 4) % 4
+
+        if padding:
+            self.Write(b"\0" * padding)
+
+    # Writes an entry header (and its name)
+    def WriteHeader(self, vName, vMode, vSize, vUid=0, vGid=0, vMtime=0, vRdev=(0, 0), vNlink=1):
+        self._inode += 1
+
+        name = vName.encode() + b"\0"
+        fields = (self._inode, vMode, vUid, vGid, vNlink, int(vMtime), vSize, 0, 0, vRdev[0], vRdev[1], len(name), 0)
+
+        header = self._magic + "".join("{0:08X}".format(f) for f in fields).encode()
+
+        self.WritePadded(header + name, len(header) + len(name))
+
+    # Adds an entry that doesn't need to exist on disk (devices, generated files, links)
+    def AddEntry(self, vName, vMode, vData=b"", vRdev=(0, 0), vUid=0, vGid=0, vMtime=0):
+        if vName in self._written:
+            return
+
+        self._written.add(vName)
+
+        nlink = 2 if stat.S_ISDIR(vMode) else 1
+
+        self.WriteHeader(vName, vMode, len(vData), vUid, vGid, vMtime, vRdev, nlink)
+        self.WritePadded(vData, len(vData))
+
+    # Adds a directory entry
+    def AddDirectory(self, vName, vMode=0o755):
+        self.AddEntry(vName, stat.S_IFDIR | vMode)
+
+    # Adds a symbolic link
+    def AddSymlink(self, vName, vTarget):
+        self.AddEntry(vName, stat.S_IFLNK | 0o777, vTarget.encode())
+
+    # Adds a file with the given contents
+    def AddData(self, vName, vData, vMode=0o644):
+        self.AddEntry(vName, stat.S_IFREG | vMode, vData)
+
+    # Adds a character or block device node
+    def AddDevice(self, vName, vMode, vMajor, vMinor):
+        self.AddEntry(vName, vMode, vRdev=(vMajor, vMinor))
+
+    # Adds an entry for a path on disk using its own metadata
+    def AddPath(self, vName, vPath, vStat=None):
+        if vName in self._written:
+            return
+
+        st = vStat or os.lstat(vPath)
+
+        if stat.S_ISREG(st.st_mode):
+            self.AddFile(vName, vPath)
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(vPath).encode()
+            self.AddEntry(vName, st.st_mode, target, (0, 0), st.st_uid, st.st_gid, st.st_mtime)
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            rdev = (os.major(st.st_rdev), os.minor(st.st_rdev))
+            self.AddEntry(vName, st.st_mode, b"", rdev, st.st_uid, st.st_gid, st.st_mtime)
+        else:
+            self.AddEntry(vName, st.st_mode, b"", (0, 0), st.st_uid, st.st_gid, st.st_mtime)
+
+    # Streams a regular file into the archive
+    def AddFile(self, vName, vPath):
+        with open(vPath, "rb") as source:
+            st = os.fstat(source.fileno())
+            size = st.st_size
+
+            self._written.add(vName)
+            self.WriteHeader(vName, st.st_mode, size, st.st_uid, st.st_gid, st.st_mtime)
+
+            remaining = size
+
+            while remaining:
+                chunk = source.read(min(remaining, self._chunk_size))
+
+                if not chunk:
+                    break
+
+                self.Write(chunk)
+                remaining -= len(chunk)
+
+            # If the file shrunk while we were reading it, keep the
+            # archive consistent with the size in the header.
+            if remaining:
+                self.Write(b"\0" * remaining)
+
+            self.WritePadding(size)
+
+    # Adds a directory tree (including the root as ".") in a single walk
+    def AddTree(self, vRoot, vPrefix="", vExclude=()):
+        for name, path, st in self.Walk(vRoot, vPrefix, vExclude):
+            self.AddPath(name, path, st)
+
+    # Returns the entries of a directory tree in the order they are written:
+    # (name in the archive, path on disk, lstat result). Names in 'vExclude'
+    # (and everything below them) are skipped.
+    @classmethod
+    def Walk(cls, vRoot, vPrefix="", vExclude=()):
+        if not vPrefix:
+            yield ".", vRoot, os.lstat(vRoot)
+
+        with os.scandir(vRoot) as iterator:
+            entries = sorted(iterator, key=lambda e: e.name)
+
+        for entry in entries:
+            name = vPrefix + entry.name
+
+            if name in vExclude:
+                continue
+
+            st = entry.stat(follow_symlinks=False)
+
+            yield name, entry.path, st
+
+            if stat.S_ISDIR(st.st_mode):
+                yield from cls.Walk(entry.path, name + "/", vExclude)
+
+    # Writes the trailer and pads the archive to a 512 byte block
+    def Close(self):
+        self.WriteHeader(self._trailer, 0, 0, vNlink=1)
+
+        self.Write(b"\0" * ((512 - self._length % 512) % 512))
+
+    # Returns the amount of uncompressed bytes written so far
+    def GetLength(self):
+        return self._length
+
+# Parses "newc" cpio archives that are fed in chunks (i.e straight out of a
+# decompressor) without writing anything to disk or keeping the file data
+# in memory. Archives that follow each other (with zero padding in between)
+# are parsed as one. Every entry is recorded with its size in the archive
+# and its estimated share of the compressed data.
+class CpioReader(object):
+    # Magic numbers of the "newc" format (without and with checksums)
+    _magics = (b"070701", b"070702")
+
+    # Length of an entry header
+    _header_length = 110
+
+    # Name of the entry that terminates an archive
+    _trailer = "TRAILER!!!"
+
+    def __init__(self):
+        # Parsed entries: name, mode, size, raw (bytes in the archive),
+        # compressed (estimated), digest (files), target (symlinks), segment
+        self.entries = []
+
+        # Segment that the entries being parsed belong to
+        self.segment = 0
+
+        self._state = "header"
+        self._needed = self._header_length
+        self._buffer = bytearray()
+        self._fields = None
+        self._entry = None
+        self._remaining = 0
+        self._data_left = 0
+        self._digest = None
+        self._target = b""
+
+    # Returns true if the reader stopped in the middle of an entry
+    def IsTruncated(self):
+        return self._state != "header" or bool(self._buffer)
+
+    # Parses a chunk of the archive. 'vCost' is the amount of compressed
+    # bytes that every byte of the chunk took. If 'vStopAtTrailer' is set,
+    # parsing stops after the trailer of an archive. Returns the amount of
+    # bytes parsed and whether a trailer was reached.
+    def Feed(self, vData, vCost=1.0, vStopAtTrailer=False):
+        data = memoryview(vData)
+        position = 0
+
+        while position < len(data):
+            if self._state == "data":
+                take = min(self._remaining, len(data) - position)
+                self.AddData(data[position:position + take], vCost)
+                position += take
+                continue
+
+            # Zero padding between archives
+            if self._state == "header" and not self._buffer:
+                while position < len(data) and data[position] == 0:
+                    position += 1
+
+                if position == len(data):
+                    break
+
+            take = min(self._needed - len(self._buffer), len(data) - position)
+            self._buffer += data[position:position + take]
+            position += take
+
+            if len(self._buffer) < self._needed:
+                break
+
+            if self._state == "header":
+                self.ParseHeader()
+            elif self.ParseName(vCost) and vStopAtTrailer:
+                return position, True
+
+        return position, False
+
+    # Parses an entry header
+    def ParseHeader(self):
+        header = bytes(self._buffer)
+
+        if header[:6] not in self._magics:
+            raise ValueError("Invalid cpio header")
+
+        self._fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+
+        # The name is padded so that the data starts on a 4 byte boundary
+        namesize = self._fields[11]
+        self._needed = namesize + (4 - (self._header_length + namesize) % 4) % 4
+        self._state = "name"
+        self._buffer = bytearray()
+
+    # Parses the name of an entry and starts reading its data. Returns
+    # true if the entry is the trailer of an archive.
+    def ParseName(self, vCost):
+        name = bytes(self._buffer[:self._fields[11]]).rstrip(b"\0").decode(errors="surrogateescape")
+        size = self._fields[6]
+        length = self._header_length + len(self._buffer)
+
+        self._buffer = bytearray()
+        self._state = "header"
+        self._needed = self._header_length
+
+        if name == self._trailer:
+            return True
+
+        if name.startswith("./"):
+            name = name[2:]
+
+        mode = self._fields[1]
+
+        self._entry = {
+            "name": name,
+            "mode": mode,
+            "size": size,
+            "raw": length,
+            "compressed": length * vCost,
+            "digest": None,
+            "target": None,
+            "segment": self.segment,
+        }
+
+        self._data_left = size
+        self._remaining = size + (4 - size % 4) % 4
+        self._digest = hashlib.sha256() if stat.S_ISREG(mode) else None
+        self._target = b""
+
+        if self._remaining:
+            self._state = "data"
+        else:
+            self.FinishEntry()
+
+        return False
+
+    # Adds a chunk of the data (and padding) of the current entry
+    def AddData(self, vChunk, vCost):
+        data = vChunk[:self._data_left]
+        self._data_left -= len(data)
+
+        if self._digest:
+            self._digest.update(data)
+        elif stat.S_ISLNK(self._entry["mode"]):
+            self._target += bytes(data)
+
+        self._entry["raw"] += len(vChunk)
+        self._entry["compressed"] += len(vChunk) * vCost
+        self._remaining -= len(vChunk)
+
+        if not self._remaining:
+            self._state = "header"
+            self.FinishEntry()
+
+    # Records the entry that was just read
+    def FinishEntry(self):
+        if self._digest:
+            self._entry["digest"] = self._digest.hexdigest()
+        elif stat.S_ISLNK(self._entry["mode"]):
+            self._entry["target"] = self._target.decode(errors="surrogateescape")
+
+        self.entries.append(self._entry)
+        self._entry = None
@@ -0,0 +1,565 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import glob
+import hashlib
+import json
+import os
+import struct
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Tools import Tools
+
+# Reads the dynamic linking information straight out of ELF files and
+# resolves the libraries that they need the same way that ld.so would.
+# This replaces the 'file' and 'ldd' pipelines that were used before.
+class Elf(object):
+    # ELF identification
+    _magic = b"\x7fELF"
+
+    # Program header types
+    _pt_load = 1
+    _pt_dynamic = 2
+    _pt_interp = 3
+
+    # Dynamic section tags
+    _dt_null = 0
+    _dt_needed = 1
+    _dt_strtab = 5
+    _dt_soname = 14
+    _dt_rpath = 15
+    _dt_runpath = 29
+
+    # Parsed ELF information, keyed by path
+    _cache = {}
+
+    # Set to true when new entries were parsed and the cache needs to be written
+    _dirty = False
+
+    # Set to true once the on-disk cache has been loaded
+    _loaded = False
+
+    # The library directories listed in /etc/ld.so.conf (Lazily loaded)
+    _conf_dirs = None
+
+    # Previously resolved libraries, keyed by the name and the search path used
+    _resolved = {}
+
+    # Loads the persistent cache of parsed ELF files
+    @classmethod
+    def LoadCache(cls):
+        cls._loaded = True
+
+        try:
+            with open(var.elfCache, "r") as cache:
+                cls._cache = json.load(cache)
+        except (OSError, ValueError):
+            cls._cache = {}
+
+    # Writes the parsed ELF information back to disk so that the next
+    # build doesn't need to parse unchanged files again
+    @classmethod
+    def SaveCache(cls):
+        if not cls._dirty:
+            return
+
+        try:
+            os.makedirs(var.cacheDirectory, exist_ok=True)
+
+            tempCache = var.elfCache + "." + str(os.getpid())
+
+            with open(tempCache, "w") as cache:
+                json.dump(cls._cache, cache)
+
+            os.replace(tempCache, var.elfCache)
+            cls._dirty = False
+        except OSError:
+            Tools.Warn("Unable to write the ELF cache to " + var.elfCache)
+
+    # Returns the dynamic linking information for a file or None if the file
+    # isn't an ELF file. The information is served from the cache when the
+    # file hasn't changed since it was last parsed.
+    @classmethod
+    def GetInfo(cls, vFile):
+        if not cls._loaded:
+            cls.LoadCache()
+
+        try:
+            key = Tools.GetFileKey(vFile)
+        except OSError:
+            return None
+
+        cached = cls._cache.get(vFile)
+
+        if cached and cached["key"] == key:
+            return cached["info"]
+
+        info = cls.Parse(vFile)
+
+        cls._cache[vFile] = {"key": key, "info": info}
+        cls._dirty = True
+
+        return info
+
+    # Checks to see if a file is an ELF executable or shared object
+    @classmethod
+    def IsElf(cls, vFile):
+        return cls.GetInfo(vFile) is not None
+
+    # Parses the ELF headers of a file and returns its dynamic linking information
+    @classmethod
+    def Parse(cls, vFile):
+        try:
+            with open(vFile, "rb") as elf:
+                return cls.ParseStream(elf)
+        except (OSError, struct.error, ValueError):
+            return None
+
+    # Parses an opened ELF file. Only the headers, the interpreter and the
+    # dynamic segment are read, so large files are never read completely.
+    @classmethod
+    def ParseStream(cls, vStream):
+        ident = vStream.read(16)
+
+        if len(ident) < 16 or ident[:4] != cls._magic:
+            return None
+
+        elfClass = ident[4]
+        order = "<" if ident[5] == 1 else ">"
+
+        if elfClass == 2:
+            header = struct.unpack(order + "HHIQQQIHHHHHH", vStream.read(48))
+            phFormat = order + "IIQQQQQQ"
+            dynFormat = order + "qQ"
+        elif elfClass == 1:
+            header = struct.unpack(order + "HHIIIIIHHHHHH", vStream.read(36))
+            phFormat = order + "IIIIIIII"
+            dynFormat = order + "iI"
+        else:
+            return None
+
+        eType, eMachine = header[0], header[1]
+        phOffset, phEntrySize, phCount = header[4], header[8], header[9]
+
+        info = {
+            "class": elfClass,
+            "machine": eMachine,
+            "type": eType,
+            "interp": None,
+            "needed": [],
+            "rpath": [],
+            "runpath": [],
+            "soname": None,
+        }
+
+        # Read the program headers
+        segments = []
+        vStream.seek(phOffset)
+        table = vStream.read(phEntrySize * phCount)
+
+        for i in range(phCount):
+            entry = struct.unpack_from(phFormat, table, i * phEntrySize)
+
+            # The 32 bit layout has the flags in a different position
+            if elfClass == 2:
+                pType, pOffset, pVaddr, pFilesz = entry[0], entry[2], entry[3], entry[5]
+            else:
+                pType, pOffset, pVaddr, pFilesz = entry[0], entry[1], entry[2], entry[4]
+
+            segments.append((pType, pOffset, pVaddr, pFilesz))
+
+        dynamic = None
+
+        for pType, pOffset, pVaddr, pFilesz in segments:
+            if pType == cls._pt_interp:
+                vStream.seek(pOffset)
+                info["interp"] = os.fsdecode(vStream.read(pFilesz).split(b"\0")[0])
+            elif pType == cls._pt_dynamic:
+                dynamic = (pOffset, pFilesz)
+
+        if not dynamic:
+            return info
+
+        # Read the dynamic section entries
+        vStream.seek(dynamic[0])
+        data = vStream.read(dynamic[1])
+        entrySize = struct.calcsize(dynFormat)
+
+        entries = []
+        strtab = None
+
+        for offset in range(0, len(data) - entrySize + 1, entrySize):
+            tag, value = struct.unpack_from(dynFormat, data, offset)
+
+            if tag == cls._dt_null:
+                break
+            elif tag == cls._dt_strtab:
+                strtab = value
+            else:
+                entries.append((tag, value))
+
+        if strtab is None:
+            return info
+
+        # DT_STRTAB holds a virtual address, translate it to a file offset
+        strtabOffset = None
+
+        for pType, pOffset, pVaddr, pFilesz in segments:
+            if pType == cls._pt_load and pVaddr <= strtab < pVaddr + pFilesz:
+                strtabOffset = strtab - pVaddr + pOffset
+                break
+
+        if strtabOffset is None:
+            return info
+
+        for tag, value in entries:
+            if tag == cls._dt_needed:
+                info["needed"].append(cls.ReadString(vStream, strtabOffset + value))
+            elif tag == cls._dt_soname:
+                info["soname"] = cls.ReadString(vStream, strtabOffset + value)
+            elif tag == cls._dt_rpath:
+                info["rpath"] = cls.ReadString(vStream, strtabOffset + value).split(":")
+            elif tag == cls._dt_runpath:
+                info["runpath"] = cls.ReadString(vStream, strtabOffset + value).split(":")
+
+        return info
+
+    # Returns the content of a section (i.e .modinfo) of an ELF file that is
+    # already in memory, or None if the file doesn't have that section
+    @classmethod
+    def GetSection(cls, vData, vName):
+        if vData[:4] != cls._magic:
+            return None
+
+        order = "<" if vData[5] == 1 else ">"
+
+        try:
+            if vData[4] == 2:
+                header = struct.unpack_from(order + "HHIQQQIHHHHHH", vData, 16)
+                shFormat = order + "IIQQQQIIQQ"
+            elif vData[4] == 1:
+                header = struct.unpack_from(order + "HHIIIIIHHHHHH", vData, 16)
+                shFormat = order + "IIIIIIIIII"
+            else:
+                return None
+
+            shOffset, shEntrySize, shCount, shStringIndex = header[5], header[10], header[11], header[12]
+
+            sections = []
+
+            for i in range(shCount):
+                entry = struct.unpack_from(shFormat, vData, shOffset + i * shEntrySize)
+                sections.append((entry[0], entry[4], entry[5]))
+
+            names = sections[shStringIndex]
+
+            for nameOffset, offset, size in sections:
+                start = names[1] + nameOffset
+                end = vData.index(b"\0", start)
+
+                if vData[start:end].decode() == vName:
+                    return vData[offset:offset + size]
+        except (struct.error, IndexError, ValueError):
+            return None
+
+        return None
+
+    # Returns a digest of what the loader maps from an ELF file: the address,
+    # sizes and flags of every loadable segment and the bytes that it maps.
+    # Files that only differ in sections that aren't loaded (debug information,
+    # symbol tables, etc) have the same digest. The location of the section
+    # headers in the ELF header (which is usually mapped too) is ignored since
+    # the loader doesn't use it. Returns None if the file isn't an ELF file.
+    @classmethod
+    def GetLoadDigest(cls, vFile):
+        digest = hashlib.sha256()
+
+        try:
+            with open(vFile, "rb") as elf:
+                ident = elf.read(16)
+
+                if len(ident) < 16 or ident[:4] != cls._magic:
+                    return None
+
+                order = "<" if ident[5] == 1 else ">"
+
+                # Offsets of e_shoff and of e_shentsize, e_shnum and e_shstrndx
+                if ident[4] == 2:
+                    header = struct.unpack(order + "HHIQQQIHHHHHH", elf.read(48))
+                    phFormat = order + "IIQQQQQQ"
+                    masked = [(0x28, 0x30), (0x3a, 0x40)]
+                elif ident[4] == 1:
+                    header = struct.unpack(order + "HHIIIIIHHHHHH", elf.read(36))
+                    phFormat = order + "IIIIIIII"
+                    masked = [(0x20, 0x24), (0x2e, 0x34)]
+                else:
+                    return None
+
+                phOffset, phEntrySize, phCount = header[4], header[8], header[9]
+
+                elf.seek(phOffset)
+                table = elf.read(phEntrySize * phCount)
+
+                for i in range(phCount):
+                    entry = struct.unpack_from(phFormat, table, i * phEntrySize)
+
+                    if ident[4] == 2:
+                        pType, pFlags, pOffset, pVaddr, pFilesz, pMemsz = entry[0], entry[1], entry[2], entry[3], entry[5], entry[6]
+                    else:
+                        pType, pOffset, pVaddr, pFilesz, pMemsz, pFlags = entry[0], entry[1], entry[2], entry[4], entry[5], entry[6]
+
+                    if pType != cls._pt_load:
+                        continue
+
+                    elf.seek(pOffset)
+                    data = bytearray(elf.read(pFilesz))
+
+                    for start, end in masked:
+                        if pOffset < end:
+                            data[max(0, start - pOffset):end - pOffset] = bytes(end - max(start, pOffset))
+
+                    digest.update(struct.pack("<QQQI", pVaddr, pFilesz, pMemsz, pFlags))
+                    digest.update(data)
+        except (OSError, struct.error, ValueError):
+            return None
+
+        return digest.hexdigest()
+
+    # Reads a null terminated string at the given file offset
+    @classmethod
+    def ReadString(cls, vStream, vOffset):
+        vStream.seek(vOffset)
+
+        value = b""
+
+        while True:
+            chunk = vStream.read(64)
+
+            if not chunk:
+                break
+
+            end = chunk.find(b"\0")
+
+            if end != -1:
+                value += chunk[:end]
+                break
+
+            value += chunk
+
+        # Names are bytes, like file names (they don't have to be valid UTF-8)
+        return os.fsdecode(value)
+
+    # Returns the library directories listed in /etc/ld.so.conf (and its includes)
+    @classmethod
+    def GetConfiguredDirectories(cls):
+        if cls._conf_dirs is None:
+            cls._conf_dirs = []
+            cls.ReadLdConf("/etc/ld.so.conf", set())
+
+        return cls._conf_dirs
+
+    # Reads an ld.so.conf style file
+    @classmethod
+    def ReadLdConf(cls, vFile, vSeen):
+        if vFile in vSeen:
+            return
+
+        vSeen.add(vFile)
+
+        try:
+            with open(vFile, "r") as conf:
+                lines = conf.read().splitlines()
+        except OSError:
+            return
+
+        for line in lines:
+            line = line.split("#")[0].strip()
+
+            if not line:
+                continue
+
+            if line.startswith("include"):
+                for pattern in line.split()[1:]:
+                    if not pattern.startswith("/"):
+                        pattern = os.path.join(os.path.dirname(vFile), pattern)
+
+                    for include in sorted(glob.glob(pattern)):
+                        cls.ReadLdConf(include, vSeen)
+            elif line not in cls._conf_dirs:
+                cls._conf_dirs.append(line)
+
+    # Returns the default library directories for an ELF class
+    @classmethod
+    def GetDefaultDirectories(cls, vClass):
+        if vClass == 2:
+            return [var.lib64, "/usr/lib64", var.lib, "/usr/lib"]
+        else:
+            return [var.lib, "/usr/lib", "/lib32", "/usr/lib32"]
+
+    # Expands the dynamic string tokens used in RPATH/RUNPATH entries
+    @classmethod
+    def ExpandPath(cls, vPath, vOrigin, vClass):
+        lib = "lib64" if vClass == 2 else "lib"
+
+        for token, value in (("ORIGIN", vOrigin), ("LIB", lib), ("PLATFORM", var.arch)):
+            vPath = vPath.replace("${" + token + "}", value).replace("$" + token, value)
+
+        return vPath
+
+    # Returns the directories from the RPATH/RUNPATH entries of an object
+    # (and of the executable) that are searched for its libraries
+    @classmethod
+    def GetSearchDirectories(cls, vInfo, vExecutableInfo, vOrigin):
+        directories = []
+
+        # DT_RPATH is only used when the object doesn't have a DT_RUNPATH
+        if not vInfo["runpath"]:
+            directories += vInfo["rpath"]
+
+            if vExecutableInfo and not vExecutableInfo["runpath"]:
+                directories += vExecutableInfo["rpath"]
+
+        directories += vInfo["runpath"]
+
+        return [cls.ExpandPath(d, vOrigin, vInfo["class"]) for d in directories if d]
+
+    # Finds the library that the dynamic linker would load for a DT_NEEDED
+    # entry of the object described by 'vInfo' (located at 'vFile').
+    @classmethod
+    def FindLibrary(cls, vName, vFile, vInfo, vExecutableInfo):
+        origin = os.path.dirname(os.path.realpath(vFile))
+
+        # A name with a slash is used as is
+        if "/" in vName:
+            candidates = [cls.ExpandPath(vName, origin, vInfo["class"])]
+        else:
+            directories = cls.GetSearchDirectories(vInfo, vExecutableInfo, origin)
+            directories += cls.GetConfiguredDirectories()
+            directories += cls.GetDefaultDirectories(vInfo["class"])
+
+            candidates = [os.path.join(d, vName) for d in directories]
+
+        key = (vName, vInfo["class"], vInfo["machine"]) + tuple(candidates)
+
+        if key not in cls._resolved:
+            cls._resolved[key] = cls.FindCompatible(candidates, vInfo)
+
+        return cls._resolved[key]
+
+    # Returns the first candidate that is an ELF file compatible with the object
+    @classmethod
+    def FindCompatible(cls, vCandidates, vInfo):
+        for candidate in vCandidates:
+            if not os.path.isfile(candidate):
+                continue
+
+            # Skip libraries built for a different architecture (i.e 32 bit
+            # libraries that share a name with the 64 bit ones)
+            libInfo = cls.GetInfo(candidate)
+
+            if libInfo and libInfo["class"] == vInfo["class"] and libInfo["machine"] == vInfo["machine"]:
+                return os.path.normpath(candidate)
+
+        return None
+
+    # Returns the set of interpreters and libraries required by the binaries,
+    # including the libraries that those libraries need.
+    @classmethod
+    def GetDependencies(cls, vBinaries):
+        return cls.Resolve(vBinaries)[0]
+
+    # Resolves the libraries of the binaries. Returns the set of interpreters
+    # and libraries, and every DT_NEEDED entry that was resolved: (object,
+    # its information, the executable's information, needed name, library).
+    @classmethod
+    def Resolve(cls, vBinaries):
+        dependencies = set()
+        references = []
+
+        for binary in vBinaries:
+            info = cls.GetInfo(binary)
+
+            if not info:
+                continue
+
+            if info["interp"]:
+                dependencies.add(info["interp"])
+
+            # Walk the needed libraries breadth first like the dynamic linker does
+            pending = [(binary, info)]
+            seen = set([binary])
+
+            while pending:
+                current, currentInfo = pending.pop(0)
+
+                for needed in currentInfo["needed"]:
+                    library = cls.FindLibrary(needed, current, currentInfo, info)
+
+                    if not library:
+                        Tools.Warn("Unable to find " + needed + " (needed by " + current + ")")
+                        continue
+
+                    references.append((current, currentInfo, info, needed, library))
+
+                    if library in seen:
+                        continue
+
+                    seen.add(library)
+                    dependencies.add(library)
+                    pending.append((library, cls.GetInfo(library)))
+
+        cls.SaveCache()
+
+        return dependencies, references
+
+    # Returns how the libraries of the binaries are laid out in the
+    # initramfs: the files that are copied (each library once, even if it
+    # was found through several paths) and the symlinks (path -> target)
+    # that the dynamic linker needs. The initramfs has no ld.so.cache, so a
+    # library that the host found through ld.so.conf is linked into the
+    # default directory under the name that references it.
+    @classmethod
+    def GetLayout(cls, vBinaries):
+        dependencies, references = cls.Resolve(vBinaries)
+        files = []
+        links = {}
+        placed = {}
+
+        for library in sorted(dependencies):
+            real = os.path.realpath(library)
+
+            if real in placed:
+                links[library] = placed[real]
+            else:
+                placed[real] = library
+                files.append(library)
+
+        present = set(files) | set(vBinaries)
+
+        for current, info, executableInfo, needed, library in references:
+            if "/" in needed:
+                continue
+
+            # Inside the initramfs the object is a plain file at its own path
+            directories = cls.GetSearchDirectories(info, executableInfo, os.path.dirname(current))
+            directories += cls.GetDefaultDirectories(info["class"])
+
+            found = None
+
+            for directory in directories:
+                candidate = os.path.normpath(os.path.join(directory, needed))
+
+                if candidate in present or candidate in links:
+                    found = candidate
+                    break
+
+            if found:
+                if os.path.realpath(links.get(found, found)) != os.path.realpath(library):
+                    Tools.Warn("The dynamic linker will load " + found + " instead of " + library + " (needed by " + current + ")")
+
+                continue
+
+            links[os.path.join(cls.GetDefaultDirectories(info["class"])[0], needed)] = library
+
+        return files, links
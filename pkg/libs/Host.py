@@ -0,0 +1,232 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import os
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Tools import Tools
+from pkg.libs.ModuleIndex import ModuleIndex
+
+# Detects the kernel modules that this machine needs to boot (host-only
+# mode). Only the devices that are part of the boot path are looked at:
+# the block devices under the root filesystem (following device mapper and
+# md slaves, and the vdevs in the zpool.cache or every disk when the root
+# is on ZFS) and, when LUKS needs a passphrase, the input devices. The
+# modalias of every one of these devices and of their parents (controllers,
+# buses) is matched against modules.alias, and the drivers that are bound
+# to them are added as well.
+class Host(object):
+    # Device mapper targets (uuid prefix) and the module that provides them
+    _dm_targets = {
+        "CRYPT-": "dm_crypt",
+        "LVM-": "dm_mod",
+        "mpath-": "dm_multipath",
+    }
+
+    # md levels and the module that provides them
+    _md_levels = {
+        "linear": "linear",
+        "raid0": "raid0",
+        "raid1": "raid1",
+        "raid4": "raid456",
+        "raid5": "raid456",
+        "raid6": "raid456",
+        "raid10": "raid10",
+    }
+
+    # Returns the path of a file in the sysfs tree
+    @classmethod
+    def GetSysfsPath(cls, *vParts):
+        return os.path.join(var.sysfsRoot, *vParts)
+
+    # Reads a small text file, returns an empty string if it can't be read
+    @classmethod
+    def ReadValue(cls, vPath):
+        try:
+            with open(vPath, "r") as value:
+                return value.read().strip()
+        except OSError:
+            return ""
+
+    # Returns the source and filesystem type of the root mount
+    @classmethod
+    def GetRootMount(cls):
+        root = None
+
+        try:
+            with open(os.path.join(var.procRoot, "mounts"), "r") as mounts:
+                for line in mounts:
+                    fields = line.split()
+
+                    # The last mount on / is the one that is visible
+                    if len(fields) >= 3 and fields[1] == "/" and fields[2] != "rootfs":
+                        root = (fields[0], fields[2])
+        except OSError:
+            Tools.Fail("Unable to read the mounts from " + var.procRoot + "!")
+
+        if not root:
+            Tools.Fail("Unable to find the root filesystem in " + var.procRoot + "/mounts!")
+
+        return root
+
+    # Returns the sysfs directory of a block device (i.e /dev/sda2, /dev/mapper/root)
+    @classmethod
+    def GetBlockDirectory(cls, vDevice):
+        name = os.path.basename(os.path.realpath(vDevice) if os.path.exists(vDevice) else vDevice)
+        path = cls.GetSysfsPath("class", "block", name)
+
+        if os.path.exists(path):
+            return os.path.realpath(path)
+
+        return None
+
+    # Returns the sysfs directory of the block device under the root. The
+    # device number of / is used when the trees are the ones of this
+    # machine, since the source in the mounts might not be a block device
+    # name (i.e /dev/root when booted without an initramfs).
+    @classmethod
+    def GetRootDirectory(cls, vSource):
+        if var.procRoot == "/proc" and var.sysfsRoot == "/sys":
+            device = os.stat("/").st_dev
+            path = cls.GetSysfsPath("dev", "block", str(os.major(device)) + ":" + str(os.minor(device)))
+
+            if os.path.exists(path):
+                return os.path.realpath(path)
+
+        return cls.GetBlockDirectory(vSource)
+
+    # Collects the modules for a device and all its parents, up to /sys/devices
+    @classmethod
+    def CollectDevice(cls, vDirectory, vAliases, vModules):
+        top = os.path.realpath(cls.GetSysfsPath("devices"))
+        directory = os.path.realpath(vDirectory)
+
+        while directory.startswith(top + os.sep):
+            modalias = cls.ReadValue(os.path.join(directory, "modalias"))
+
+            if modalias:
+                vAliases.add(modalias)
+
+            # The driver that is bound to the device right now
+            module = os.path.join(directory, "driver", "module")
+
+            if os.path.islink(module):
+                vModules.add(ModuleIndex.Normalize(os.path.basename(os.readlink(module))))
+
+            directory = os.path.dirname(directory)
+
+    # Collects the modules for a block device and the devices it is built on
+    @classmethod
+    def CollectBlockDevice(cls, vDirectory, vAliases, vModules, vSeen):
+        if not vDirectory or vDirectory in vSeen:
+            return
+
+        vSeen.add(vDirectory)
+
+        cls.CollectDevice(vDirectory, vAliases, vModules)
+
+        # Device mapper (dm-crypt, LVM, multipath) and md devices
+        uuid = cls.ReadValue(os.path.join(vDirectory, "dm", "uuid"))
+
+        if os.path.isdir(os.path.join(vDirectory, "dm")):
+            vModules.add("dm_mod")
+
+            for prefix, module in cls._dm_targets.items():
+                if uuid.startswith(prefix):
+                    vModules.add(module)
+
+        level = cls.ReadValue(os.path.join(vDirectory, "md", "level"))
+
+        if level:
+            vModules.add("md_mod")
+
+            if level in cls._md_levels:
+                vModules.add(cls._md_levels[level])
+
+        # The devices this one is built on
+        slaves = os.path.join(vDirectory, "slaves")
+
+        if os.path.isdir(slaves):
+            for slave in sorted(os.listdir(slaves)):
+                cls.CollectBlockDevice(os.path.realpath(os.path.join(slaves, slave)), vAliases, vModules, vSeen)
+
+    # Returns the sysfs directories of the physical disks and partitions
+    # (loop, dm, md, zram, etc devices live under /sys/devices/virtual)
+    @classmethod
+    def GetPhysicalBlockDevices(cls):
+        directory = cls.GetSysfsPath("class", "block")
+        virtual = os.path.realpath(cls.GetSysfsPath("devices", "virtual")) + os.sep
+        devices = []
+
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                path = os.path.realpath(os.path.join(directory, name))
+
+                if not path.startswith(virtual):
+                    devices.append(path)
+
+        return devices
+
+    # Returns the modules that the devices in the boot path need. The
+    # devices of the pools (from the zpool.cache) narrow down the disks
+    # that are looked at when the root is on ZFS.
+    @classmethod
+    def Detect(cls, vUseZfs, vUseLuks, vZfsDevices=None):
+        aliases = set()
+        modules = set()
+        seen = set()
+
+        source, fstype = cls.GetRootMount()
+
+        # The filesystem of the root (zfs is added by its own hook)
+        if fstype != "zfs":
+            modules.add(fstype)
+
+        if fstype == "zfs" or vUseZfs:
+            vdevs = [cls.GetBlockDirectory(device) for device in vZfsDevices or []]
+
+            # The vdevs of a pool aren't visible in sysfs, so without the
+            # zpool.cache every disk that could be one is included
+            if vdevs and all(vdevs):
+                for device in vdevs:
+                    cls.CollectBlockDevice(device, aliases, modules, seen)
+            else:
+                for device in cls.GetPhysicalBlockDevices():
+                    cls.CollectBlockDevice(device, aliases, modules, seen)
+        else:
+            directory = cls.GetRootDirectory(source)
+
+            if directory:
+                cls.CollectBlockDevice(directory, aliases, modules, seen)
+            else:
+                Tools.Warn("Unable to find the block device of the root filesystem (" + source + "). "
+                           "Looking at every disk instead ...")
+
+                for device in cls.GetPhysicalBlockDevices():
+                    cls.CollectBlockDevice(device, aliases, modules, seen)
+
+        if vUseLuks:
+            modules.add("dm_crypt")
+
+            # A keyboard is needed to type the passphrase
+            inputs = cls.GetSysfsPath("class", "input")
+
+            if os.path.isdir(inputs):
+                for name in sorted(os.listdir(inputs)):
+                    cls.CollectDevice(os.path.join(inputs, name), aliases, modules)
+
+        for alias in aliases:
+            modules.update(ModuleIndex.FindAlias(alias))
+
+        # Only the modules that exist as loadable modules are needed,
+        # anything else is built into the kernel
+        selected = set()
+
+        for module in modules:
+            name = ModuleIndex.Resolve(module) or ModuleIndex.Resolve("fs-" + module)
+
+            if name:
+                selected.add(name)
+
+        return sorted(selected)
@@ -0,0 +1,367 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import json
+import re
+import stat
+
+from pkg.libs.Tools import Tools
+from pkg.libs.Cpio import CpioReader
+from pkg.libs.Compression import Compression
+
+# Reads an existing initramfs (every segment, compressed or not) as a
+# stream, without unpacking it to disk, and reports what takes up its
+# space: the size of every directory subtree before and after compression,
+# the largest files and the files with the same content. Two images can
+# also be compared.
+class Inspector(object):
+    # Amount of the image that is read (and decompressed) at a time. Smaller
+    # chunks attribute the compressed size to the entries more precisely.
+    _chunk_size = 64 * 1024
+
+    # Kernel version in the path of the modules. It is replaced when two
+    # images are compared, so the images of different kernels can be compared.
+    _modules_directory = re.compile(r"^lib/modules/[^/]+")
+
+    # Reads an image and returns its segments and entries
+    @classmethod
+    def Read(cls, vPath):
+        reader = CpioReader()
+        segments = []
+        offset = 0
+
+        try:
+            with open(vPath, "rb") as image:
+                data = image.read(cls._chunk_size)
+
+                while True:
+                    # Segments are padded with zeros
+                    stripped = data.lstrip(b"\0")
+                    offset += len(data) - len(stripped)
+                    data = stripped
+
+                    if len(data) < 8:
+                        more = image.read(cls._chunk_size)
+
+                        if more:
+                            data += more
+                            continue
+
+                        if not data:
+                            break
+
+                    codec = Compression.Detect(data)
+
+                    if not codec:
+                        Tools.Fail("Unknown data at offset " + str(offset) + " of " + vPath)
+
+                    reader.segment = len(segments)
+                    segment = {"codec": codec, "offset": offset, "compressed": 0, "raw": 0, "entries": len(reader.entries)}
+
+                    if codec == "none":
+                        data, used = cls.ReadArchive(image, reader, data)
+                        segment["raw"] = used
+                    else:
+                        data, used, segment["raw"] = cls.ReadCompressed(vPath, image, reader, data, codec)
+
+                    segment["compressed"] = used
+                    segment["entries"] = len(reader.entries) - segment["entries"]
+                    segments.append(segment)
+                    offset += used
+        except OSError:
+            Tools.Fail("Unable to read the image: " + vPath)
+        except ValueError:
+            Tools.Fail("The image " + vPath + " has an invalid cpio archive at offset " + str(offset))
+
+        if reader.IsTruncated():
+            Tools.Warn("The image " + vPath + " ends in the middle of an entry")
+
+        return segments, reader.entries
+
+    # Reads an uncompressed archive from the image. Returns the data that
+    # was read past its end and the size of the archive.
+    @classmethod
+    def ReadArchive(cls, vImage, vReader, vData):
+        used = 0
+
+        while vData:
+            parsed, finished = vReader.Feed(vData, 1.0, True)
+            used += parsed
+
+            if finished:
+                return vData[parsed:], used
+
+            vData = vImage.read(cls._chunk_size)
+
+        return b"", used
+
+    # Decompresses a compressed segment from the image and parses the
+    # archives in it. Every decompressed chunk is charged the compressed
+    # bytes it came from. Returns the data that was read past the end of
+    # the segment, the compressed size and the uncompressed size.
+    @classmethod
+    def ReadCompressed(cls, vPath, vImage, vReader, vData, vCodec):
+        decompressor = Compression.OpenDecompressor(vCodec)
+
+        if not decompressor:
+            Tools.Fail("The python library for " + vCodec + " decompression isn't installed!")
+
+        used = 0
+        raw = 0
+        pending = 0
+
+        while vData:
+            try:
+                output = decompressor.decompress(vData)
+            except Compression.GetDecompressErrors():
+                Tools.Fail("The " + vCodec + " segment of " + vPath + " is corrupted")
+
+            consumed = len(vData) - (len(decompressor.unused_data) if decompressor.eof else 0)
+            used += consumed
+            pending += consumed
+
+            if output:
+                vReader.Feed(output, pending / len(output))
+                raw += len(output)
+                pending = 0
+
+            if decompressor.eof:
+                return decompressor.unused_data, used, raw
+
+            vData = vImage.read(cls._chunk_size)
+
+        return b"", used, raw
+
+    # Returns the type of an entry
+    @classmethod
+    def GetType(cls, vEntry):
+        mode = vEntry["mode"]
+
+        if stat.S_ISREG(mode):
+            return "file"
+        elif stat.S_ISDIR(mode):
+            return "directory"
+        elif stat.S_ISLNK(mode):
+            return "symlink"
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            return "device"
+
+        return "other"
+
+    # Returns the subtree that an entry is counted in (its first 'vDepth'
+    # path components)
+    @classmethod
+    def GetSubtree(cls, vName, vDepth):
+        return "/".join(vName.split("/")[:vDepth])
+
+    # Returns the entries that end up in the unpacked initramfs. An entry
+    # in a later segment replaces an earlier one with the same name.
+    @classmethod
+    def GetEffective(cls, vEntries):
+        effective = {}
+
+        for entry in vEntries:
+            effective[entry["name"]] = entry
+
+        return effective
+
+    # Returns the sizes of every subtree, largest (compressed) first
+    @classmethod
+    def GetSubtrees(cls, vEntries, vDepth):
+        subtrees = {}
+
+        for entry in vEntries:
+            key = cls.GetSubtree(entry["name"], vDepth)
+            subtree = subtrees.setdefault(key, {"subtree": key, "entries": 0, "raw": 0, "compressed": 0})
+            subtree["entries"] += 1
+            subtree["raw"] += entry["raw"]
+            subtree["compressed"] += entry["compressed"]
+
+        for subtree in subtrees.values():
+            subtree["compressed"] = int(round(subtree["compressed"]))
+
+        return sorted(subtrees.values(), key=lambda s: (-s["compressed"], s["subtree"]))
+
+    # Returns the groups of files with the same content, the ones that
+    # waste the most space first
+    @classmethod
+    def GetDuplicates(cls, vEffective):
+        groups = {}
+
+        for entry in vEffective.values():
+            if entry["digest"] and entry["size"]:
+                groups.setdefault(entry["digest"], []).append(entry)
+
+        duplicates = []
+
+        for digest, entries in groups.items():
+            if len(entries) > 1:
+                duplicates.append({
+                    "digest": digest,
+                    "size": entries[0]["size"],
+                    "wasted": entries[0]["size"] * (len(entries) - 1),
+                    "names": sorted(entry["name"] for entry in entries),
+                })
+
+        return sorted(duplicates, key=lambda d: (-d["wasted"], d["names"]))
+
+    # Returns the summary of an image
+    @classmethod
+    def Summarize(cls, vSegments, vEntries, vDepth):
+        effective = cls.GetEffective(vEntries)
+        types = {}
+
+        for entry in vEntries:
+            kind = cls.GetType(entry)
+            types[kind] = types.get(kind, 0) + 1
+
+        files = [entry for entry in effective.values() if entry["digest"] is not None]
+
+        return {
+            "segments": vSegments,
+            "entries": len(vEntries),
+            "types": types,
+            "replaced": len(vEntries) - len(effective),
+            "compressed": sum(segment["compressed"] for segment in vSegments),
+            "raw": sum(segment["raw"] for segment in vSegments),
+            "subtrees": cls.GetSubtrees(vEntries, vDepth),
+            "largest": [{"name": e["name"], "size": e["size"]} for e in sorted(files, key=lambda e: (-e["size"], e["name"]))],
+            "duplicates": cls.GetDuplicates(effective),
+        }
+
+    # Prints the summary of an image and returns it
+    @classmethod
+    def Inspect(cls, vPath, vTop=15, vDepth=2, vOutput=None):
+        segments, entries = cls.Read(vPath)
+        summary = cls.Summarize(segments, entries, vDepth)
+
+        Tools.Info(vPath + ": " + str(len(segments)) + " segments, " + str(summary["entries"]) + " entries (" +
+                   ", ".join(str(count) + " " + kind for kind, count in sorted(summary["types"].items())) + ")")
+
+        if summary["replaced"]:
+            Tools.Flag(str(summary["replaced"]) + " entries are replaced by the same entries in a later segment")
+
+        Tools.Print("")
+        Tools.Print("{0:<8} {1:<6} {2:>12} {3:>14} {4:>14} {5:>8}".format("Segment", "Codec", "Offset", "Compressed", "Raw", "Entries"))
+
+        for i, segment in enumerate(segments):
+            Tools.Print("{0:<8} {1:<6} {2:>12} {3:>14} {4:>14} {5:>8}".format(
+                i, segment["codec"], segment["offset"], segment["compressed"], segment["raw"], segment["entries"]))
+
+        Tools.Print("")
+        Tools.Print("{0:<40} {1:>8} {2:>12} {3:>16} {4:>7}".format("Subtree", "Entries", "Raw (KiB)", "Compressed (KiB)", "Share"))
+
+        for subtree in summary["subtrees"][:vTop]:
+            share = 100.0 * subtree["compressed"] / summary["compressed"] if summary["compressed"] else 0
+            Tools.Print("{0:<40} {1:>8} {2:>12.1f} {3:>16.1f} {4:>6.1f}%".format(
+                subtree["subtree"], subtree["entries"], subtree["raw"] / 1024, subtree["compressed"] / 1024, share))
+
+        Tools.Print("")
+        Tools.Print("Largest files:")
+
+        for entry in summary["largest"][:vTop]:
+            Tools.Print("{0:>12} {1}".format(entry["size"], entry["name"]))
+
+        if summary["duplicates"]:
+            wasted = sum(duplicate["wasted"] for duplicate in summary["duplicates"])
+
+            Tools.Print("")
+            Tools.Print("Files with the same content (" + str(wasted // 1024) + " KiB could be saved):")
+
+            for duplicate in summary["duplicates"][:vTop]:
+                Tools.Print("{0:>12} x{1} {2}".format(duplicate["size"], len(duplicate["names"]), " ".join(duplicate["names"])))
+
+        Tools.Print("")
+
+        if vOutput:
+            with open(vOutput, "w") as output:
+                json.dump(summary, output, indent=4, sort_keys=True)
+
+        Tools.Flush()
+
+        return summary
+
+    # Returns the name used to match the entries of two images
+    @classmethod
+    def Normalize(cls, vName):
+        return cls._modules_directory.sub("lib/modules/*", vName)
+
+    # Returns the differences between the entries of two images
+    @classmethod
+    def Compare(cls, vOld, vNew, vDepth):
+        old = dict((cls.Normalize(name), entry) for name, entry in cls.GetEffective(vOld).items())
+        new = dict((cls.Normalize(name), entry) for name, entry in cls.GetEffective(vNew).items())
+
+        added = [{"name": name, "size": new[name]["size"]} for name in sorted(set(new) - set(old))]
+        removed = [{"name": name, "size": old[name]["size"]} for name in sorted(set(old) - set(new))]
+        changed = []
+
+        for name in sorted(set(old) & set(new)):
+            a, b = old[name], new[name]
+
+            if (a["mode"], a["size"], a["digest"], a["target"]) != (b["mode"], b["size"], b["digest"], b["target"]):
+                changed.append({"name": name, "old": a["size"], "new": b["size"], "change": b["size"] - a["size"]})
+
+        subtrees = {}
+
+        for sign, entries in ((-1, vOld), (1, vNew)):
+            for subtree in cls.GetSubtrees([dict(e, name=cls.Normalize(e["name"])) for e in entries], vDepth):
+                delta = subtrees.setdefault(subtree["subtree"], {"subtree": subtree["subtree"], "raw": 0, "compressed": 0})
+                delta["raw"] += sign * subtree["raw"]
+                delta["compressed"] += sign * subtree["compressed"]
+
+        subtrees = [delta for delta in subtrees.values() if delta["raw"] or delta["compressed"]]
+
+        return {
+            "added": added,
+            "removed": removed,
+            "changed": sorted(changed, key=lambda c: (-abs(c["change"]), c["name"])),
+            "subtrees": sorted(subtrees, key=lambda d: (-abs(d["compressed"]), d["subtree"])),
+        }
+
+    # Prints the differences between two images and returns them
+    @classmethod
+    def Diff(cls, vOldPath, vNewPath, vTop=15, vDepth=2, vOutput=None):
+        oldSegments, oldEntries = cls.Read(vOldPath)
+        newSegments, newEntries = cls.Read(vNewPath)
+        diff = cls.Compare(oldEntries, newEntries, vDepth)
+
+        oldSize = sum(segment["compressed"] for segment in oldSegments)
+        newSize = sum(segment["compressed"] for segment in newSegments)
+        diff["compressed"] = {"old": oldSize, "new": newSize, "change": newSize - oldSize}
+
+        Tools.Info(vOldPath + " -> " + vNewPath + ": {0:+d} bytes ({1} -> {2}), {3} added, {4} removed, {5} changed".format(
+            newSize - oldSize, oldSize, newSize, len(diff["added"]), len(diff["removed"]), len(diff["changed"])))
+
+        Tools.Print("")
+        Tools.Print("{0:<40} {1:>14} {2:>18}".format("Subtree", "Raw (bytes)", "Compressed (bytes)"))
+
+        for delta in diff["subtrees"][:vTop]:
+            Tools.Print("{0:<40} {1:>+14d} {2:>+18d}".format(delta["subtree"], delta["raw"], delta["compressed"]))
+
+        # Title, entries and the change in size of every entry
+        sections = [
+            ("Added", [(entry["size"], entry["name"]) for entry in diff["added"]]),
+            ("Removed", [(-entry["size"], entry["name"]) for entry in diff["removed"]]),
+            ("Changed", [(entry["change"], entry["name"]) for entry in diff["changed"]]),
+        ]
+
+        for title, entries in sections:
+            if not entries:
+                continue
+
+            Tools.Print("")
+            Tools.Print(title + ":")
+
+            for change, name in sorted(entries, key=lambda e: (-abs(e[0]), e[1]))[:vTop]:
+                Tools.Print("{0:>+12d} {1}".format(change, name))
+
+        Tools.Print("")
+
+        if vOutput:
+            with open(vOutput, "w") as output:
+                json.dump(diff, output, indent=4, sort_keys=True)
+
+        Tools.Flush()
+
+        return diff
@@ -0,0 +1,257 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import atexit
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+
+import pkg.libs.Variables as var
+
+# Measures every phase of the build (wall and cpu time, subprocesses,
+# files and bytes copied, peak memory) and reports the results at exit.
+class Metrics(object):
+    # Results of every phase that ran, in order
+    _phases = []
+
+    # Counters that are incremented while the build runs
+    _counters = {
+        "subprocesses": 0,
+        "files": 0,
+        "bytes": 0,
+    }
+
+    # Extra values that are included in the report (i.e selected firmware)
+    _notes = {}
+
+    # Amount of processes started, by program name
+    _programs = {}
+
+    # Audit events that start a new process
+    _process_events = ("subprocess.Popen", "os.system", "os.posix_spawn", "os.fork")
+
+    # Set to true once the audit hook and the exit handler are installed
+    _installed = False
+
+    # Starts collecting metrics. The summary is printed at exit unless
+    # the caller reports the results itself.
+    @classmethod
+    def Install(cls, vReportAtExit=True):
+        if cls._installed:
+            return
+
+        cls._installed = True
+
+        # Every process creation raises an audit event, no matter which
+        # module started it, so counting them here catches all of them.
+        # (Audit hooks need python 3.8, the processes aren't counted before.)
+        if hasattr(sys, "addaudithook"):
+            sys.addaudithook(cls.Audit)
+
+        if vReportAtExit:
+            atexit.register(cls.Report)
+
+    # Audit hook that counts the processes that the build starts
+    @classmethod
+    def Audit(cls, vEvent, vArguments):
+        if vEvent in cls._process_events:
+            cls._counters["subprocesses"] += 1
+
+            # subprocess.Popen, os.posix_spawn and os.system pass the program
+            # (or the command line) first, os.fork doesn't pass anything
+            program = str(vArguments[0]).split()[0] if vArguments and vArguments[0] else "fork"
+            program = os.path.basename(program)
+            cls._programs[program] = cls._programs.get(program, 0) + 1
+
+    # Increments a counter
+    @classmethod
+    def Count(cls, vName, vAmount=1):
+        cls._counters[vName] = cls._counters.get(vName, 0) + vAmount
+
+    # Returns the current value of a counter
+    @classmethod
+    def GetCount(cls, vName):
+        return cls._counters.get(vName, 0)
+
+    # Adds a value to the report
+    @classmethod
+    def Note(cls, vName, vValue):
+        cls._notes[vName] = vValue
+
+    # Returns a value that was added to the report
+    @classmethod
+    def GetNote(cls, vName):
+        return cls._notes.get(vName)
+
+    # Returns the cpu time used by the finished child processes
+    @classmethod
+    def GetChildrenTime(cls):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    # Returns the peak resident memory (in KiB) of this process and its children
+    @classmethod
+    def GetPeakMemory(cls):
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return max(own, children)
+
+    # Runs a phase of the build and records its metrics. If this phase
+    # was selected with --profile, it is also ran under cProfile.
+    @classmethod
+    def Run(cls, vFunction, *vArguments):
+        name = vFunction.__name__
+        counters = dict(cls._counters)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children = cls.GetChildrenTime()
+
+        profiler = None
+
+        if var.profilePhase == name:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            return vFunction(*vArguments)
+        finally:
+            if profiler:
+                profiler.disable()
+                cls.SaveProfile(name, profiler)
+
+            cls._phases.append({
+                "phase": name,
+                "wall": time.perf_counter() - wall,
+                "cpu": time.process_time() - cpu,
+                "children_cpu": cls.GetChildrenTime() - children,
+                "subprocesses": cls._counters["subprocesses"] - counters["subprocesses"],
+                "files": cls._counters["files"] - counters["files"],
+                "bytes": cls._counters["bytes"] - counters["bytes"],
+                "peak_rss_kb": cls.GetPeakMemory(),
+            })
+
+    # Forgets the results collected so far (a build that runs in a worker
+    # process starts with the results that its parent had collected)
+    @classmethod
+    def Reset(cls):
+        cls._phases = []
+        cls._notes = {}
+        cls._programs = {}
+
+        for name in cls._counters:
+            cls._counters[name] = 0
+
+    # Returns the results collected so far, so that a worker process can
+    # send them back to its parent
+    @classmethod
+    def GetResults(cls):
+        return {"phases": cls._phases, "notes": cls._notes, "programs": cls._programs}
+
+    # Adds the results of a build that ran in a worker process. Its phases
+    # are labeled with the build they belong to.
+    @classmethod
+    def Merge(cls, vLabel, vResults):
+        for phase in vResults["phases"]:
+            phase = dict(phase, phase=vLabel + ": " + phase["phase"])
+            cls._phases.append(phase)
+
+            for name in ("subprocesses", "files", "bytes"):
+                cls.Count(name, phase[name])
+
+        for program, count in vResults["programs"].items():
+            cls._programs[program] = cls._programs.get(program, 0) + count
+
+        cls._notes.setdefault("builds", {})[vLabel] = vResults["notes"]
+
+    # Returns the metrics of the phase that finished last
+    @classmethod
+    def GetLastPhase(cls):
+        return cls._phases[-1]
+
+    # Writes the profile of a phase next to the initramfs and prints the top entries
+    @classmethod
+    def SaveProfile(cls, vName, vProfiler):
+        path = var.home + "/" + vName + ".prof"
+        vProfiler.dump_stats(path)
+
+        stream = io.StringIO()
+        pstats.Stats(vProfiler, stream=stream).sort_stats("cumulative").print_stats(15)
+
+        Tools = cls.GetTools()
+        Tools.Print("Profile of " + vName + " (saved to " + path + "):\n" + stream.getvalue().rstrip("\n"))
+        Tools.Flush()
+
+    # Prints the summary (a table, or a JSON object in the 'json' log format)
+    # and writes the JSON report if one was requested
+    @classmethod
+    def Report(cls):
+        if not cls._phases:
+            return
+
+        totals = cls.GetTotals()
+
+        # Anything still buffered comes before the summary
+        cls.GetTools().Flush()
+
+        if var.logFormat == "json":
+            print(json.dumps({"level": "summary", "phases": cls._phases, "totals": totals, "programs": cls._programs}))
+        elif not var.quiet:
+            cls.PrintTable(totals)
+
+        if var.metricsReport:
+            report = {
+                "version": var.version,
+                "kernel": var.kernel,
+                "phases": cls._phases,
+                "totals": totals,
+                "programs": cls._programs,
+                "notes": cls._notes,
+            }
+
+            with open(var.metricsReport, "w") as output:
+                json.dump(report, output, indent=4, sort_keys=True)
+
+    # Returns the Tools class (it imports this module, so it can't be imported
+    # when this module is loaded)
+    @classmethod
+    def GetTools(cls):
+        from pkg.libs.Tools import Tools
+        return Tools
+
+    # Prints the summary table and the programs that were started
+    @classmethod
+    def PrintTable(cls, vTotals):
+        header = "{0:<28} {1:>9} {2:>9} {3:>9} {4:>6} {5:>7} {6:>12} {7:>10}"
+        row = "{0:<28} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>6} {5:>7} {6:>12} {7:>10}"
+        Tools = cls.GetTools()
+
+        Tools.Print("")
+        Tools.Print(header.format("Phase", "Wall (s)", "CPU (s)", "Child (s)", "Procs", "Files", "Bytes", "Peak KiB"))
+
+        for phase in cls._phases:
+            Tools.Print(row.format(phase["phase"], phase["wall"], phase["cpu"], phase["children_cpu"],
+                                   phase["subprocesses"], phase["files"], phase["bytes"], phase["peak_rss_kb"]))
+
+        Tools.Print(row.format("Total", vTotals["wall"], vTotals["cpu"], vTotals["children_cpu"],
+                               vTotals["subprocesses"], vTotals["files"], vTotals["bytes"], vTotals["peak_rss_kb"]))
+
+        programs = ", ".join("{0} x{1}".format(name, count) for name, count in sorted(cls._programs.items()))
+        Tools.Print("Processes started: " + str(cls.GetCount("subprocesses")) + (" (" + programs + ")" if programs else ""))
+        Tools.Print("")
+        Tools.Flush()
+
+    # Returns the sum of all the phases
+    @classmethod
+    def GetTotals(cls):
+        totals = {"phase": "Total", "peak_rss_kb": cls.GetPeakMemory()}
+
+        for key in ("wall", "cpu", "children_cpu", "subprocesses", "files", "bytes"):
+            totals[key] = sum(phase[key] for phase in cls._phases)
+
+        return totals
@@ -0,0 +1,407 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import fnmatch
+import os
+import re
+import struct
+
+from pkg.libs.Elf import Elf
+from pkg.libs.Compression import Compression
+
+# Loads the module indexes that depmod generates for a kernel
+# (modules.dep, modules.alias, modules.softdep and modules.builtin)
+# once and answers module, alias and dependency queries from memory.
+class ModuleIndex(object):
+    # Magic number and node flags of the kmod binary indexes (*.bin)
+    _bin_magic = 0xB007F457
+    _node_prefix = 0x80000000
+    _node_values = 0x40000000
+    _node_childs = 0x20000000
+    _node_mask = 0x0FFFFFFF
+
+    # Suffixes that a module file can have
+    _suffix = re.compile(r"\.ko(\.gz|\.xz|\.zst)?$")
+
+    # Modules directory that the indexes were loaded from
+    _directory = None
+
+    # Module name -> path relative to the modules directory
+    _paths = {}
+
+    # Module name -> direct dependencies (module names)
+    _deps = {}
+
+    # Alias pattern -> module names
+    _aliases = {}
+
+    # The alias patterns grouped by their literal prefix (the text before
+    # the first wildcard), with one regex that matches any pattern of the
+    # group (Built the first time an alias is looked up, the regex of a
+    # group the first time it is used)
+    # Format: prefix: [regex, [(pattern, module names)]]
+    _alias_groups = None
+
+    # Wildcards of the alias patterns
+    _wildcard = re.compile(r"[*?\[]")
+
+    # Module name -> (pre softdeps, post softdeps)
+    _softdeps = {}
+
+    # Names of the modules that are built into the kernel
+    _builtin = set()
+
+    # Module name -> parsed .modinfo section (Read the first time it is needed)
+    _modinfo = {}
+
+    # Returns the normalized name of a module (modprobe treats '-' and '_' the same)
+    @classmethod
+    def Normalize(cls, vName):
+        return vName.replace("-", "_")
+
+    # Returns the module name for a module path
+    @classmethod
+    def GetName(cls, vPath):
+        return cls.Normalize(cls._suffix.sub("", os.path.basename(vPath)))
+
+    # Loads the indexes of a modules directory (only once per directory)
+    @classmethod
+    def Load(cls, vDirectory):
+        if cls._directory == vDirectory:
+            return
+
+        cls._directory = vDirectory
+        cls._paths = {}
+        cls._deps = {}
+        cls._aliases = {}
+        cls._alias_groups = None
+        cls._softdeps = {}
+        cls._builtin = set()
+        cls._modinfo = {}
+
+        cls.LoadDependencies()
+        cls.LoadAliases()
+        cls.LoadSoftDependencies()
+        cls.LoadBuiltin()
+
+    # Returns the lines of an index file, or None if it doesn't exist
+    @classmethod
+    def ReadLines(cls, vFile):
+        try:
+            with open(os.path.join(cls._directory, vFile), "r") as index:
+                return index.read().splitlines()
+        except OSError:
+            return None
+
+    # Loads modules.dep (or modules.dep.bin)
+    @classmethod
+    def LoadDependencies(cls):
+        lines = cls.ReadLines("modules.dep")
+
+        if lines is None:
+            lines = [values[0] for values in cls.ReadBinaryIndex("modules.dep.bin").values()]
+
+        for line in lines:
+            path, separator, deps = line.partition(":")
+
+            if not separator:
+                continue
+
+            name = cls.GetName(path)
+            cls._paths[name] = path.strip()
+            cls._deps[name] = [cls.GetName(dep) for dep in deps.split()]
+
+    # Loads modules.alias (or modules.alias.bin)
+    @classmethod
+    def LoadAliases(cls):
+        lines = cls.ReadLines("modules.alias")
+
+        if lines is None:
+            for alias, modules in cls.ReadBinaryIndex("modules.alias.bin").items():
+                cls._aliases[alias] = [cls.Normalize(m) for m in modules]
+            return
+
+        for line in lines:
+            fields = line.split()
+
+            if len(fields) == 3 and fields[0] == "alias":
+                cls._aliases.setdefault(fields[1], []).append(cls.Normalize(fields[2]))
+
+    # Loads modules.softdep
+    @classmethod
+    def LoadSoftDependencies(cls):
+        for line in cls.ReadLines("modules.softdep") or []:
+            fields = line.split()
+
+            if len(fields) < 3 or fields[0] != "softdep":
+                continue
+
+            pre = []
+            post = []
+            current = None
+
+            for field in fields[2:]:
+                if field == "pre:":
+                    current = pre
+                elif field == "post:":
+                    current = post
+                elif current is not None:
+                    current.append(cls.Normalize(field))
+
+            cls._softdeps[cls.Normalize(fields[1])] = (pre, post)
+
+    # Loads modules.builtin (or modules.builtin.bin)
+    @classmethod
+    def LoadBuiltin(cls):
+        lines = cls.ReadLines("modules.builtin")
+
+        if lines is None:
+            cls._builtin = set(cls.Normalize(name) for name in cls.ReadBinaryIndex("modules.builtin.bin"))
+            return
+
+        cls._builtin = set(cls.GetName(line) for line in lines if line.strip())
+
+    # Reads a kmod binary index (a trie) into a dictionary of key -> values
+    @classmethod
+    def ReadBinaryIndex(cls, vFile):
+        try:
+            with open(os.path.join(cls._directory, vFile), "rb") as index:
+                data = index.read()
+        except OSError:
+            return {}
+
+        magic, version, root = struct.unpack_from(">III", data, 0)
+
+        if magic != cls._bin_magic:
+            return {}
+
+        entries = {}
+        pending = [(root, "")]
+
+        while pending:
+            node, key = pending.pop()
+            offset = node & cls._node_mask
+
+            if node & cls._node_prefix:
+                end = data.index(b"\0", offset)
+                key += data[offset:end].decode()
+                offset = end + 1
+
+            if node & cls._node_childs:
+                first, last = data[offset], data[offset + 1]
+                offset += 2
+
+                for i in range(last - first + 1):
+                    child = struct.unpack_from(">I", data, offset + i * 4)[0]
+
+                    if child:
+                        pending.append((child, key + chr(first + i)))
+
+                offset += (last - first + 1) * 4
+
+            if node & cls._node_values:
+                count = struct.unpack_from(">I", data, offset)[0]
+                offset += 4
+                values = []
+
+                for i in range(count):
+                    # Each value has a priority followed by the string
+                    end = data.index(b"\0", offset + 4)
+                    values.append(data[offset + 4:end].decode())
+                    offset = end + 1
+
+                entries[key] = values
+
+        return entries
+
+    # Returns the absolute path of a module, or None if it isn't a loadable module
+    @classmethod
+    def GetPath(cls, vName):
+        path = cls._paths.get(cls.Normalize(vName))
+
+        if path is None:
+            return None
+
+        return os.path.join(cls._directory, path)
+
+    # Checks to see if a module is built into the kernel
+    @classmethod
+    def IsBuiltin(cls, vName):
+        return cls.Normalize(vName) in cls._builtin
+
+    # Groups the alias patterns by their literal prefix. A pattern can only
+    # match an alias that starts with its prefix, so a lookup only has to
+    # try the groups of the prefixes of the alias.
+    @classmethod
+    def GroupAliases(cls):
+        patterns = {}
+
+        for pattern, names in cls._aliases.items():
+            wildcard = cls._wildcard.search(pattern)
+            prefix = pattern[:wildcard.start()] if wildcard else pattern
+            patterns.setdefault(prefix, [None, []])[1].append((pattern, names))
+
+        cls._alias_groups = patterns
+
+    # Returns the modules that match a device alias (i.e pci:v00008086d...)
+    @classmethod
+    def FindAlias(cls, vAlias):
+        if cls._alias_groups is None:
+            cls.GroupAliases()
+
+        modules = []
+
+        for end in range(len(vAlias) + 1):
+            group = cls._alias_groups.get(vAlias[:end])
+
+            if not group:
+                continue
+
+            if group[0] is None:
+                group[0] = re.compile("|".join(fnmatch.translate(pattern) for pattern, names in group[1]))
+
+            if not group[0].match(vAlias):
+                continue
+
+            for pattern, names in group[1]:
+                if fnmatch.fnmatchcase(vAlias, pattern):
+                    for name in names:
+                        if name not in modules:
+                            modules.append(name)
+
+        return modules
+
+    # Returns the module name for a module name or alias, or None if
+    # there isn't a loadable module for it
+    @classmethod
+    def Resolve(cls, vName):
+        name = cls.Normalize(vName)
+
+        if name in cls._paths:
+            return name
+
+        for module in cls.FindAlias(vName):
+            if module in cls._paths:
+                return module
+
+        return None
+
+    # Returns the module and all the modules it needs (hard and soft
+    # dependencies) ordered so that every module comes after its dependencies.
+    @classmethod
+    def GetDependencies(cls, vName, vSeen=None):
+        seen = vSeen if vSeen is not None else set()
+        name = cls.Normalize(vName)
+
+        if name in seen or name not in cls._paths:
+            return []
+
+        seen.add(name)
+
+        pre, post = cls._softdeps.get(name, ([], []))
+        ordered = []
+
+        for dep in pre + cls._deps.get(name, []):
+            ordered += cls.GetDependencies(dep, seen)
+
+        ordered.append(name)
+
+        for dep in post:
+            ordered += cls.GetDependencies(dep, seen)
+
+        return ordered
+
+    # Returns the modules that a module needs directly (hard and soft dependencies)
+    @classmethod
+    def GetDirectDependencies(cls, vName):
+        pre, post = cls._softdeps.get(cls.Normalize(vName), ([], []))
+        dependencies = pre + cls._deps.get(cls.Normalize(vName), []) + post
+
+        return [cls.Normalize(dep) for dep in dependencies if cls.Normalize(dep) in cls._paths]
+
+    # Splits a set of modules into levels. Every module only depends on
+    # (or has to be loaded after) modules of earlier levels, so all the
+    # modules of a level can be loaded at the same time.
+    @classmethod
+    def GetLevels(cls, vModules):
+        modules = set(cls.Normalize(module) for module in vModules)
+        after = dict((module, set()) for module in modules)
+
+        for module in modules:
+            pre, post = cls._softdeps.get(module, ([], []))
+
+            for dep in cls._deps.get(module, []) + pre:
+                if dep in modules and dep != module:
+                    after[module].add(dep)
+
+            # Post soft dependencies are loaded after the module
+            for dep in post:
+                if dep in modules and dep != module:
+                    after[dep].add(module)
+
+        levels = {}
+
+        def GetLevel(vModule, vVisiting):
+            if vModule in levels:
+                return levels[vModule]
+
+            # Soft dependencies can form cycles, those edges are ignored
+            vVisiting.add(vModule)
+            level = 0
+
+            for dep in after[vModule]:
+                if dep not in vVisiting:
+                    level = max(level, GetLevel(dep, vVisiting) + 1)
+
+            vVisiting.discard(vModule)
+            levels[vModule] = level
+
+            return level
+
+        result = []
+
+        for module in sorted(modules):
+            level = GetLevel(module, set())
+
+            while len(result) <= level:
+                result.append([])
+
+        for module in sorted(modules):
+            result[levels[module]].append(module)
+
+        return result
+
+    # Returns the .modinfo section of a module as a dictionary of
+    # key -> values (a key like 'alias' or 'firmware' can appear many times)
+    @classmethod
+    def GetModinfo(cls, vName):
+        name = cls.Normalize(vName)
+
+        if name in cls._modinfo:
+            return cls._modinfo[name]
+
+        modinfo = {}
+        path = cls.GetPath(name)
+
+        try:
+            with open(path, "rb") as module:
+                data = Compression.DecompressModule(module.read(), path)
+        except (OSError, TypeError):
+            data = None
+
+        section = Elf.GetSection(data, ".modinfo") if data else None
+
+        for entry in (section or b"").split(b"\0"):
+            key, separator, value = entry.decode(errors="replace").partition("=")
+
+            if separator:
+                modinfo.setdefault(key, []).append(value)
+
+        cls._modinfo[name] = modinfo
+
+        return modinfo
+
+    # Returns the firmware files that a module requests (they might contain wildcards)
+    @classmethod
+    def GetFirmware(cls, vName):
+        return cls.GetModinfo(vName).get("firmware", [])
@@ -0,0 +1,391 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import glob
+import json
+import os
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Tools import Tools
+
+# Records why every file is in the initramfs. The build adds an edge for
+# every reason a file is pulled in: a hook lists a file, a binary needs a
+# library (DT_NEEDED), an addon module needs another module (modules.dep)
+# or a module requests firmware. The nodes are the paths in the initramfs
+# and the roots are the hooks (i.e hook:Zfs). The graph of every build is
+# saved with the size of its files, so that './mkinitrd.py why' can explain
+# why a file is there and how much every hook entry adds to the image.
+class Provenance(object):
+    # The parents of every node and the reason of each edge
+    # Format: node: {parent: kind}
+    _parents = {}
+
+    # The edges that the shared phases recorded (every build starts from them)
+    _shared = {}
+
+    # Forgets the edges that were recorded so far
+    @classmethod
+    def Reset(cls):
+        cls._parents = {}
+        cls._shared = {}
+
+    # Remembers the edges recorded so far as the ones every build starts from
+    @classmethod
+    def MarkShared(cls):
+        cls._shared = dict((child, dict(parents)) for child, parents in cls._parents.items())
+
+    # Forgets the edges that a previous build in this process recorded
+    @classmethod
+    def ResetBuild(cls):
+        cls._parents = dict((child, dict(parents)) for child, parents in cls._shared.items())
+
+    # Returns the name of a node: paths are absolute paths in the
+    # initramfs, anything else (the roots) is used as is
+    @classmethod
+    def Normalize(cls, vNode):
+        if vNode.startswith("/"):
+            return "/" + os.path.normpath(vNode).lstrip("/")
+
+        return vNode
+
+    # Checks to see if anything recorded a reason for a node
+    @classmethod
+    def HasParents(cls, vNode):
+        return cls.Normalize(vNode) in cls._parents
+
+    # Records that 'vChild' is in the initramfs because of 'vParent'
+    @classmethod
+    def Add(cls, vParent, vChild, vKind):
+        parent = cls.Normalize(vParent)
+        child = cls.Normalize(vChild)
+
+        if parent != child:
+            cls._parents.setdefault(child, {}).setdefault(parent, vKind)
+
+    # Returns the graph of the files in a staged initramfs: the nodes with
+    # their size, the edges and the files that no hook accounts for.
+    # Directories are replaced by the files in them, and modules that were
+    # compressed after they were copied are renamed to their final name.
+    @classmethod
+    def GetGraph(cls, vRoot):
+        edges = set()
+
+        for child, parents in cls._parents.items():
+            for parent, kind in parents.items():
+                edges.add((parent, child, kind))
+
+        # Find the names the files have in the initramfs
+        renamed = {}
+
+        for edge in edges:
+            for node in edge[:2]:
+                if node.startswith("/") and node not in renamed:
+                    renamed[node] = cls.FindStaged(vRoot, node)
+
+        nodes = {}
+        final = set()
+
+        for parent, child, kind in edges:
+            parent = renamed.get(parent, parent)
+            child = renamed.get(child, child)
+            final.add((parent, child, kind))
+
+            for node in (parent, child):
+                nodes.setdefault(node, {"size": 0, "present": not node.startswith("/")})
+
+        for node in list(nodes):
+            path = vRoot + node if node.startswith("/") else None
+
+            if not path or not os.path.lexists(path):
+                continue
+
+            nodes[node]["present"] = True
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                for directory, dirs, files in os.walk(path):
+                    for file in files:
+                        member = "/" + os.path.relpath(os.path.join(directory, file), vRoot)
+                        final.add((node, member, "contains"))
+                        nodes.setdefault(member, {"size": 0, "present": True})
+
+        for node, info in nodes.items():
+            path = vRoot + node
+
+            if info["present"] and node.startswith("/") and os.path.isfile(path) and not os.path.islink(path):
+                info["size"] = os.lstat(path).st_size
+
+        # Everything in the initramfs that no edge accounts for
+        other = {"files": 0, "bytes": 0}
+
+        for directory, dirs, files in os.walk(vRoot):
+            for file in files:
+                path = os.path.join(directory, file)
+                node = "/" + os.path.relpath(path, vRoot)
+
+                if node not in nodes and os.path.isfile(path) and not os.path.islink(path):
+                    other["files"] += 1
+                    other["bytes"] += os.lstat(path).st_size
+
+        return {
+            "image": var.initrd,
+            "kernel": var.kernel,
+            "nodes": nodes,
+            "edges": sorted(final),
+            "other": other,
+        }
+
+    # Returns the name of a file in the staged initramfs. Kernel modules
+    # might have been compressed since they were recorded.
+    @classmethod
+    def FindStaged(cls, vRoot, vNode):
+        if os.path.lexists(vRoot + vNode):
+            return vNode
+
+        for suffix in (".gz", ".xz", ".zst"):
+            if os.path.lexists(vRoot + vNode + suffix):
+                return vNode + suffix
+
+        return vNode
+
+    # Returns the path where the graph of an image is saved
+    @classmethod
+    def GetGraphPath(cls, vImage):
+        return var.provenanceDirectory + "/" + vImage + ".json"
+
+    # Saves the graph of the current build (for 'why') and exports it to
+    # the file given with --provenance
+    @classmethod
+    def Save(cls, vRoot):
+        graph = cls.GetGraph(vRoot)
+        path = cls.GetGraphPath(var.initrd)
+        tempPath = path + "." + str(os.getpid())
+
+        try:
+            os.makedirs(var.provenanceDirectory, exist_ok=True)
+
+            with open(tempPath, "w") as output:
+                json.dump(graph, output)
+
+            os.replace(tempPath, path)
+        except OSError:
+            Tools.Warn("Unable to save the provenance graph to " + path)
+
+        if var.provenance:
+            output = var.provenance
+
+            # Every kernel gets its own file
+            if len(var.kernels) > 1:
+                base, extension = os.path.splitext(output)
+                output = base + "-" + var.kernel + extension
+
+            cls.Export(graph, output)
+            Tools.Flag("Wrote the provenance graph to " + output)
+
+        return graph
+
+    # Loads a saved graph. Without a path, the graph of the most recent build is used.
+    @classmethod
+    def Load(cls, vPath=None):
+        if not vPath:
+            graphs = glob.glob(var.provenanceDirectory + "/*.json")
+
+            if not graphs:
+                Tools.Fail("No provenance graph was found in " + var.provenanceDirectory + ". Build an initramfs first or use --graph.")
+
+            vPath = max(graphs, key=os.path.getmtime)
+
+        try:
+            with open(vPath, "r") as graph:
+                return json.load(graph)
+        except (OSError, ValueError):
+            Tools.Fail("Unable to read the provenance graph " + vPath + "!")
+
+    # Writes a graph as JSON, or as a Graphviz graph if the file ends with .dot
+    @classmethod
+    def Export(cls, vGraph, vPath):
+        try:
+            with open(vPath, "w") as output:
+                if vPath.endswith(".dot"):
+                    output.write(cls.GetDot(vGraph))
+                else:
+                    json.dump(vGraph, output, indent=4, sort_keys=True)
+        except OSError:
+            Tools.Fail("Unable to write the provenance graph to " + vPath + "!")
+
+    # Returns a graph in the Graphviz format. The roots are boxes and the
+    # files are labeled with their size.
+    @classmethod
+    def GetDot(cls, vGraph):
+        lines = ["digraph provenance {", "    rankdir=LR;"]
+
+        for node, info in sorted(vGraph["nodes"].items()):
+            if node.startswith("/"):
+                label = node + "\\n" + "{0:.1f} KiB".format(info["size"] / 1024)
+                lines.append("    " + json.dumps(node) + " [label=\"" + label.replace("\"", "\\\"") + "\"];")
+            else:
+                lines.append("    " + json.dumps(node) + " [shape=box];")
+
+        for parent, child, kind in vGraph["edges"]:
+            lines.append("    " + json.dumps(parent) + " -> " + json.dumps(child) + " [label=" + json.dumps(kind) + "];")
+
+        lines.append("}")
+
+        return "\n".join(lines) + "\n"
+
+    # Returns the parents and the children of every node of a graph
+    @classmethod
+    def GetLinks(cls, vGraph):
+        parents = {}
+        children = {}
+
+        for parent, child, kind in vGraph["edges"]:
+            parents.setdefault(child, []).append((parent, kind))
+            children.setdefault(parent, []).append(child)
+
+        return parents, children
+
+    # Finds the node of a path given on the command line (with or without
+    # the leading slash, and without the compression suffix of a module)
+    @classmethod
+    def FindNode(cls, vGraph, vPath):
+        path = "/" + os.path.normpath(vPath).lstrip("/")
+
+        for candidate in (path, path + ".gz", path + ".xz", path + ".zst"):
+            if candidate in vGraph["nodes"]:
+                return candidate
+
+        return None
+
+    # Returns the chains (root first) that explain why a node is in the
+    # image, the shortest ones first. Each step is (node, kind of the edge
+    # that leads to it).
+    @classmethod
+    def Explain(cls, vGraph, vNode, vLimit=10):
+        parents = cls.GetLinks(vGraph)[0]
+        chains = []
+        pending = [[(vNode, None)]]
+
+        # Walk up breadth first. The amount of partial chains is bounded
+        # since a file can be reached through many binaries.
+        explored = 0
+
+        while pending and len(chains) < vLimit and explored < 10000:
+            chain = pending.pop(0)
+            node = chain[0][0]
+            explored += 1
+
+            if node not in parents:
+                chains.append(chain)
+                continue
+
+            seen = set(step[0] for step in chain)
+
+            for parent, kind in parents[node]:
+                if parent not in seen:
+                    pending.append([(parent, None), (node, kind)] + chain[1:])
+
+        return chains
+
+    # Returns how much every hook entry (a file listed by a hook or a
+    # requested module) adds to the image: all the files it pulls in
+    # (cumulative) and the files that nothing else pulls in (exclusive,
+    # what removing the entry would save). The totals of every root too.
+    @classmethod
+    def GetSizes(cls, vGraph):
+        parents, children = cls.GetLinks(vGraph)
+        nodes = vGraph["nodes"]
+        roots = sorted(node for node in nodes if node not in parents)
+
+        def GetReachable(vStart):
+            reached = set()
+            pending = [vStart]
+
+            while pending:
+                node = pending.pop()
+
+                if node not in reached:
+                    reached.add(node)
+                    pending += children.get(node, [])
+
+            return reached
+
+        entries = []
+        owners = {}
+
+        for root in roots:
+            for entry in sorted(set(children.get(root, []))):
+                reached = GetReachable(entry)
+                entries.append({"root": root, "entry": entry, "reached": reached})
+
+                for node in reached:
+                    owners.setdefault(node, set()).add(entry)
+
+        for entry in entries:
+            reached = entry.pop("reached")
+            files = [node for node in reached if nodes[node]["size"]]
+
+            entry["files"] = len(files)
+            entry["cumulative"] = sum(nodes[node]["size"] for node in files)
+            entry["exclusive"] = sum(nodes[node]["size"] for node in files if len(owners[node]) == 1)
+
+        totals = []
+
+        for root in roots:
+            reached = GetReachable(root)
+            totals.append({"root": root, "files": sum(1 for node in reached if nodes[node]["size"]),
+                           "cumulative": sum(nodes[node]["size"] for node in reached)})
+
+        totals.sort(key=lambda total: -total["cumulative"])
+        entries.sort(key=lambda entry: (-entry["exclusive"], -entry["cumulative"], entry["entry"]))
+
+        return totals, entries
+
+    # Prints why every path is in the image
+    @classmethod
+    def PrintReasons(cls, vGraph, vPaths):
+        for path in vPaths:
+            node = cls.FindNode(vGraph, path)
+
+            if not node:
+                Tools.Warn(path + " isn't in " + vGraph["image"] + " (or no hook accounts for it)")
+                continue
+
+            size = vGraph["nodes"][node]["size"]
+            Tools.Info(node + " ({0:.1f} KiB) is in {1} because of:".format(size / 1024, vGraph["image"]))
+
+            for chain in cls.Explain(vGraph, node):
+                text = chain[0][0]
+
+                for step, kind in chain[1:]:
+                    text += " -(" + kind + ")-> " + step
+
+                Tools.Print("    " + text)
+
+        Tools.Print("")
+
+    # Prints the size that every root and the largest hook entries add to the image
+    @classmethod
+    def PrintSizes(cls, vGraph, vTop):
+        totals, entries = cls.GetSizes(vGraph)
+
+        Tools.Info(vGraph["image"] + ": what every hook adds to the image")
+        Tools.Print("")
+        Tools.Print("{0:<24} {1:>8} {2:>16}".format("Root", "Files", "Cumulative (KiB)"))
+
+        for total in totals:
+            Tools.Print("{0:<24} {1:>8} {2:>16.1f}".format(total["root"], total["files"], total["cumulative"] / 1024))
+
+        other = vGraph["other"]
+        Tools.Print("{0:<24} {1:>8} {2:>16.1f}".format("(unaccounted)", other["files"], other["bytes"] / 1024))
+
+        Tools.Print("")
+        Tools.Print("{0:<48} {1:<16} {2:>8} {3:>16} {4:>15}".format("Entry", "Root", "Files", "Cumulative (KiB)", "Exclusive (KiB)"))
+
+        for entry in entries[:vTop]:
+            Tools.Print("{0:<48} {1:<16} {2:>8} {3:>16.1f} {4:>15.1f}".format(
+                entry["entry"], entry["root"], entry["files"], entry["cumulative"] / 1024, entry["exclusive"] / 1024))
+
+        Tools.Print("")
+
+        return totals, entries
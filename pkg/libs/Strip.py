@@ -0,0 +1,102 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import os
+import shutil
+import stat
+
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import call
+from subprocess import DEVNULL
+
+import pkg.libs.Variables as var
+
+from pkg.libs.Tools import Tools
+from pkg.libs.Elf import Elf
+from pkg.libs.Cache import Cache
+
+# Removes the debug information, the .comment section and the symbols that
+# aren't needed at runtime from the files in the initramfs, using strip(1).
+class Strip(object):
+    # strip options for each kind of file. Kernel modules keep their symbol
+    # table (the kernel needs it to link them), so only the debug
+    # information is removed from them.
+    _options = {
+        "binaries": ["--strip-unneeded", "--remove-section=.comment"],
+        "libraries": ["--strip-unneeded", "--remove-section=.comment"],
+        "modules": ["--strip-debug", "--remove-section=.comment"],
+    }
+
+    # Marker at the end of a signed kernel module. The signature covers the
+    # whole module, so a signed module can't be changed at all.
+    _signature = b"~Module signature appended~\n"
+
+    # Strips the files of a category in parallel (strip runs as its own
+    # process, so threads are enough to use all the cores). Returns the
+    # totals: files, stripped, signed, failed, before and after (bytes).
+    @classmethod
+    def StripFiles(cls, vFiles, vCategory):
+        program = Tools.GetProgramPath("strip")
+        totals = {"files": 0, "stripped": 0, "signed": 0, "failed": 0, "before": 0, "after": 0}
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for status, before, after in pool.map(lambda file: cls.StripFile(program, file, vCategory), vFiles):
+                totals["files"] += 1
+                totals[status] += 1
+                totals["before"] += before
+                totals["after"] += after
+
+        return totals
+
+    # Strips a single file that was staged into the initramfs and returns
+    # the result (stripped, signed or failed) and its size before and after.
+    # The stripped file is written next to it and replaces it (the staged
+    # file might be a hard link to the file on the host).
+    @classmethod
+    def StripFile(cls, vProgram, vFile, vCategory):
+        before = os.path.getsize(vFile)
+
+        if vCategory == "modules" and cls.IsSigned(vFile):
+            return ("signed", before, before)
+
+        stripped = vFile + ".stripped"
+        key = None
+
+        try:
+            if Cache.IsEnabled():
+                source = vFile[len(var.temp):]
+                key = Cache.GetKey(["strip", Cache.HashFile(source), Cache.HashFile(vProgram)] + cls._options[vCategory])
+                cached = Cache.Get(key)
+
+                if cached:
+                    Tools.StageFile(cached, stripped, vMode=stat.S_IMODE(os.stat(vFile).st_mode))
+                    key = None
+
+            if not os.path.exists(stripped):
+                if call([vProgram] + cls._options[vCategory] + ["-o", stripped, vFile], stdout=DEVNULL, stderr=DEVNULL) != 0:
+                    raise OSError
+
+                # Never ship a file whose loaded code or data was changed
+                if Elf.GetLoadDigest(stripped) != Elf.GetLoadDigest(vFile):
+                    raise OSError
+
+                if key:
+                    Cache.Put(key, stripped)
+
+                shutil.copymode(vFile, stripped)
+
+            os.replace(stripped, vFile)
+        except OSError:
+            if os.path.exists(stripped):
+                os.remove(stripped)
+
+            return ("failed", before, before)
+
+        return ("stripped", before, os.path.getsize(vFile))
+
+    # Checks to see if a kernel module has a signature appended
+    @classmethod
+    def IsSigned(cls, vModule):
+        with open(vModule, "rb") as module:
+            module.seek(max(0, os.path.getsize(vModule) - len(cls._signature)))
+            return module.read() == cls._signature
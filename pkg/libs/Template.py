@@ -0,0 +1,95 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import os
+import re
+import stat
+
+from pkg.libs.Tools import Tools
+
+# Renders the files that are generated for the initramfs. Templates contain
+# @NAME@ placeholders that are filled from the build configuration in a
+# single pass, and every output file is written exactly once.
+class Template(object):
+    # Placeholders are upper case names between two '@'
+    _placeholder = re.compile(r"@([A-Z][A-Z0-9_]*)@")
+
+    # Fills every placeholder of a template. Fails if the template uses a
+    # placeholder that has no value, or if a value isn't used by the template.
+    @classmethod
+    def Render(cls, vText, vValues, vName):
+        used = set()
+        missing = set()
+
+        def Fill(vMatch):
+            name = vMatch.group(1)
+
+            if name not in vValues:
+                missing.add(name)
+                return vMatch.group(0)
+
+            used.add(name)
+            return vValues[name]
+
+        text = cls._placeholder.sub(Fill, vText)
+
+        if missing:
+            Tools.Fail("The " + vName + " template has placeholders without a value: " + ", ".join(sorted(missing)))
+
+        unused = set(vValues) - used
+
+        if unused:
+            Tools.Fail("The " + vName + " template is missing the placeholders: " + ", ".join(sorted(unused)))
+
+        return text
+
+    # Renders a template file into the initramfs. The output keeps the mode
+    # of the template and is always executable by its owner.
+    @classmethod
+    def RenderFile(cls, vTemplate, vTarget, vValues):
+        try:
+            with open(vTemplate, "r") as template:
+                text = template.read()
+
+            mode = stat.S_IMODE(os.stat(vTemplate).st_mode) | stat.S_IXUSR
+        except OSError:
+            Tools.Fail("Unable to read the " + vTemplate + " template!")
+
+        cls.WriteFile(vTarget, cls.Render(text, vValues, os.path.basename(vTemplate)), mode)
+
+    # Applies a list of fixups to the lines of a file. A fixup is either
+    # ("replace", line pattern, old, new), which replaces 'old' in the lines
+    # that match the pattern, or ("append", line), which adds a line at the end.
+    @classmethod
+    def Fixup(cls, vLines, vFixups):
+        lines = list(vLines)
+
+        for fixup in vFixups:
+            if fixup[0] == "replace":
+                pattern = re.compile(fixup[1])
+
+                for i, line in enumerate(lines):
+                    if pattern.search(line):
+                        lines[i] = line.replace(fixup[2], fixup[3])
+            elif fixup[0] == "append":
+                if lines and not lines[-1].endswith("\n"):
+                    lines[-1] += "\n"
+
+                lines.append(fixup[1] + "\n")
+
+        return lines
+
+    # Writes a generated file. The file is replaced rather than modified
+    # in place since it might be a hard link to a file on the host.
+    @classmethod
+    def WriteFile(cls, vTarget, vText, vMode):
+        tempTarget = vTarget + ".render"
+
+        try:
+            with open(tempTarget, "w") as target:
+                target.write(vText)
+
+            os.chmod(tempTarget, vMode)
+            os.replace(tempTarget, vTarget)
+        except OSError:
+            Tools.Fail("Unable to write " + vTarget + "!")
@@ -1,30 +1,72 @@
 # Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
 # Licensed under the Simplified BSD License which can be found in the LICENSE file.
 
+import atexit
+import fcntl
+import json
 import os
 import shutil
+import stat
 import sys
+import time
 
 import pkg.libs.Variables as var
 
-from subprocess import call
-from subprocess import check_output
+from pkg.libs.Metrics import Metrics
 
 class Tools(object):
+    # Directories that are known to exist in the temporary directory
+    _directories = set()
+
+    # Devices where hard links or reflinks into the temporary directory failed
+    _no_link = set()
+    _no_clone = set()
+
+    # ioctl used to create a reflink (FICLONE)
+    _ficlone = 0x40049409
+
+    # Messages that haven't been written to the terminal yet
+    _buffer = []
+    _flush_registered = False
+
+    # Result of the terminal check for the 'auto' color mode
+    _use_color = None
+
+    # Terminal escape sequences of the colors used by the messages
+    _colors = {
+        "red": "\033[1;31m",
+        "yellow": "\033[1;33m",
+        "green": "\033[1;32m",
+        "cyan": "\033[1;36m",
+        "purple": "\033[1;34m",
+    }
+
+    # Directories searched for programs (in addition to $PATH)
+    _program_directories = ["/usr/local/sbin", "/usr/local/bin", "/usr/sbin", "/usr/bin", "/sbin", "/bin"]
+
     # Checks parameters and running user
     @classmethod
     def ProcessArguments(cls, Addon):
-        user = check_output(["whoami"], universal_newlines=True).strip()
+        arguments = []
 
-        if user != "root":
-            cls.Fail("This program must be ran as root")
+        # Options (--name=value) can be placed anywhere on the command line
+        for argument in sys.argv[1:]:
+            if argument.startswith("--"):
+                cls.ProcessOption(argument)
+            else:
+                arguments.append(argument)
 
-        arguments = sys.argv[1:]
+        # Checked after the options so that the failure uses the selected output format
+        if os.geteuid() != 0:
+            cls.Fail("This program must be ran as root")
 
         # Let the user directly create an initramfs if no modules are needed
         if len(arguments) == 1:
-            if arguments[0] != "1" and arguments[0] != "2":
-                if not Addon.GetFiles():
+            # The kernels can also come from --kernels
+            if var.kernels:
+                var.choice = arguments[0]
+            elif arguments[0] != "1" and arguments[0] != "2":
+                if not Addon.GetFiles() and not var.hostOnly:
                     var.choice = arguments[0]
             else:
                 cls.Fail("You must pass a kernel parameter")
@@ -34,6 +76,99 @@ class Tools(object):
             var.choice = arguments[0]
             var.kernel = arguments[1]
 
+    # Processes a single --name=value option
+    @classmethod
+    def ProcessOption(cls, vOption):
+        name, separator, value = vOption[2:].partition("=")
+
+        if name == "compress":
+            var.compression = value
+        elif name == "level":
+            var.compressionLevel = cls.GetNumericOption(name, value)
+        elif name == "threads":
+            var.compressionThreads = cls.GetNumericOption(name, value)
+        elif name == "module-compression":
+            var.moduleCompression = value
+        elif name == "strip":
+            var.strip = True
+        elif name == "kernels":
+            var.kernels = [kernel for kernel in value.split(",") if kernel]
+
+            if not var.kernels:
+                cls.Fail("The --kernels option requires a list of kernels!")
+        elif name == "jobs":
+            var.jobs = cls.GetNumericOption(name, value)
+        elif name == "watch":
+            var.watch = True
+        elif name == "debounce":
+            var.watchDelay = cls.GetNumericOption(name, value)
+        elif name == "no-cache":
+            var.useCache = False
+        elif name == "provenance":
+            var.provenance = os.path.abspath(value)
+        elif name == "report":
+            var.metricsReport = os.path.abspath(value)
+        elif name == "profile":
+            var.profilePhase = value
+        elif name == "staging":
+            if value not in ("auto", "link", "copy"):
+                cls.Fail("The --staging option must be auto, link or copy!")
+
+            var.staging = value
+        elif name == "firmware":
+            if value not in ("auto", "all"):
+                cls.Fail("The --firmware option must be auto or all!")
+
+            var.firmwareSelection = value
+        elif name == "layered":
+            var.layered = True
+        elif name == "microcode":
+            var.microcode = True
+        elif name == "zpool-check":
+            if value not in ("warn", "strict", "off"):
+                cls.Fail("The --zpool-check option must be warn, strict or off!")
+
+            var.zpoolCheck = value
+        elif name == "enc-drives":
+            var.encDrives = [drive for drive in value.split(",") if drive]
+
+            for drive in var.encDrives:
+                if not drive.startswith(("UUID=", "PARTUUID=", "LABEL=", "PARTLABEL=", "ID=", "/dev/")):
+                    cls.Fail("Unknown encrypted drive: " + drive + " (use UUID=, PARTUUID=, LABEL=, PARTLABEL=, ID= or a /dev path)")
+        elif name == "enc-jobs":
+            var.encJobs = cls.GetNumericOption(name, value)
+
+            if var.encJobs < 0:
+                cls.Fail("The --enc-jobs option can't be negative!")
+        elif name == "host-only":
+            var.hostOnly = True
+        elif name == "sysfs":
+            var.sysfsRoot = os.path.abspath(value)
+        elif name == "proc":
+            var.procRoot = os.path.abspath(value)
+        elif name == "color":
+            if value not in ("auto", "always", "never"):
+                cls.Fail("The --color option must be auto, always or never!")
+
+            var.color = value
+        elif name == "quiet":
+            var.quiet = True
+        elif name == "log-format":
+            if value not in ("text", "json"):
+                cls.Fail("The --log-format option must be text or json!")
+
+            var.logFormat = value
+        else:
+            cls.Fail("Unknown option: " + vOption)
+
+    # Returns the value of an option that must be a number
+    @classmethod
+    def GetNumericOption(cls, vName, vValue):
+        try:
+            return int(vValue)
+        except ValueError:
+            cls.Fail("The --" + vName + " option requires a number!")
+
     # Prints the header of the application
     @classmethod
     def PrintHeader(cls):
@@ -57,8 +192,8 @@ class Tools(object):
     # Finds the path to a program on the system
     @classmethod
     def GetProgramPath(cls, vProg):
-        cmd = 'whereis ' + vProg + ' | cut -d " " -f 2'
-        results = check_output(cmd, shell=True, universal_newlines=True).strip()
+        directories = os.environ.get("PATH", "").split(os.pathsep) + cls._program_directories
+        results = shutil.which(vProg, path=os.pathsep.join(directories))
 
         if results:
             return results
@@ -97,6 +232,8 @@ class Tools(object):
                 quit(1)
 
         # Removes the temporary directory
+        cls.ForgetDirectories()
+
         if os.path.exists(var.temp):
             shutil.rmtree(var.temp)
 
@@ -109,101 +246,273 @@ class Tools(object):
     def CleanAndExit(cls, vInitrd):
         cls.Clean()
         cls.Info("Please copy \"" + vInitrd + "\" to your " + "/boot directory")
+        cls.Flush()
         quit()
 
+    # Returns a key that identifies the current state of a file on disk
+    # (device, inode, size and modification time)
+    @classmethod
+    def GetFileKey(cls, vFile):
+        st = os.stat(vFile)
+        return "{0}:{1}:{2}:{3}".format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
     # Intelligently copies the file into the initramfs
     @classmethod
     def Copy(cls, vFile, **optionalArgs):
-        # NOTE: shutil.copy will dereference all symlinks before copying.
+        # NOTE: Symlinks are dereferenced before copying.
 
         # If a prefix was passed into the function as an optional argument
         # it will be used below.
         directoryPrefix = optionalArgs.get("directoryPrefix", None)
 
-        # Check to see if a file with this name exists before copying,
-        # if it exists, delete it, then copy. If a directory, create the directory
-        # before copying.
         if directoryPrefix:
-            path =  var.temp + "/" + directoryPrefix + "/" + vFile
-            targetFile = directoryPrefix + "/" +  vFile
+            path = os.path.normpath(var.temp + "/" + directoryPrefix + "/" + vFile)
+            targetFile = directoryPrefix + "/" + vFile
         else:
-            path = var.temp + "/" + vFile
+            path = os.path.normpath(var.temp + "/" + vFile)
             targetFile = vFile
 
-        if os.path.exists(path):
-            if os.path.isfile(path):
-                os.remove(path)
-                shutil.copy(targetFile, path)
-        else:
-            if os.path.isfile(targetFile):
-                # Make sure that the directory that this file wants to be in
-                # exists, if not then create it.
-                if os.path.isdir(os.path.dirname(path)):
-                    shutil.copy(targetFile, path)
-                else:
-                    os.makedirs(os.path.dirname(path))
-                    shutil.copy(targetFile, path)
-            elif os.path.isdir(targetFile):
-                os.makedirs(path)
-
-        # Finally lets make sure that the file was copied to its destination
-        if not os.path.isfile(path):
+        # A single stat tells us everything we need about the source
+        try:
+            st = os.stat(targetFile)
+        except OSError:
+            cls.Fail("Unable to copy " + targetFile + " to " + path + "!")
+
+        if stat.S_ISDIR(st.st_mode):
+            cls.MakeDirectory(path)
+            return
+
+        cls.MakeDirectory(os.path.dirname(path))
+
+        try:
+            cls.StageFile(targetFile, path, st)
+        except OSError:
             cls.Fail("Unable to copy " + targetFile + " to " + path + "!")
 
+    # Forgets the directories that MakeDirectory created (the temporary
+    # directory is removed or belongs to another build)
+    @classmethod
+    def ForgetDirectories(cls):
+        cls._directories.clear()
+
+    # Creates a directory (and its parents) in the temporary directory. The
+    # directories that are known to exist are remembered so that each one
+    # is only created once.
+    @classmethod
+    def MakeDirectory(cls, vPath):
+        if vPath in cls._directories:
+            return
+
+        os.makedirs(vPath, exist_ok=True)
+
+        while vPath not in cls._directories and vPath != "/":
+            cls._directories.add(vPath)
+            vPath = os.path.dirname(vPath)
+
+    # Copies a directory tree into the temporary directory using the same
+    # staging methods as single files
+    @classmethod
+    def CopyTree(cls, vSource, vTarget):
+        shutil.copytree(vSource, vTarget, copy_function=cls.StageFile)
+
+    # Places a file at the target path using the cheapest method available.
+    # In order: a hard link (if the 'link' staging mode is selected), a
+    # reflink (FICLONE), an in-kernel copy (copy_file_range) and finally a
+    # normal copy. Any file that already exists at the target is replaced.
+    #
+    # NOTE: Since staged files might be hard links to the files on the host,
+    # later steps must never modify a staged file in place, they must write
+    # a new file and replace the staged one.
+    #
+    # 'vMode' is the mode the staged file must have (the mode of the source
+    # by default). A hard link is only used if the source already has it,
+    # since changing the mode of a link changes the source (i.e a cache object).
+    @classmethod
+    def StageFile(cls, vSource, vTarget, vStat=None, vMode=None):
+        st = vStat or os.stat(vSource)
+        mode = stat.S_IMODE(st.st_mode) if vMode is None else vMode
+
+        Metrics.Count("files")
+        Metrics.Count("bytes", st.st_size)
+
+        if var.staging == "link" and st.st_dev not in cls._no_link and stat.S_IMODE(st.st_mode) == mode:
+            try:
+                cls.Replace(vTarget, lambda: os.link(vSource, vTarget))
+                return vTarget
+            except OSError:
+                # Different filesystem or not allowed, don't try again for this device
+                cls._no_link.add(st.st_dev)
+
+        with open(vSource, "rb") as source:
+            fd = cls.Replace(vTarget, lambda: os.open(vTarget, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+
+            with os.fdopen(fd, "wb") as target:
+                cls.CopyData(source, target, st)
+                os.fchmod(target.fileno(), mode)
+
+        return vTarget
+
+    # Runs a function that creates the target. If the target already exists,
+    # it is removed (never truncated, it might be a hard link) and the
+    # function is ran again.
+    @classmethod
+    def Replace(cls, vTarget, vCreate):
+        try:
+            return vCreate()
+        except FileExistsError:
+            os.remove(vTarget)
+            return vCreate()
+
+    # Rewrites a text file through a function that receives and returns its
+    # lines. The new content is written to a new file that replaces the old
+    # one, so files that are hard links to the host are never modified.
+    @classmethod
+    def EditFile(cls, vFile, vFunction):
+        with open(vFile, "r") as file:
+            lines = file.read().splitlines(True)
+
+        tempFile = vFile + ".edit"
+
+        with open(tempFile, "w") as file:
+            file.writelines(vFunction(lines))
+
+        shutil.copymode(vFile, tempFile)
+        os.replace(tempFile, vFile)
+
+    # Copies the content of one opened file into another
+    @classmethod
+    def CopyData(cls, vSource, vTarget, vStat):
+        if var.staging != "copy" and vStat.st_dev not in cls._no_clone:
+            try:
+                fcntl.ioctl(vTarget.fileno(), cls._ficlone, vSource.fileno())
+                return
+            except OSError:
+                cls._no_clone.add(vStat.st_dev)
+
+        remaining = vStat.st_size
+
+        if var.staging != "copy" and hasattr(os, "copy_file_range"):
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(vSource.fileno(), vTarget.fileno(), remaining)
+
+                    if not copied:
+                        break
+
+                    remaining -= copied
+
+                if remaining <= 0:
+                    return
+            except OSError:
+                if remaining != vStat.st_size:
+                    raise
+
+        shutil.copyfileobj(vSource, vTarget, 1024 * 1024)
+
     ####### Message Functions #######
 
-    # Returns the string with a color to be used in bash
+    # Returns true if messages should be colored
+    @classmethod
+    def UseColor(cls):
+        if var.color == "auto":
+            if cls._use_color is None:
+                cls._use_color = sys.stdout.isatty() and os.environ.get("TERM") != "dumb"
+
+            return cls._use_color
+
+        return var.color == "always"
+
+    # Returns the string with a color to be used in the terminal
     @classmethod
     def Colorize(cls, vColor, vMessage):
-        if vColor == "red":
-            colored_message = "\e[1;31m" + vMessage + "\e[0;m"
-        elif vColor == "yellow":
-            colored_message = "\e[1;33m" + vMessage + "\e[0;m"
-        elif vColor == "green":
-            colored_message = "\e[1;32m" + vMessage + "\e[0;m"
-        elif vColor == "cyan":
-            colored_message = "\e[1;36m" + vMessage + "\e[0;m"
-        elif vColor == "purple":
-            colored_message = "\e[1;34m" + vMessage + "\e[0;m"
-        elif vColor == "none":
-            colored_message = vMessage
-
-        return colored_message
-
-    # Prints a message through the shell
+        if vColor == "none" or var.logFormat == "json" or not cls.UseColor():
+            return vMessage
+
+        return cls._colors[vColor] + vMessage + "\033[0;m"
+
+    # Adds a message to the output buffer. In the 'json' format every
+    # message is written as a single JSON object with its level.
+    @classmethod
+    def Log(cls, vLevel, vPrefix, vMessage):
+        if var.quiet and vLevel in ("print", "info", "flag", "option"):
+            return
+
+        if var.logFormat == "json":
+            entry = {"time": round(time.time(), 3), "level": vLevel, "message": vMessage}
+
+            if var.logTag:
+                entry["build"] = var.logTag
+
+            line = json.dumps(entry)
+        elif var.logTag and vMessage:
+            line = vPrefix + "(" + var.logTag + ") " + vMessage
+        else:
+            line = vPrefix + vMessage
+
+        if not cls._buffer:
+            # The buffer is flushed at exit (before the metrics summary)
+            if not cls._flush_registered:
+                atexit.register(cls.Flush)
+                cls._flush_registered = True
+
+        cls._buffer.append(line)
+
+        # Anything that marks progress is shown right away, the rest is
+        # written in batches
+        if vLevel in ("info", "warn", "fail") or len(cls._buffer) >= 64:
+            cls.Flush()
+
+    # Writes the buffered messages
+    @classmethod
+    def Flush(cls):
+        if cls._buffer:
+            sys.stdout.write("\n".join(cls._buffer) + "\n")
+            cls._buffer = []
+
+        sys.stdout.flush()
+
+    # Clears the terminal
+    @classmethod
+    def ClearScreen(cls):
+        if var.logFormat != "json" and not var.quiet and sys.stdout.isatty():
+            sys.stdout.write("\033[H\033[2J")
+            sys.stdout.flush()
+
+    # Prints a message
     @classmethod
     def Print(cls, vMessage):
-        call(["echo", "-e", vMessage])
+        cls.Log("print", "", vMessage)
 
     # Used for displaying information
     @classmethod
     def Info(cls, vMessage):
-        call(["echo", "-e", cls.Colorize("green", "[*] ") + vMessage])
+        cls.Log("info", cls.Colorize("green", "[*] "), vMessage)
 
     # Used for input (questions)
     @classmethod
     def Question(cls, vQuestion):
+        cls.Flush()
         return input(vQuestion)
 
     # Used for warnings
     @classmethod
     def Warn(cls, vMessage):
-        call(["echo", "-e", cls.Colorize("yellow", "[!] ") + vMessage])
+        cls.Log("warn", cls.Colorize("yellow", "[!] "), vMessage)
 
     # Used for flags (aka using zfs, luks, etc)
     @classmethod
     def Flag(cls, vFlag):
-        call(["echo", "-e", cls.Colorize("purple", "[+] ") + vFlag])
+        cls.Log("flag", cls.Colorize("purple", "[+] "), vFlag)
 
     # Used for options
     @classmethod
     def Option(cls, vOption):
-        call(["echo", "-e", cls.Colorize("cyan", "[>] ") + vOption])
+        cls.Log("option", cls.Colorize("cyan", "[>] "), vOption)
 
     # Used for errors
     @classmethod
     def Fail(cls, vMessage):
-        cls.Print(cls.Colorize("red", "[#] ") + vMessage)
+        cls.Log("fail", cls.Colorize("red", "[#] "), vMessage)
         cls.NewLine()
         cls.Clean()
         quit(1)
@@ -211,7 +520,8 @@ class Tools(object):
     # Prints empty line
     @classmethod
     def NewLine(cls):
-        print("")
+        if var.logFormat != "json":
+            cls.Log("print", "", "")
 
     # Error Function: Binary doesn't exist
     @classmethod
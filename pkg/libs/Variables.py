@@ -2,7 +2,7 @@
 # Licensed under the Simplified BSD License which can be found in the LICENSE file.
 
 import os
-import subprocess
+import stat
 import sys
 import random
 
@@ -24,6 +24,34 @@ lmodules = ""
 initrd = "initrd"
 choice = ""
 
+# Kernels that an initramfs is built for in a single run (each one is built
+# in its own process) and the amount of builds that run at the same time
+# (0 uses all the cores)
+kernels = []
+jobs = 0
+
+# Keep running and rebuild the images when the files they are made of
+# change. The changes are collected until nothing changed for 'watchDelay'
+# seconds. Without inotify the files are checked every 'watchInterval' seconds.
+watch = False
+watchDelay = 2
+watchInterval = 5
+
+# Compression used for the initramfs (gzip, xz, zstd, lz4, none), its level
+# (None uses the default level of the codec) and the amount of threads
+# used to compress it (0 uses all the cores).
+compression = "gzip"
+compressionLevel = None
+compressionThreads = 0
+
+# Compression used for the kernel modules (gz, xz, zst, none). Modules
+# that are already compressed on the host are copied as is.
+moduleCompression = "gz"
+
+# Strip the debug information and the symbols that aren't needed at runtime
+# from the binaries, libraries and kernel modules in the initramfs
+strip = False
+
 rstring = str(random.randint(100000000,999999999))
 
 temp = "/tmp/" + rstring
@@ -50,42 +78,149 @@ llib64 = temp + lib64
 letc = temp + etc
 
 # CPU Architecture
-arch = subprocess.check_output(["uname", "-m"], universal_newlines=True).strip()
+arch = os.uname().machine
 
 # Preliminary binaries needed for the success of creating the initrd
 # but that are not needed to be placed inside the initrd
 prel_bin = [
-    "/bin/cpio",
     "/sbin/depmod",
 ]
 
 # Firmware directory
 firmwareDirectory = "/lib/firmware/"
 
-# Layout of the initramfs
+# Firmware selected from the command line: auto (the firmware that the
+# included modules request), all, or empty to use the firmware hook settings
+firmwareSelection = ""
+
+# Check the zpool.cache against the labels of its devices before it goes
+# into the initramfs: warn (report the stale devices), strict (refuse to
+# build) or off
+zpoolCheck = "warn"
+
+# Encrypted drives that init unlocks when the 'enc_drives' boot option
+# isn't given, and the amount of drives that are unlocked at the same time
+# (0 picks it when booting, from the cores and the available memory)
+encDrives = []
+encJobs = 0
+
+# Detect the modules that this machine needs to boot (host-only mode)
+# instead of only using the modules in the addon hook
+hostOnly = False
+
+# Roots of the sysfs and procfs trees that the host-only mode reads
+# (They can point to a copy of another machine's trees)
+sysfsRoot = "/sys"
+procRoot = "/proc"
+
+# Build the initramfs as concatenated cpio segments (layers), each one
+# compressed on its own. A layer that didn't change since a previous build
+# is reused from the cache instead of being compressed again.
+layered = False
+
+# Layers of a layered initramfs, in order, and the paths (relative to the
+# root of the initramfs) that go into them. Everything that isn't listed
+# goes into the first layer (base).
+layers = [
+    ("base", []),
+    ("modules", ["lib/modules", "lib/firmware", "etc/modules.plan"]),
+    ("volatile", ["init", "etc/zfs/zpool.cache", "etc/modprobe.d"]),
+]
+
+# Add an uncompressed early segment with the CPU microcode (it must be the
+# first segment so that the kernel can load the microcode before anything else)
+microcode = False
+
+# Microcode file in the early segment: directory in the firmware directory
+# and the pattern of its files
+microcodeSources = {
+    "GenuineIntel.bin": ("intel-ucode", "*"),
+    "AuthenticAMD.bin": ("amd-ucode", "*.bin"),
+}
+
+# Persistent cache used to speed up later builds
+cacheDirectory = "/var/cache/bliss-initramfs"
+
+# Parsed ELF dependency information
+elfCache = cacheDirectory + "/elf.json"
+
+# Content hashes of the files that went into previous builds
+hashCache = cacheDirectory + "/hashes.json"
+
+# Why every file is in the image (the provenance graph of every build, by image)
+provenanceDirectory = cacheDirectory + "/provenance"
+
+# Also write the provenance graph of the build to this file (JSON, or
+# Graphviz if it ends with .dot)
+provenance = ""
+
+# Reuse the results of previous builds?
+useCache = True
+
+# How files are placed into the temporary directory:
+#   auto - reflinks or in-kernel copies when possible, normal copies otherwise
+#   link - hard links when possible (same filesystem), otherwise like 'auto'
+#   copy - always normal copies
+staging = "auto"
+
+# Path of the JSON report with the metrics of every build phase (if any)
+metricsReport = ""
+
+# Name of a build phase that will be ran under cProfile (i.e CopyModules)
+profilePhase = ""
+
+# Output of the messages:
+#   color - auto (only when writing to a terminal), always or never
+#   quiet - only show warnings and errors
+#   logFormat - text, or json (one JSON object per message)
+color = "auto"
+quiet = False
+logFormat = "text"
+
+# Label added to the messages of a build when several builds run at the
+# same time (the kernel of the build)
+logTag = ""
+
+# Layout of the initramfs (relative to the temporary directory)
 baselayout = [
-    temp + "/etc",
-    temp + "/etc/zfs",
-    temp + "/dev",
-    temp + "/proc",
-    temp + "/sys",
-    temp + "/mnt",
-    temp + "/mnt/root",
-    temp + "/mnt/key",
-    temp + "/lib",
-    temp + "/lib/modules",
-    temp + "/lib64",
-    temp + "/bin",
-    temp + "/sbin",
-    temp + "/usr",
-    temp + "/root",
-    temp + "/run"
+    "/etc",
+    "/etc/zfs",
+    "/dev",
+    "/proc",
+    "/sys",
+    "/mnt",
+    "/mnt/root",
+    "/mnt/key",
+    "/lib",
+    "/lib/modules",
+    "/lib64",
+    "/bin",
+    "/sbin",
+    "/usr",
+    "/root",
+    "/run"
 ]
 
-# Line numbers in the 'init' script where sed will substitute its values in
-useZfsLine = "7"
-useLuksLine = "8"
-useAddonLine = "9"
-useUdevLine = "10"
-initrdVersionLine = "12"
-addonModulesLine = "35"
+# Device nodes that are written straight into the initramfs archive.
+# Format: (path in the initramfs, mode, major, minor)
+basedevices = [
+    ("dev/console", stat.S_IFCHR | 0o600, 5, 1),
+    ("dev/null", stat.S_IFCHR | 0o666, 1, 3),
+]
+
+# Module load plan inside the initramfs (one level of modules per line)
+modulePlan = "/etc/modules.plan"
+
+# Changes made to the shell configuration files that are copied from the
+# host, so that they work with the tools available in the initramfs.
+# Format: file: [("replace", line pattern, old, new) or ("append", line)]
+shellFixups = {
+    "/etc/bash/bashrc": [
+        ("append", "alias poweroff='poweroff -f'"),
+        ("append", "alias reboot='reboot -f'"),
+    ],
+    "/etc/profile": [
+        ("replace", r"EDITOR", "/bin/nano", "/bin/vi"),
+        ("replace", r"PAGER", "/usr/bin/less", "/bin/less"),
+    ],
+}
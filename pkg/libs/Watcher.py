@@ -0,0 +1,276 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from pkg.libs.Tools import Tools
+
+# Watches files and directories for changes and reports the targets (any
+# value that the caller attached to a path) that changed. inotify is used
+# through the C library, and if it isn't available, the paths are polled.
+# Directories that don't exist (yet) are checked every interval and
+# watched once they show up.
+class Watcher(object):
+    # inotify events that are watched: the content, the attributes or the
+    # entries of a directory changed
+    _in_modify = 0x00000002
+    _in_attrib = 0x00000004
+    _in_close_write = 0x00000008
+    _in_moved_from = 0x00000040
+    _in_moved_to = 0x00000080
+    _in_create = 0x00000100
+    _in_delete = 0x00000200
+    _in_delete_self = 0x00000400
+    _in_move_self = 0x00000800
+
+    # The watch was removed (i.e the directory was deleted)
+    _in_ignored = 0x00008000
+
+    # inotify_init1 flags
+    _in_nonblock = 0o4000
+    _in_cloexec = 0o2000000
+
+    # Header of an inotify event (wd, mask, cookie, length of the name)
+    _event = struct.Struct("iIII")
+
+    def __init__(self, vInterval):
+        # Paths that are watched: (directory, name or None for the whole directory, target)
+        self._paths = []
+
+        # inotify watch descriptors: directory and its (name, target) entries
+        self._watches = {}
+        self._directories = {}
+
+        # Directories that couldn't be watched (they don't exist right now)
+        self._unwatched = set()
+
+        self._interval = vInterval
+        self._snapshot = {}
+        self._fd = self.OpenInotify()
+
+    # Returns a non blocking inotify descriptor, or None if inotify
+    # isn't available (the paths are polled then)
+    def OpenInotify(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = self._libc.inotify_init1(self._in_nonblock | self._in_cloexec)
+        except (OSError, AttributeError):
+            fd = -1
+
+        if fd < 0:
+            Tools.Warn("inotify isn't available. The files will be checked every " + str(self._interval) + " seconds ...")
+            return None
+
+        return fd
+
+    # Returns true if inotify is used
+    def UsesInotify(self):
+        return self._fd is not None
+
+    # Watches a file or a directory (only its own entries, not the
+    # subdirectories). Files are watched through their directory, so
+    # files that are replaced by a rename are still noticed.
+    def Add(self, vPath, vTarget):
+        vPath = os.path.normpath(vPath)
+
+        if os.path.isdir(vPath):
+            directory, name = vPath, None
+        else:
+            directory, name = os.path.dirname(vPath), os.path.basename(vPath)
+
+        if (directory, name, vTarget) in self._paths:
+            return
+
+        self._paths.append((directory, name, vTarget))
+        self._snapshot[(directory, name, vTarget)] = self.GetState(directory, name)
+
+        if self._fd is None:
+            return
+
+        wd = self._directories.get(directory)
+
+        if wd is not None:
+            self._watches[wd][1].append((name, vTarget))
+        elif not self.Watch(directory):
+            self._unwatched.add(directory)
+
+    # Watches a directory for all the paths in it. Returns false if it
+    # can't be watched (i.e it doesn't exist).
+    def Watch(self, vDirectory):
+        mask = (self._in_modify | self._in_attrib | self._in_close_write | self._in_moved_from |
+                self._in_moved_to | self._in_create | self._in_delete | self._in_delete_self | self._in_move_self)
+
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(vDirectory), mask)
+
+        if wd < 0:
+            return False
+
+        self._directories[vDirectory] = wd
+        self._watches[wd] = (vDirectory, [(name, target) for directory, name, target in self._paths if directory == vDirectory])
+
+        return True
+
+    # Watches the directories that showed up since the last time and
+    # returns the targets of the paths in them that changed meanwhile
+    def Arm(self):
+        targets = set()
+
+        for directory in sorted(self._unwatched):
+            if self.Watch(directory):
+                self._unwatched.discard(directory)
+                targets |= self.GetChanged(directory)
+
+        return targets
+
+    # Returns the targets of the paths in a directory whose state isn't the
+    # last known one (and remembers the new state)
+    def GetChanged(self, vDirectory):
+        targets = set()
+
+        for directory, name, target in self._paths:
+            if directory != vDirectory:
+                continue
+
+            state = self.GetState(directory, name)
+
+            if state != self._snapshot[(directory, name, target)]:
+                self._snapshot[(directory, name, target)] = state
+                targets.add(target)
+
+        return targets
+
+    # Returns the state of a watched path, used by the polling fallback
+    def GetState(self, vDirectory, vName):
+        if vName:
+            try:
+                st = os.stat(os.path.join(vDirectory, vName))
+            except OSError:
+                return None
+
+            return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+        try:
+            names = sorted(os.listdir(vDirectory))
+        except OSError:
+            return None
+
+        return tuple((name, self.GetState(vDirectory, name)) for name in names)
+
+    # Waits until something changes and returns the targets that changed.
+    # After the first change, the changes are collected until nothing
+    # changed for 'vDelay' seconds, so a kernel install or a package update
+    # only triggers one rebuild.
+    def Wait(self, vDelay):
+        targets = set()
+
+        # Events of other files in a watched directory don't return targets
+        while not targets:
+            targets = self.Read(None)
+
+        while True:
+            more = self.Read(vDelay)
+
+            if not more:
+                return targets
+
+            targets |= more
+
+    # Returns the targets that changed within 'vTimeout' seconds (forever
+    # if it is None). An empty set means that nothing changed.
+    def Read(self, vTimeout):
+        if self._fd is None:
+            return self.Poll(vTimeout)
+
+        deadline = None if vTimeout is None else time.monotonic() + vTimeout
+
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+
+            # The directories that can't be watched yet are checked every interval
+            if self._unwatched:
+                timeout = self._interval if timeout is None else min(timeout, self._interval)
+
+            targets = self.ReadEvents(timeout) | self.Arm()
+
+            if targets or (deadline is not None and time.monotonic() >= deadline):
+                return targets
+
+    # Returns the targets of the inotify events that arrive within
+    # 'vTimeout' seconds. Directories whose watch was removed are watched
+    # again when they show up.
+    def ReadEvents(self, vTimeout):
+        try:
+            ready = select.select([self._fd], [], [], vTimeout)[0]
+        except InterruptedError:
+            return set()
+
+        if not ready:
+            return set()
+
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        targets = set()
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if wd not in self._watches:
+                continue
+
+            directory = self._watches[wd][0]
+
+            if mask & self._in_ignored:
+                del self._watches[wd]
+                del self._directories[directory]
+                self._unwatched.add(directory)
+                targets |= self.GetChanged(directory)
+                continue
+
+            for watched, target in self._watches[wd][1]:
+                if watched is None or watched == name:
+                    self._snapshot[(directory, watched, target)] = self.GetState(directory, watched)
+                    targets.add(target)
+
+        return targets
+
+    # Compares the watched paths against their last known state every
+    # interval and returns the targets that changed
+    def Poll(self, vTimeout):
+        deadline = None if vTimeout is None else time.monotonic() + vTimeout
+
+        while True:
+            targets = set()
+
+            for directory, name, target in self._paths:
+                state = self.GetState(directory, name)
+
+                if state != self._snapshot[(directory, name, target)]:
+                    self._snapshot[(directory, name, target)] = state
+                    targets.add(target)
+
+            if targets:
+                return targets
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+            wait = self._interval if deadline is None else min(self._interval, max(0, deadline - time.monotonic()))
+            time.sleep(wait)
+
+    # Stops watching
+    def Close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,285 @@
+# Copyright 2012-2015 Jonathan Vasquez <jvasquez1011@gmail.com>
+# Licensed under the Simplified BSD License which can be found in the LICENSE file.
+
+import glob
+import os
+import struct
+
+# Reads the zpool.cache and the labels of the ZFS vdevs (both are packed
+# nvlists in the XDR encoding) without the ZFS tools, and checks that the
+# devices listed in the zpool.cache are still the vdevs of their pools.
+class ZpoolCache(object):
+    # nvlist data types that hold a single number and how XDR encodes them
+    # (everything smaller than 32 bits takes 32 bits)
+    _scalars = {
+        2: ">I",    # byte
+        3: ">i",    # int16
+        4: ">I",    # uint16
+        5: ">i",    # int32
+        6: ">I",    # uint32
+        7: ">q",    # int64
+        8: ">Q",    # uint64
+        18: ">q",   # hrtime
+        21: ">i",   # boolean value
+        22: ">i",   # int8
+        23: ">I",   # uint8
+        27: ">d",   # double
+    }
+
+    # nvlist data types that hold an array of numbers
+    _arrays = {
+        11: ">i",   # int16 array
+        12: ">I",   # uint16 array
+        13: ">i",   # int32 array
+        14: ">I",   # uint32 array
+        15: ">q",   # int64 array
+        16: ">Q",   # uint64 array
+        24: ">i",   # boolean array
+        25: ">i",   # int8 array
+        26: ">I",   # uint8 array
+    }
+
+    # Other nvlist data types
+    _boolean = 1
+    _string = 9
+    _byte_array = 10
+    _string_array = 17
+    _nvlist = 19
+    _nvlist_array = 20
+
+    # Encoding of a packed nvlist (first byte of its header)
+    _encoding_xdr = 1
+
+    # Size of a vdev label, and the offset and size of its nvlist. There are
+    # two labels at the start of the device (and two at the end).
+    _label_size = 256 * 1024
+    _label_nvlist = (16 * 1024, 112 * 1024)
+
+    # Directories searched for the vdevs that aren't where the cache says
+    _device_directories = ["/dev/disk/by-id", "/dev/disk/by-partuuid", "/dev/disk/by-path"]
+
+    # The vdevs of the devices in the device directories, by their GUID (Lazily loaded)
+    _guids = None
+
+    # The devices of every pool found by the last check
+    # Format: pool: [device path]
+    _devices = {}
+
+    # Forgets the devices found by the last check and the labels that were
+    # read (the disks might have changed since)
+    @classmethod
+    def Reset(cls):
+        cls._guids = None
+        cls._devices = {}
+
+    # Unpacks a packed nvlist into a dictionary
+    @classmethod
+    def Unpack(cls, vData):
+        if len(vData) < 4 or vData[0] != cls._encoding_xdr:
+            raise ValueError("not an XDR encoded nvlist")
+
+        try:
+            nvlist, offset = cls.ReadList(vData, 4)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise ValueError("truncated or corrupted nvlist")
+
+        return nvlist
+
+    # Reads an nvlist: its version and flags, the pairs and the two zeros
+    # that end it. Returns the nvlist and the offset after it.
+    @classmethod
+    def ReadList(cls, vData, vOffset):
+        offset = vOffset + 8
+        nvlist = {}
+
+        while True:
+            encodedSize, decodedSize = struct.unpack_from(">ii", vData, offset)
+            offset += 8
+
+            if encodedSize == 0 and decodedSize == 0:
+                return nvlist, offset
+
+            name, offset = cls.ReadString(vData, offset)
+            kind, count = struct.unpack_from(">ii", vData, offset)
+            offset += 8
+
+            nvlist[name], offset = cls.ReadValue(vData, offset, kind, count)
+
+    # Reads the value of a pair. Returns the value and the offset after it.
+    @classmethod
+    def ReadValue(cls, vData, vOffset, vKind, vCount):
+        if vKind == cls._boolean:
+            return True, vOffset
+        elif vKind in cls._scalars:
+            value = struct.unpack_from(cls._scalars[vKind], vData, vOffset)[0]
+            return value, vOffset + struct.calcsize(cls._scalars[vKind])
+        elif vKind in cls._arrays:
+            count = struct.unpack_from(">I", vData, vOffset)[0]
+            size = struct.calcsize(cls._arrays[vKind])
+            values = [struct.unpack_from(cls._arrays[vKind], vData, vOffset + 4 + i * size)[0] for i in range(count)]
+            return values, vOffset + 4 + count * size
+        elif vKind == cls._string:
+            return cls.ReadString(vData, vOffset)
+        elif vKind == cls._byte_array:
+            if vOffset + vCount > len(vData):
+                raise IndexError
+            return bytes(vData[vOffset:vOffset + vCount]), vOffset + (vCount + 3) // 4 * 4
+        elif vKind == cls._string_array:
+            values = []
+
+            for i in range(vCount):
+                value, vOffset = cls.ReadString(vData, vOffset)
+                values.append(value)
+
+            return values, vOffset
+        elif vKind == cls._nvlist:
+            return cls.ReadList(vData, vOffset)
+        elif vKind == cls._nvlist_array:
+            values = []
+
+            for i in range(vCount):
+                value, vOffset = cls.ReadList(vData, vOffset)
+                values.append(value)
+
+            return values, vOffset
+
+        raise ValueError("unknown nvlist data type " + str(vKind))
+
+    # Reads an XDR string (its length, the characters and the padding)
+    @classmethod
+    def ReadString(cls, vData, vOffset):
+        length = struct.unpack_from(">I", vData, vOffset)[0]
+        start = vOffset + 4
+
+        if start + length > len(vData):
+            raise IndexError
+
+        return bytes(vData[start:start + length]).decode(), start + (length + 3) // 4 * 4
+
+    # Returns the pools in a zpool.cache file (pool name: configuration)
+    @classmethod
+    def Read(cls, vPath):
+        with open(vPath, "rb") as cache:
+            pools = cls.Unpack(cache.read())
+
+        return dict((name, config) for name, config in pools.items() if isinstance(config, dict))
+
+    # Returns the leaf vdevs (disks and files) of a vdev tree
+    @classmethod
+    def GetLeaves(cls, vTree):
+        if vTree.get("children"):
+            return [leaf for child in vTree["children"] for leaf in cls.GetLeaves(child)]
+
+        if vTree.get("type") in ("disk", "file"):
+            return [vTree]
+
+        return []
+
+    # Returns the nvlist of the first valid label of a device, or None if
+    # the device doesn't have a ZFS label. Raises OSError if the device
+    # can't be read.
+    @classmethod
+    def ReadLabel(cls, vDevice):
+        offset, size = cls._label_nvlist
+
+        with open(vDevice, "rb") as device:
+            for label in (0, cls._label_size):
+                device.seek(label + offset)
+
+                try:
+                    nvlist = cls.Unpack(device.read(size))
+                except ValueError:
+                    continue
+
+                if "guid" in nvlist:
+                    return nvlist
+
+        return None
+
+    # Returns what is wrong with the label of a device (or None if it
+    # belongs to the vdev). Devices that can't be read aren't checked.
+    @classmethod
+    def CheckLabel(cls, vDevice, vGuid, vPoolGuid):
+        try:
+            label = cls.ReadLabel(vDevice)
+        except OSError:
+            return None
+
+        if not label:
+            return "doesn't have a ZFS label"
+
+        if label.get("guid") != vGuid or label.get("pool_guid") != vPoolGuid:
+            return "is a different vdev now"
+
+        return None
+
+    # Returns the path of the device whose label has a vdev GUID, from the
+    # device directories (i.e a disk that was moved or renamed)
+    @classmethod
+    def FindDevice(cls, vGuid):
+        if cls._guids is None:
+            cls._guids = {}
+
+            for directory in cls._device_directories:
+                for path in sorted(glob.glob(directory + "/*")):
+                    try:
+                        label = cls.ReadLabel(path)
+                    except OSError:
+                        continue
+
+                    if label:
+                        cls._guids.setdefault(label["guid"], path)
+
+        return cls._guids.get(vGuid)
+
+    # Checks every leaf vdev of every pool in a zpool.cache file against the
+    # label of the device it points to. Returns the problems found, as
+    # (pool, path, problem, the device where the vdev is now or None), and
+    # remembers the devices of every pool (where they are now).
+    @classmethod
+    def Check(cls, vPath):
+        problems = []
+        cls._devices = {}
+
+        for name, config in sorted(cls.Read(vPath).items()):
+            devices = []
+
+            for leaf in cls.GetLeaves(config.get("vdev_tree", {})):
+                path = leaf.get("path")
+                problem = None
+
+                if not path:
+                    continue
+
+                if not os.path.exists(path):
+                    problem = "doesn't exist"
+                elif leaf["type"] == "disk":
+                    problem = cls.CheckLabel(path, leaf.get("guid"), config.get("pool_guid"))
+
+                if problem:
+                    found = cls.FindDevice(leaf.get("guid"))
+                    problems.append((name, path, problem, found))
+
+                    if found:
+                        devices.append(found)
+                else:
+                    devices.append(path)
+
+            cls._devices[name] = devices
+
+        return problems
+
+    # Returns the devices of every pool found by the last check, by pool
+    @classmethod
+    def GetPools(cls):
+        return dict(cls._devices)
+
+    # Returns the devices of every pool found by the last check
+    @classmethod
+    def GetDevices(cls):
+        return [device for name, devices in sorted(cls._devices.items()) for device in devices]
+
+    # Returns the devices of every pool as 'pool=device' entries for init
+    @classmethod
+    def GetHints(cls):
+        return [name + "=" + device for name, devices in sorted(cls._devices.items()) for device in devices]